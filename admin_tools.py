@@ -1,12 +1,20 @@
-from database import Database
+import sys
 from datetime import datetime
 
+# Модули бота и SQLAlchemy импортируются внутри команд: каждой команде нужна своя часть
+
 def add_parent_manually():
     """Инструмент для ручного добавления родителей"""
-    db = Database()
+    from queries import PaymentQueries
+    from reference_cache import ReferenceCache
+    
+    queries = PaymentQueries()
+    # Индексы и ключи, на которые опирается add_parent, как при запуске бота
+    queries.ensure_schema()
+    refs = ReferenceCache(queries.engine)
     
     # Показываем доступные школы
-    schools = db.get_schools()
+    schools = refs.get_schools()
     print("\n🏫 Доступные школы:")
     for i, school in enumerate(schools, 1):
         print(f"{i}. {school.name}")
@@ -15,7 +23,7 @@ def add_parent_manually():
     selected_school = schools[school_choice]
     
     # Показываем классы в выбранной школе
-    grades = db.get_grades_by_school(selected_school.id)
+    grades = refs.get_grades_by_school(selected_school.id)
     print(f"\n📚 Классы в {selected_school.name}:")
     for i, grade in enumerate(grades, 1):
         print(f"{i}. {grade.grade_name} ({grade.monthly_payment} руб./мес)")
@@ -35,8 +43,8 @@ def add_parent_manually():
     if chat_id:
         chat_id = int(chat_id)
     
-    # Добавляем родителя
-    parent = db.add_parent(
+    # Добавляем родителя одним INSERT, без загрузки ORM
+    parent_id = queries.add_parent(
         first_name=first_name,
         last_name=last_name,
         child_name=child_name,
@@ -47,12 +55,80 @@ def add_parent_manually():
     )
     
     print(f"\n✅ Родитель успешно добавлен!")
-    print(f"ID: {parent.id}")
-    print(f"Имя: {parent.first_name} {parent.last_name or ''}")
-    print(f"Ребенок: {parent.child_name}")
+    print(f"ID: {parent_id}")
+    print(f"Имя: {first_name} {last_name or ''}")
+    print(f"Ребенок: {child_name}")
     print(f"Школа: {selected_school.name}")
     print(f"Класс: {selected_grade.grade_name}")
     print(f"Сумма оплаты: {selected_grade.monthly_payment} руб./мес")
 
+def import_parents(path, dry_run=False):
+    """Массовый импорт родителей из CSV/XLSX"""
+    from importer import ParentImporter
+    from queries import PaymentQueries
+    from reference_cache import ReferenceCache
+    
+    queries = PaymentQueries()
+    queries.ensure_schema()
+    importer = ParentImporter(queries.engine, ReferenceCache(queries.engine))
+    
+    started = datetime.now()
+    report = importer.import_file(path, dry_run=dry_run)
+    elapsed = (datetime.now() - started).total_seconds()
+    
+    if dry_run:
+        print("\n🔍 Проверка без записи в базу")
+    print(f"\n📥 Импорт из {path} за {elapsed:.1f} сек.")
+    print(report.summary_text())
+
+def migrate():
+    """Применить новые миграции схемы"""
+    from db_session import get_engine
+    from migrations import apply_migrations
+    
+    applied = apply_migrations(get_engine())
+    if applied:
+        print("\n✅ Применены миграции:")
+        for migration_id in applied:
+            print(f"• {migration_id}")
+    else:
+        print("\n✅ Схема актуальна, новых миграций нет")
+
+def rebuild_summary(month=None):
+    """Пересчитать итоги payment_summary по таблице payments"""
+    from queries import PaymentQueries
+    
+    rows = PaymentQueries().rebuild_summary(month)
+    print(f"\n✅ Итоги пересчитаны{' за ' + month if month else ''}: {rows} строк")
+
+def check_plans(verbose=False):
+    """EXPLAIN QUERY PLAN для всех запросов бота; код выхода 1, если есть полный просмотр таблицы"""
+    from db_session import get_engine
+    from migrations import check_query_plans
+    
+    failed = 0
+    for name, statement, plan, scans in check_query_plans(get_engine()):
+        status = f"❌ полный просмотр: {', '.join(scans)}" if scans else "✅"
+        print(f"\n{status} {name}")
+        if scans or verbose:
+            print('   ' + ' '.join(statement.split())[:200])
+            for detail in plan:
+                print(f"   {detail}")
+        failed += bool(scans)
+    
+    print(f"\nЗапросов с полным просмотром: {failed}")
+    return failed
+
 if __name__ == '__main__':
-    add_parent_manually()
\ No newline at end of file
+    # python admin_tools.py import parents.csv [--dry-run] | migrate | rebuild_summary [YYYY-MM] | check_plans [-v]
+    if len(sys.argv) >= 3 and sys.argv[1] == 'import':
+        import_parents(sys.argv[2], dry_run='--dry-run' in sys.argv)
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'migrate':
+        migrate()
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'rebuild_summary':
+        rebuild_summary(sys.argv[2] if len(sys.argv) >= 3 else None)
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'check_plans':
+        # python admin_tools.py check_plans [-v]
+        sys.exit(1 if check_plans(verbose='-v' in sys.argv) else 0)
+    else:
+        add_parent_manually()
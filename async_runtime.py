@@ -0,0 +1,319 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+
+from sqlalchemy import text
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut, Unauthorized
+
+import config
+from db_session import DATABASE_URL
+from delivery import DeliveryReport, GLOBAL_RATE, PER_CHAT_INTERVAL, PER_CHAT_PRUNE_SIZE
+from metrics import metrics
+from payment_summary import PAYMENT_DELTA_SQL, payment_delta
+from queries import PARENT_CARD_SQL
+
+logger = logging.getLogger(__name__)
+
+# Сколько запросов к Telegram одновременно в полете в асинхронном режиме
+ASYNC_CONCURRENCY = getattr(config, 'ASYNC_CONCURRENCY', 100)
+
+
+def to_async_url(url):
+    """sqlite:///... -> sqlite+aiosqlite:///..., postgresql://... -> postgresql+asyncpg://..."""
+    if url.startswith('sqlite:'):
+        return 'sqlite+aiosqlite:' + url[len('sqlite:'):]
+    if url.startswith('postgresql:') or url.startswith('postgresql+psycopg2:'):
+        return 'postgresql+asyncpg:' + url.split(':', 1)[1]
+    return url
+
+
+class AsyncRuntime:
+    """Цикл asyncio в отдельном потоке, на котором выполняются корутины-обработчики.
+
+    Поток диспетчера только ставит корутину в цикл и сразу освобождается,
+    поэтому число одновременных обработчиков не ограничено пулом потоков.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='async-runtime', daemon=True)
+        self.thread.start()
+
+    def submit(self, coroutine):
+        """Запустить корутину в цикле; возвращает concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine):
+        """Запустить корутину и дождаться результата из обычного потока"""
+        return self.submit(coroutine).result()
+
+    def handler(self, coroutine_function):
+        """Обернуть async-обработчик (update, context) в callback для python-telegram-bot"""
+        async def measured(update, context):
+            # Замеряется сама корутина, а не постановка ее в цикл
+            with metrics.measure_update(coroutine_function.__name__):
+                await coroutine_function(update, context)
+
+        @wraps(coroutine_function)
+        def callback(update, context):
+            future = self.submit(measured(update, context))
+            future.add_done_callback(self._log_exception)
+        callback.instrumented = True
+        return callback
+
+    @staticmethod
+    def _log_exception(future):
+        if not future.cancelled() and future.exception():
+            logger.error(f'Ошибка в асинхронном обработчике: {future.exception()}')
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class AsyncBotAPI:
+    """Минимальный асинхронный клиент Telegram Bot API на httpx.
+
+    Ошибки приводятся к исключениям telegram.error, чтобы логика повторов
+    была той же, что и в синхронной рассылке.
+    """
+
+    def __init__(self, token, timeout=10):
+        try:
+            import httpx
+        except ImportError:
+            raise RuntimeError('Для асинхронного режима установите httpx: pip install httpx')
+        self.base_url = f'https://api.telegram.org/bot{token}'
+        self.timeout = timeout
+        self._httpx = httpx
+        self._client = None
+
+    @property
+    def client(self):
+        # Клиент создается внутри работающего цикла asyncio
+        if self._client is None:
+            self._client = self._httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=self._httpx.Limits(max_connections=ASYNC_CONCURRENCY)
+            )
+        return self._client
+
+    async def _call(self, method, **params):
+        params = {key: value for key, value in params.items() if value is not None}
+        if 'reply_markup' in params:
+            params['reply_markup'] = json.dumps(params['reply_markup'].to_dict())
+        started = time.perf_counter()
+        try:
+            response = await self.client.post(f'{self.base_url}/{method}', data=params)
+        except self._httpx.TimeoutException as e:
+            metrics.observe_api(method, time.perf_counter() - started, failed=True)
+            raise TimedOut() from e
+        except self._httpx.HTTPError as e:
+            metrics.observe_api(method, time.perf_counter() - started, failed=True)
+            raise NetworkError(str(e)) from e
+
+        data = response.json()
+        metrics.observe_api(method, time.perf_counter() - started, failed=not data.get('ok'))
+        if data.get('ok'):
+            return data.get('result')
+        description = data.get('description', 'Unknown error')
+        retry_after = data.get('parameters', {}).get('retry_after')
+        if retry_after:
+            raise RetryAfter(retry_after)
+        if response.status_code in (401, 403):
+            raise Unauthorized(description)
+        if response.status_code == 400:
+            raise BadRequest(description)
+        raise NetworkError(description)
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        return await self._call('sendMessage', chat_id=chat_id, text=text, reply_markup=reply_markup)
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None):
+        return await self._call(
+            'editMessageText', chat_id=chat_id, message_id=message_id, text=text, reply_markup=reply_markup
+        )
+
+    async def answer_callback_query(self, callback_query_id, text=None):
+        return await self._call('answerCallbackQuery', callback_query_id=callback_query_id, text=text)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+
+class AsyncProgressBot:
+    """edit_message_text для DeliveryProgress через AsyncBotAPI: правка ставится
+    в цикл asyncio и не ждет ответа Telegram, поток рассылки не блокируется"""
+
+    def __init__(self, api, runtime):
+        self.api = api
+        self.runtime = runtime
+
+    def edit_message_text(self, text, chat_id, message_id, reply_markup=None):
+        future = self.runtime.submit(self.api.edit_message_text(chat_id, message_id, text, reply_markup))
+        future.add_done_callback(self._log_exception)
+
+    @staticmethod
+    def _log_exception(future):
+        if not future.cancelled() and future.exception():
+            logger.warning(f'Не удалось обновить ход рассылки: {future.exception()}')
+
+
+class AsyncRateLimiter:
+    """То же, что delivery.RateLimiter, но ожидание через asyncio.sleep.
+    Используется только из цикла AsyncRuntime"""
+
+    def __init__(self, global_rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL, capacity=None, tokens=None):
+        self.rate = global_rate
+        self.capacity = capacity or max(1, global_rate)
+        self.tokens = self.capacity if tokens is None else tokens
+        self.updated_at = time.monotonic()
+        self.per_chat_interval = per_chat_interval
+        self.next_allowed = {}
+        self.lock = asyncio.Lock()
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        if len(self.next_allowed) > PER_CHAT_PRUNE_SIZE:
+            self.next_allowed = {key: slot for key, slot in self.next_allowed.items() if slot > now}
+        slot = max(now, self.next_allowed.get(chat_id, now))
+        self.next_allowed[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttled(self, rate):
+        """Этот же лимитер, но не быстрее rate сообщений в секунду"""
+        return AsyncThrottledLimiter(self, rate)
+
+
+class AsyncThrottledLimiter:
+    """Дополнительный лимит одной рассылки поверх общего AsyncRateLimiter"""
+
+    def __init__(self, limiter, rate):
+        self.limiter = limiter
+        self.bucket = AsyncRateLimiter(rate, per_chat_interval=0, capacity=1, tokens=0)
+
+    async def wait(self, chat_id):
+        await self.bucket.wait(None)
+        await self.limiter.wait(chat_id)
+
+
+class AsyncReminderDelivery:
+    """Асинхронная рассылка: не больше concurrency запросов одновременно.
+
+    Результаты передаются в report в пуле потоков цикла: report.on_result
+    записывает их в outbox синхронным драйвером и не должен останавливать
+    цикл, на котором в это же время работают /start и кнопка "Оплатил".
+    """
+
+    def __init__(self, api, concurrency=ASYNC_CONCURRENCY, limiter=None, max_retries=3, backoff=1.0):
+        self.api = api
+        self.concurrency = concurrency
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    async def send_all(self, messages, report=None):
+        report = report or DeliveryReport()
+        limiter = self.limiter or AsyncRateLimiter()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(message):
+            async with semaphore:
+                await self._send_one(message, report, limiter)
+
+        await asyncio.gather(*(send(message) for message in messages))
+        logger.info(f'Рассылка завершена: {report.sent} отправлено, {report.failed} ошибок, {report.retried} повторов')
+        return report
+
+    @staticmethod
+    async def _report(method, *args):
+        await asyncio.get_running_loop().run_in_executor(None, method, *args)
+
+    async def _send_one(self, message, report, limiter):
+        if report.cancelled.is_set():
+            return
+        chat_id = message['chat_id']
+        attempt = 0
+        while True:
+            await limiter.wait(chat_id)
+            if report.cancelled.is_set():
+                return
+            try:
+                await self.api.send_message(chat_id, message['text'], message.get('reply_markup'))
+                await self._report(report.add_sent, message)
+                return
+            except RetryAfter as e:
+                logger.warning(f'Flood limit для {chat_id}, ждем {e.retry_after} сек.')
+                report.add_retry()
+                await asyncio.sleep(e.retry_after)
+            except (BadRequest, Unauthorized) as e:
+                logger.error(f'Ошибка отправки {chat_id}: {e}')
+                await self._report(report.add_failed, message, e)
+                return
+            except (TimedOut, NetworkError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.error(f'Ошибка отправки {chat_id} после {self.max_retries} повторов: {e}')
+                    await self._report(report.add_failed, message, e)
+                    return
+                logger.warning(f'Сетевая ошибка для {chat_id}, повтор {attempt}: {e}')
+                report.add_retry()
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            except Exception as e:
+                logger.error(f'Ошибка отправки {chat_id}: {e}')
+                await self._report(report.add_failed, message, e)
+                return
+
+
+class AsyncPaymentQueries:
+    """Запросы горячего пути (/start, кнопка "Оплатил") через асинхронный драйвер"""
+
+    def __init__(self, url=DATABASE_URL):
+        try:
+            from sqlalchemy.ext.asyncio import create_async_engine
+        except ImportError:
+            raise RuntimeError('Для асинхронного режима установите: pip install "sqlalchemy[asyncio]" aiosqlite')
+        self.engine = create_async_engine(to_async_url(url), pool_size=ASYNC_CONCURRENCY // 4 or 1)
+
+    async def get_parent_cards(self, chat_id):
+        """Асинхронный вариант PaymentQueries.get_parent_cards"""
+        async with self.engine.connect() as conn:
+            result = await conn.execute(text(PARENT_CARD_SQL), {'chat_id': chat_id})
+            return [dict(row._mapping) for row in result]
+
+    async def mark_payment_paid(self, payment_id, chat_id):
+        """Асинхронный вариант PaymentQueries.mark_payment_paid"""
+        async with self.engine.begin() as conn:
+            result = await conn.execute(text('''
+                UPDATE payments
+                SET is_paid = :is_paid, payment_date = :payment_date
+                WHERE id = :payment_id
+                  AND NOT is_paid
+                  AND parent_id IN (SELECT id FROM parents WHERE chat_id = :chat_id)
+            '''), {'is_paid': True, 'payment_date': datetime.now(), 'payment_id': payment_id, 'chat_id': chat_id})
+            if result.rowcount:
+                await conn.execute(text(PAYMENT_DELTA_SQL), payment_delta(payment_id, paid=1))
+                return 'paid'
+            already_paid = (await conn.execute(text('''
+                SELECT 1 FROM payments
+                WHERE id = :payment_id
+                  AND is_paid
+                  AND parent_id IN (SELECT id FROM parents WHERE chat_id = :chat_id)
+            '''), {'payment_id': payment_id, 'chat_id': chat_id})).first()
+            return 'already_paid' if already_paid else 'not_found'
@@ -0,0 +1,398 @@
+"""Нагрузочный стенд для обработчиков PaymentBot без Telegram.
+
+Создает синтетическую базу (школы, классы, родители, платежи за несколько
+лет), вызывает обработчики с поддельными Update/CallbackContext и бота-
+заглушку, которая записывает вызовы API с задержкой и периодически
+отвечает 429. Для каждого сценария печатает время, число запросов к БД
+и вызовов API.
+
+    python bench.py --parents 10000 --months 36 --repeat 3
+    python bench.py --db /tmp/bench.db --save baseline.json
+    python bench.py --db /tmp/bench.db --compare baseline.json --tolerance 0.2
+
+С --compare код выхода 1, если медиана какого-либо сценария выросла больше
+чем на tolerance относительно сохраненной.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import config
+
+BENCH_ADMIN_ID = 1
+FIRST_NAMES = ['Анна', 'Мария', 'Елена', 'Ольга', 'Ирина', 'Наталья', 'Светлана', 'Татьяна', 'Сергей', 'Андрей']
+LAST_NAMES = ['Иванова', 'Петрова', 'Смирнова', 'Кузнецова', 'Попова', 'Соколова', 'Лебедева', 'Козлова']
+CHILD_NAMES = ['Саша', 'Маша', 'Даша', 'Миша', 'Петя', 'Катя', 'Ваня', 'Аня', 'Лиза', 'Дима']
+
+
+class StubBot:
+    """Бот без сети: каждый вызов занимает latency сек., каждый flood_every-й
+    send_message отвечает RetryAfter, как Telegram при превышении лимита"""
+
+    def __init__(self, latency=0.0, flood_every=0, retry_after=0.01):
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+
+    def _call(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            count = self.calls[method]
+        if self.latency:
+            time.sleep(self.latency)
+        return count
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        from telegram.error import RetryAfter
+        count = self._call('sendMessage')
+        if self.flood_every and count % self.flood_every == 0:
+            raise RetryAfter(self.retry_after)
+        return FakeMessage(self, chat_id, text)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        self._call('editMessageText')
+        return True
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self._call('answerCallbackQuery')
+        return True
+
+    def send_document(self, chat_id, document, **kwargs):
+        self._call('sendDocument')
+        if hasattr(document, 'read'):
+            document.read()
+        return FakeMessage(self, chat_id)
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id, text=''):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.message_id = next(bot.message_ids)
+
+    def reply_text(self, text, **kwargs):
+        return self.bot.send_message(chat_id=self.chat_id, text=text, **kwargs)
+
+    def reply_document(self, document, **kwargs):
+        return self.bot.send_document(chat_id=self.chat_id, document=document, **kwargs)
+
+    def edit_text(self, text, **kwargs):
+        return self.bot.edit_message_text(text=text, chat_id=self.chat_id, message_id=self.message_id, **kwargs)
+
+
+class FakeCallbackQuery:
+    def __init__(self, bot, chat_id, data):
+        self.id = str(next(bot.message_ids))
+        self.data = data
+        self.from_user = SimpleNamespace(id=chat_id, first_name='Админ')
+        self.message = FakeMessage(bot, chat_id)
+        self.bot = bot
+
+    def answer(self, text=None, **kwargs):
+        return self.bot.answer_callback_query(self.id, text=text)
+
+    def edit_message_text(self, text, **kwargs):
+        return self.message.edit_text(text, **kwargs)
+
+
+def command(bot, text='', chat_id=BENCH_ADMIN_ID, args=None):
+    """Update и CallbackContext для текстовой команды"""
+    update = SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id),
+        effective_user=SimpleNamespace(id=chat_id, first_name='Админ'),
+        message=FakeMessage(bot, chat_id, text),
+        callback_query=None
+    )
+    return update, fake_context(bot, args)
+
+
+def callback(bot, data, chat_id=BENCH_ADMIN_ID):
+    """Update и CallbackContext для нажатия inline-кнопки"""
+    query = FakeCallbackQuery(bot, chat_id, data)
+    update = SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id),
+        effective_user=query.from_user,
+        message=None,
+        callback_query=query
+    )
+    return update, fake_context(bot)
+
+
+def fake_context(bot, args=None):
+    return SimpleNamespace(bot=bot, args=args or [], user_data={}, chat_data={}, bot_data={},
+                           job_queue=None, dispatcher=None)
+
+
+def configure(db_path):
+    """Настройки стенда; применяются до импорта модулей бота"""
+    config.DATABASE_URL = f'sqlite:///{db_path}'
+    config.BOT_TOKEN = '123456:BENCHMARK'
+    config.ADMIN_IDS = [BENCH_ADMIN_ID]
+    config.ASYNC_MODE = False
+    config.METRICS_PORT = None
+    # Ограничения Telegram заменяет задержка заглушки
+    config.GLOBAL_RATE = 1e9
+    config.PER_CHAT_INTERVAL = 0
+
+
+def generate(engine, workdir, schools, grades, parents, months, paid_ratio, seed):
+    """Заполнить базу синтетическими данными; возвращает число платежей"""
+    from sqlalchemy import text
+    from payment_summary import rebuild_summary
+    from queries import DUE_DAY, add_months
+    from seeding import seed_reference_data
+
+    rng = random.Random(seed)
+    seed_path = os.path.join(workdir, 'bench_schools.json')
+    with open(seed_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'grades': list(range(1, grades + 1)),
+            'schools': [
+                {'id': school_id, 'name': f'Школа №{school_id}', 'monthly_payment': rng.choice((3400, 3600, 3800))}
+                for school_id in range(1, schools + 1)
+            ]
+        }, f, ensure_ascii=False)
+    seed_reference_data(engine, seed_path)
+
+    with engine.connect() as conn:
+        prices = dict(conn.execute(text('SELECT id, monthly_payment FROM grades')).all())
+    grade_ids = list(prices)
+
+    current_month = datetime.now().strftime('%Y-%m')
+    month_list = [add_months(current_month, -offset) for offset in range(months - 1, -1, -1)]
+    payments = 0
+    with engine.begin() as conn:
+        parent_rows = []
+        for parent_id in range(1, parents + 1):
+            parent_rows.append({
+                'id': parent_id,
+                'first_name': rng.choice(FIRST_NAMES),
+                'last_name': rng.choice(LAST_NAMES),
+                'child_name': rng.choice(CHILD_NAMES),
+                'grade_id': rng.choice(grade_ids),
+                'phone_number': f'+7900{parent_id:07d}',
+                'chat_id': 10_000_000 + parent_id if rng.random() < 0.95 else None,
+                'is_active': rng.random() < 0.98,
+            })
+        conn.execute(text('''
+            INSERT INTO parents (id, first_name, last_name, child_name, grade_id, phone_number, chat_id, is_active)
+            VALUES (:id, :first_name, :last_name, :child_name, :grade_id, :phone_number, :chat_id, :is_active)
+        '''), parent_rows)
+
+        batch = []
+        insert_payments = text('''
+            INSERT INTO payments (parent_id, month, amount, due_date, is_paid, payment_date, is_receipt_sent)
+            VALUES (:parent_id, :month, :amount, :due_date, :is_paid, :payment_date, :is_receipt_sent)
+        ''')
+        for parent in parent_rows:
+            for month in month_list:
+                year, month_number = map(int, month.split('-'))
+                due_date = datetime(year, month_number, DUE_DAY)
+                # Прошлые месяцы почти все оплачены, текущий - примерно наполовину
+                is_paid = rng.random() < (paid_ratio if month != current_month else 0.5)
+                batch.append({
+                    'parent_id': parent['id'],
+                    'month': month,
+                    'amount': prices[parent['grade_id']],
+                    'due_date': due_date,
+                    'is_paid': is_paid,
+                    'payment_date': due_date - timedelta(days=rng.randint(0, 9)) if is_paid else None,
+                    'is_receipt_sent': is_paid and rng.random() < 0.7,
+                })
+                if len(batch) == 10_000:
+                    conn.execute(insert_payments, batch)
+                    payments += len(batch)
+                    batch = []
+        if batch:
+            conn.execute(insert_payments, batch)
+            payments += len(batch)
+    with engine.begin() as conn:
+        # Платежи вставлены в обход PaymentQueries, итоги считаются заново
+        rebuild_summary(conn)
+        conn.execute(text('ANALYZE'))
+    return payments
+
+
+def scenarios(payment_bot, stub):
+    """Сценарии (имя, подготовка, вызов); подготовка не входит в замер"""
+    from sqlalchemy import text
+    from payment_summary import rebuild_summary
+
+    engine = payment_bot.queries.engine
+    next_month = payment_bot.next_payment_month()
+    current_month = datetime.now().strftime('%Y-%m')
+
+    def execute(sql, **params):
+        with engine.begin() as conn:
+            conn.execute(text(sql), params)
+
+    def delete_month(month):
+        # Платежи удаляются в обход PaymentQueries, итоги месяца считаются заново
+        with engine.begin() as conn:
+            conn.execute(text('DELETE FROM payments WHERE month = :month'), {'month': month})
+            rebuild_summary(conn, month)
+
+    def next_page(view):
+        _, reply_markup = payment_bot._render_page(view)
+        buttons = reply_markup.inline_keyboard[0] if reply_markup else []
+        return buttons[-1].callback_data if buttons else None
+
+    pages = {view: next_page(view) for view in ('parents', 'paid', 'unpaid')}
+
+    return [
+        ('stats', None, lambda: payment_bot.stats(*command(stub, '/stats'))),
+        ('parents_list', None, lambda: payment_bot.show_parents_list(*command(stub, '/parents'))),
+        ('paid_list', None, lambda: payment_bot.show_paid_list(*command(stub, '/paid_list'))),
+        ('unpaid_list', None, lambda: payment_bot.show_unpaid_list(*command(stub, '/unpaid_list'))),
+    ] + [
+        (f'{view}_page_2', None, lambda data=data: payment_bot.page_handler(*callback(stub, data)))
+        for view, data in pages.items() if data
+    ] + [
+        ('create_payments_preview',
+         lambda: delete_month(next_month),
+         lambda: payment_bot.create_payments(*command(stub, '/create_payments'))),
+        ('create_payments',
+         lambda: delete_month(next_month),
+         lambda: payment_bot.create_payments_confirm(*callback(stub, f'create_payments_{next_month}'))),
+        ('report_csv', None, lambda: payment_bot.financial_report(*command(stub, '/report', args=[current_month]))),
+        ('report_xlsx', None,
+         lambda: payment_bot.financial_report(*command(stub, '/report', args=[current_month, 'xlsx']))),
+        ('force_send_all',
+         lambda: execute('DELETE FROM outbox'),
+         lambda: payment_bot.force_send_all(*command(stub, '/force_all'))),
+        ('send_payment_reminders',
+         lambda: execute('DELETE FROM outbox'),
+         lambda: payment_bot.send_payment_reminders(fake_context(stub))),
+    ]
+
+
+def run_scenarios(payment_bot, stub, repeat, only=None):
+    from metrics import metrics
+
+    results = {}
+    for name, setup, call in scenarios(payment_bot, stub):
+        if only and name not in only:
+            continue
+        timings = []
+        queries = rows = api_calls = 0
+        for _ in range(repeat):
+            if setup:
+                setup()
+            stub.reset()
+            started = time.perf_counter()
+            with metrics.measure_update(f'bench:{name}') as update_stats:
+                call()
+            timings.append(time.perf_counter() - started)
+            queries += update_stats.queries
+            rows += update_stats.rows
+            api_calls += sum(stub.calls.values())
+        results[name] = {
+            'median_ms': statistics.median(timings) * 1000,
+            'min_ms': min(timings) * 1000,
+            'max_ms': max(timings) * 1000,
+            'queries': queries / repeat,
+            'rows': rows / repeat,
+            'api_calls': api_calls / repeat,
+        }
+        report(name, results[name])
+    return results
+
+
+def report(name, result):
+    print(
+        f'{name:24} медиана {result["median_ms"]:9.1f} мс  '
+        f'(мин {result["min_ms"]:9.1f}, макс {result["max_ms"]:9.1f})  '
+        f'БД: {result["queries"]:6.0f} запр. {result["rows"]:8.0f} строк  API: {result["api_calls"]:6.0f}'
+    )
+
+
+def compare(results, baseline_path, tolerance):
+    """Сценарии, медиана которых выросла больше чем на tolerance"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['median_ms']
+        if result['median_ms'] > before * (1 + tolerance):
+            regressions.append(f'{name}: {before:.1f} → {result["median_ms"]:.1f} мс')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Время обработчиков PaymentBot на синтетической базе')
+    parser.add_argument('--db', help='файл базы; если в нем уже есть родители, данные не генерируются')
+    parser.add_argument('--schools', type=int, default=20)
+    parser.add_argument('--grades', type=int, default=11, help='классов в каждой школе')
+    parser.add_argument('--parents', type=int, default=10_000)
+    parser.add_argument('--months', type=int, default=24, help='за сколько месяцев создать платежи')
+    parser.add_argument('--paid-ratio', type=float, default=0.97, help='доля оплаченных платежей прошлых месяцев')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка одного вызова API, сек.')
+    parser.add_argument('--flood-every', type=int, default=0, help='каждый N-й send_message отвечает 429')
+    parser.add_argument('--only', nargs='*', help='запустить только указанные сценарии')
+    parser.add_argument('--save', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', help='сравнить с сохраненными результатами')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    workdir = os.path.dirname(os.path.abspath(args.db)) if args.db else tempfile.mkdtemp(prefix='payment-bench-')
+    db_path = os.path.abspath(args.db) if args.db else os.path.join(workdir, 'payment_bot.db')
+    save_path = os.path.abspath(args.save) if args.save else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+    configure(db_path)
+    # database.Database может открывать базу по относительному пути от текущего каталога
+    os.chdir(workdir)
+
+    from sqlalchemy import text
+    from bot import PaymentBot
+
+    payment_bot = PaymentBot()
+    engine = payment_bot.queries.engine
+    with engine.connect() as conn:
+        existing = conn.execute(text('SELECT COUNT(*) FROM parents')).scalar()
+
+    if existing:
+        print(f'📂 {db_path}: {existing} родителей, генерация пропущена')
+    else:
+        started = time.perf_counter()
+        payments = generate(engine, workdir, args.schools, args.grades, args.parents, args.months,
+                            args.paid_ratio, args.seed)
+        payment_bot.refs.invalidate()
+        print(f'🧪 {db_path}: {args.parents} родителей, {payments} платежей за {time.perf_counter() - started:.1f} сек.')
+
+    stub = StubBot(latency=args.latency, flood_every=args.flood_every)
+    results = run_scenarios(payment_bot, stub, args.repeat, args.only)
+
+    if save_path:
+        with open(save_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if compare_path:
+        regressions = compare(results, compare_path, args.tolerance)
+        if regressions:
+            print('\n❌ Замедление больше допустимого:\n' + '\n'.join(f'• {line}' for line in regressions))
+            sys.exit(1)
+        print('\n✅ Без регрессий относительно ' + args.compare)
+
+
+if __name__ == '__main__':
+    main()
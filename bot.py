@@ -1,13 +1,37 @@
 ﻿import logging
+import os
+import threading
+import tempfile
+import time
+from contextlib import contextmanager
+
+# Отсчет времени запуска для отчета в run(): импорт модулей - его заметная часть
+IMPORT_STARTED = time.perf_counter()
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import (
     Updater, CommandHandler, MessageHandler, 
     CallbackContext, CallbackQueryHandler,
     ConversationHandler, Filters
 )
-from database import Database
+from queries import PaymentQueries, add_months
+from delivery import DeliveryProgress, DeliveryReport, ReminderDelivery, RateLimiter, GLOBAL_RATE
+from reference_cache import ReferenceCache
+from scheduler import PaymentScheduler, today
+from pagination import Paginator, PAGE_SIZE, parse_page_callback
+from outbox import Outbox, OUTBOX_BATCH_SECONDS
+from sharded_delivery import ShardedDelivery, DELIVERY_PROCESSES
+from persistence import create_persistence
+from message_templates import get_templates
+from metrics import metrics, instrument_bot, instrument_db, instrument_dispatcher, start_metrics_server
+from async_runtime import (
+    AsyncRuntime, AsyncBotAPI, AsyncPaymentQueries, AsyncProgressBot, AsyncRateLimiter, AsyncReminderDelivery
+)
+import config
 from config import BOT_TOKEN, ADMIN_IDS
-from datetime import datetime, timedelta
+from datetime import datetime
+
+IMPORT_FINISHED = time.perf_counter()
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -16,40 +40,144 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Сколько обновлений обрабатывается параллельно (пул соединений БД должен быть не меньше)
+DISPATCHER_WORKERS = getattr(config, 'DISPATCHER_WORKERS', 8)
+
+# Асинхронный режим: /start, кнопка "Оплатил" и рассылки выполняются в цикле asyncio
+ASYNC_MODE = getattr(config, 'ASYNC_MODE', False)
+
+# Режим получения обновлений: polling по умолчанию, webhook если задан WEBHOOK_URL
+WEBHOOK_URL = getattr(config, 'WEBHOOK_URL', None)
+WEBHOOK_LISTEN = getattr(config, 'WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8443)
+WEBHOOK_PATH = getattr(config, 'WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = getattr(config, 'WEBHOOK_SECRET', None)
+
+# Бюджет времени запуска, сек.: пока бот стартует, обновления не обрабатываются
+STARTUP_BUDGET = getattr(config, 'STARTUP_BUDGET', 5.0)
+
+# Как часто искать брошенные сообщения outbox и досылать незаконченные рассылки, сек.
+RESUME_INTERVAL = getattr(config, 'OUTBOX_RESUME_INTERVAL', 60)
+
 # Состояния для добавления родителя
 ADD_NAME, ADD_CHILD, ADD_SCHOOL, ADD_GRADE, ADD_PHONE, ADD_CHAT_ID = range(6)
 
 class PaymentBot:
     def __init__(self):
-        self.db = Database()
-        self.updater = Updater(token=BOT_TOKEN, use_context=True)
-        self.setup_handlers()
+        # Этапы запуска и их длительность для отчета в run()
+        self.startup_phases = [('импорт модулей', IMPORT_FINISHED - IMPORT_STARTED)]
+        
+        with self._startup_phase('база данных и схема'):
+            # database.py только создает таблицы при запуске; процессы рассылки (spawn)
+            # заново импортируют bot.py и не должны платить за загрузку ORM
+            from database import Database
+            # До создания engine: запросы и строки считаются с первого соединения
+            instrument_db()
+            Database()
+            self.queries = PaymentQueries()
+            # Вся схема создается здесь один раз, обработчики ее не трогают
+            self.queries.ensure_schema()
+            self.outbox = Outbox(self.queries.engine)
+            self.refs = ReferenceCache(self.queries.engine)
+        
+        with self._startup_phase('шаблоны сообщений'):
+            self.templates = get_templates()
+        # Идущие сейчас рассылки: campaign_id -> DeliveryReport
+        self.active_campaigns = {}
+        self.campaigns_lock = threading.Lock()
+        # Один лимит на процесс для всех рассылок; растянутые рассылки его только понижают
+        self.limiter = RateLimiter()
+        if DELIVERY_PROCESSES > 1:
+            self.sharded_delivery = ShardedDelivery(BOT_TOKEN, processes=DELIVERY_PROCESSES)
+        if ASYNC_MODE:
+            with self._startup_phase('асинхронный режим'):
+                self.runtime = AsyncRuntime()
+                self.async_api = AsyncBotAPI(BOT_TOKEN)
+                self.async_queries = AsyncPaymentQueries()
+                self.async_limiter = AsyncRateLimiter()
+        
+        with self._startup_phase('состояние диалогов и Updater'):
+            # Диалог добавления родителя и user_data переживают перезапуск
+            self.persistence = create_persistence(self.queries.engine)
+            self.updater = Updater(
+                token=BOT_TOKEN,
+                use_context=True,
+                workers=DISPATCHER_WORKERS,
+                persistence=self.persistence
+            )
+            instrument_bot(self.updater.bot)
+            self.setup_handlers()
+        
+        with self._startup_phase('планировщик'):
+            self.scheduler = PaymentScheduler(self, self.queries.engine)
+            self.scheduler.start(self.updater.job_queue)
+    
+    @contextmanager
+    def _startup_phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_phases.append((name, time.perf_counter() - started))
+    
+    def startup_report(self):
+        """Сколько занял каждый этап запуска и укладывается ли он в STARTUP_BUDGET"""
+        total = sum(duration for _, duration in self.startup_phases)
+        text = f'🚀 Бот запущен за {total:.2f} сек.'
+        if total > STARTUP_BUDGET:
+            text += f' ⚠️ больше бюджета {STARTUP_BUDGET:.1f} сек.'
+        for name, duration in self.startup_phases:
+            text += f'\n   • {name}: {duration:.2f} сек.'
+        return text
     
     def setup_handlers(self):
         dp = self.updater.dispatcher
         
         # Основные команды
-        dp.add_handler(CommandHandler("start", self.start))
+        if ASYNC_MODE:
+            # Самые частые обновления от родителей выполняются корутинами
+            dp.add_handler(CommandHandler("start", self.runtime.handler(self.start_async)))
+            dp.add_handler(CallbackQueryHandler(self.runtime.handler(self.payment_button_async), pattern="^payment_"))
+        else:
+            dp.add_handler(CommandHandler("start", self.start))
         dp.add_handler(CommandHandler("help", self.help_command))
         dp.add_handler(CommandHandler("admin", self.admin_panel))
-        dp.add_handler(CommandHandler("send_reminders", self.send_reminders))
-        dp.add_handler(CommandHandler("force_all", self.force_send_all))
+        dp.add_handler(CommandHandler("send_reminders", self.send_reminders, run_async=True))
+        dp.add_handler(CommandHandler("force_all", self.force_send_all, run_async=True))
         dp.add_handler(CommandHandler("create_payments", self.create_payments))
         dp.add_handler(CommandHandler("stats", self.stats))
         dp.add_handler(CommandHandler("paid_list", self.show_paid_list))
         dp.add_handler(CommandHandler("unpaid_list", self.show_unpaid_list))
         dp.add_handler(CommandHandler("init_db", self.init_database))
+        dp.add_handler(CommandHandler("schedule", self.show_schedule))
+        dp.add_handler(CommandHandler("perf", self.show_perf))
+        dp.add_handler(CommandHandler("report", self.financial_report, run_async=True))
         
         # Обработчики inline кнопок
-        dp.add_handler(CallbackQueryHandler(self.button_handler, pattern="^payment_"))
+        if not ASYNC_MODE:
+            dp.add_handler(CallbackQueryHandler(self.button_handler, pattern="^payment_"))
         dp.add_handler(CallbackQueryHandler(self.button_handler, pattern="^receipt_"))
+        dp.add_handler(CallbackQueryHandler(self.page_handler, pattern="^page_"))
+        dp.add_handler(CallbackQueryHandler(self.cancel_campaign, pattern="^cancel_campaign_"))
+        dp.add_handler(CallbackQueryHandler(self.create_payments_confirm, pattern="^create_payments_", run_async=True))
+        
+        # Загрузка списка родителей файлом; файлы остальных пользователей идут в receive_receipt
+        dp.add_handler(MessageHandler(
+            (Filters.document.file_extension("csv") | Filters.document.file_extension("xlsx"))
+            & Filters.chat(chat_id=ADMIN_IDS),
+            self.import_parents_document,
+            run_async=True
+        ))
+        
+        # Чеки об оплате от родителей
+        dp.add_handler(MessageHandler(Filters.photo | Filters.document, self.receive_receipt))
         
         # Обработчики текстовых сообщений для кнопок
         dp.add_handler(MessageHandler(Filters.text("👥 Добавить родителя"), self.add_parent_start))
         dp.add_handler(MessageHandler(Filters.text("📊 Статистика"), self.show_stats))
         dp.add_handler(MessageHandler(Filters.text("💳 Создать платежи"), self.create_payments_button))
-        dp.add_handler(MessageHandler(Filters.text("📤 Отправить напоминания"), self.send_reminders_button))
-        dp.add_handler(MessageHandler(Filters.text("🔄 Принудительно всем"), self.force_all_button))
+        dp.add_handler(MessageHandler(Filters.text("📤 Отправить напоминания"), self.send_reminders_button, run_async=True))
+        dp.add_handler(MessageHandler(Filters.text("🔄 Принудительно всем"), self.force_all_button, run_async=True))
         dp.add_handler(MessageHandler(Filters.text("📋 Список родителей"), self.show_parents_list))
         dp.add_handler(MessageHandler(Filters.text("✅ Оплатившие"), self.show_paid_list_button))
         dp.add_handler(MessageHandler(Filters.text("📝 Неоплатившие"), self.show_unpaid_list))
@@ -73,9 +201,14 @@ class PaymentBot:
                 ADD_CHAT_ID: [MessageHandler(Filters.text & ~Filters.command, self.add_parent_chat_id)],
             },
             fallbacks=[CommandHandler('cancel', self.add_parent_cancel)],
+            name='add_parent',
+            persistent=True,
         )
         
         dp.add_handler(add_parent_conv)
+        
+        # Замер времени, запросов к БД и строк для каждого обработчика
+        instrument_dispatcher(dp)
     
     def init_database(self, update: Update, context: CallbackContext):
         """Инициализация базы данных с школами и классами"""
@@ -88,84 +221,20 @@ class PaymentBot:
         update.message.reply_text('🗃️ Инициализирую базу данных...')
         
         try:
-            # Простая инициализация без сложных зависимостей
-            from sqlalchemy import create_engine, Column, Integer, String
-            from sqlalchemy.ext.declarative import declarative_base
-            from sqlalchemy.orm import sessionmaker
-            
-            Base = declarative_base()
-            
-            class TempSchool(Base):
-                __tablename__ = 'schools'
-                id = Column(Integer, primary_key=True)
-                name = Column(String(100), nullable=False)
-            
-            class TempGrade(Base):
-                __tablename__ = 'grades'
-                id = Column(Integer, primary_key=True)
-                school_id = Column(Integer, nullable=False)
-                grade_name = Column(String(50), nullable=False)
-                monthly_payment = Column(Integer, nullable=False)
-            
-            # Подключаемся к базе данных
-            engine = create_engine('sqlite:///payment_bot.db')
-            Base.metadata.create_all(engine)
-            Session = sessionmaker(bind=engine)
-            session = Session()
-            
-            # Данные о школах и оплате
-            schools_data = [
-                {"id": 1, "name": "Школа №5", "payment": 3400},
-                {"id": 2, "name": "Школа №26", "payment": 3800},
-                {"id": 3, "name": "Школа №78", "payment": 3400},
-                {"id": 4, "name": "Школа №100", "payment": 3600}
-            ]
-            
-            added_schools = 0
-            added_grades = 0
-            
-            # Добавляем школы
-            for school_info in schools_data:
-                existing_school = session.query(TempSchool).filter_by(id=school_info["id"]).first()
-                if not existing_school:
-                    school = TempSchool(
-                        id=school_info["id"],
-                        name=school_info["name"]
-                    )
-                    session.add(school)
-                    added_schools += 1
-                    logger.info(f"Добавлена школа: {school_info['name']}")
-            
-            session.commit()
+            from seeding import seed_reference_data
             
-            # Добавляем классы для каждой школы (1-8 классы)
-            for school_info in schools_data:
-                for grade_num in range(1, 9):
-                    grade_name = f"{grade_num} класс"
-                    
-                    existing_grade = session.query(TempGrade).filter_by(
-                        school_id=school_info["id"],
-                        grade_name=grade_name
-                    ).first()
-                    
-                    if not existing_grade:
-                        grade = TempGrade(
-                            school_id=school_info["id"],
-                            grade_name=grade_name,
-                            monthly_payment=school_info["payment"]
-                        )
-                        session.add(grade)
-                        added_grades += 1
-                        logger.info(f"Добавлен класс: {school_info['name']} - {grade_name}")
+            # Школы, классы и цены берутся из schools.json; таблицы созданы при запуске
+            result = seed_reference_data(self.queries.engine, create_schema=False)
             
-            session.commit()
-            session.close()
+            # Справочники изменились - сбрасываем кэш
+            self.refs.invalidate()
             
             update.message.reply_text(
                 f'✅ База данных успешно инициализирована!\n\n'
                 f'📊 Добавлено:\n'
-                f'• 🏫 Школ: {added_schools}\n'
-                f'• 📚 Классов: {added_grades}\n\n'
+                f'• 🏫 Школ: {result["added_schools"]}\n'
+                f'• 📚 Классов: {result["added_grades"]}\n'
+                f'• 💳 Обновлено цен: {result["updated_prices"]}\n\n'
                 f'Теперь вы можете добавлять родителей через меню "👥 Добавить родителя"'
             )
             
@@ -181,52 +250,45 @@ class PaymentBot:
         user = update.effective_user
         chat_id = update.effective_chat.id
         
-        parent = self.db.get_parent_by_chat_id(chat_id)
-        
-        if parent:
-            # Загружаем связанные данные через специальный метод
-            grade_info = self.db.get_grade_with_school_info(parent.grade_id)
-            if grade_info:
-                school_name = grade_info['school_name']
-                grade_name = grade_info['grade_name']
-                monthly_payment = grade_info['monthly_payment']
-            else:
-                school_name = 'не указана'
-                grade_name = 'не указан'
-                monthly_payment = 'не указана'
-                
-            welcome_text = f'''Привет, {parent.first_name}! 👋
-
-Я бот для напоминаний об оплате занятий.
-
-Ваши данные:
-👤 Имя: {parent.first_name}
-👶 Ребенок: {parent.child_name}
-🏫 Школа: {school_name}
-📚 Класс: {grade_name}
-💳 Сумма оплаты: {monthly_payment} руб./мес
-📞 Телефон: {parent.phone_number or 'не указан'}'''
-        else:
-            welcome_text = f'''Привет, {user.first_name}! 👋
-
-Я бот для напоминаний об оплате занятий.
-
-Если вы должны получать уведомления об оплате, но не получаете их, 
-свяжитесь с администратором.'''
+        # Один запрос по индексу ix_parents_chat_id вместе с классом и школой; строк
+        # несколько, если у родителя несколько детей
+        cards = self.queries.get_parent_cards(chat_id)
         
+        update.message.reply_text(
+            self._welcome_text(user.first_name, cards),
+            reply_markup=self._start_reply_markup(chat_id)
+        )
+    
+    async def start_async(self, update: Update, context: CallbackContext):
+        """/start в асинхронном режиме: запрос и ответ не занимают поток диспетчера"""
+        chat_id = update.effective_chat.id
+        cards = await self.async_queries.get_parent_cards(chat_id)
+        await self.async_api.send_message(
+            chat_id,
+            self._welcome_text(update.effective_user.first_name, cards),
+            reply_markup=self._start_reply_markup(chat_id)
+        )
+    
+    def _welcome_text(self, user_first_name, cards):
+        """Приветствие /start: данные родителя и его детей (cards) или общий текст"""
+        if not cards:
+            return self.templates.render('welcome_guest', {'first_name': user_first_name})
+        return self.templates.render('welcome', cards[0]) + ''.join(
+            self.templates.render('welcome_child', card) for card in cards[1:]
+        )
+    
+    def _start_reply_markup(self, chat_id):
         # Для админов показываем кнопки
-        if chat_id in ADMIN_IDS:
-            keyboard = [
-                ['👥 Добавить родителя', '📊 Статистика'],
-                ['💳 Создать платежи', '📤 Отправить напоминания'],
-                ['🔄 Принудительно всем', '📋 Список родителей'],
-                ['✅ Оплатившие', '📝 Неоплатившие'],
-                ['🗃️ Инициализировать БД']
-            ]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            update.message.reply_text(welcome_text, reply_markup=reply_markup)
-        else:
-            update.message.reply_text(welcome_text)
+        if chat_id not in ADMIN_IDS:
+            return None
+        keyboard = [
+            ['👥 Добавить родителя', '📊 Статистика'],
+            ['💳 Создать платежи', '📤 Отправить напоминания'],
+            ['🔄 Принудительно всем', '📋 Список родителей'],
+            ['✅ Оплатившие', '📝 Неоплатившие'],
+            ['🗃️ Инициализировать БД']
+        ]
+        return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
     def admin_panel(self, update: Update, context: CallbackContext):
         """Панель администратора с кнопками"""
@@ -236,9 +298,7 @@ class PaymentBot:
             update.message.reply_text('❌ Нет прав доступа')
             return
         
-        parents = self.db.get_all_active_parents()
-        unpaid_payments = self.db.get_unpaid_payments()
-        schools = self.db.get_schools()
+        stats = self.queries.get_statistics(today().strftime('%Y-%m'))
         
         # Создаем клавиатуру с кнопками
         keyboard = [
@@ -253,9 +313,9 @@ class PaymentBot:
         stats_text = f'''🛠 Панель администратора
 
 📊 Статистика:
-🏫 Школ: {len(schools)}
-👥 Родителей: {len(parents)}
-💰 Неоплаченных платежей: {len(unpaid_payments)}
+🏫 Школ: {stats['schools']}
+👥 Родителей: {stats['parents']}
+💰 Неоплаченных платежей: {stats['unpaid_total']}
 
 Выберите действие:'''
         
@@ -293,54 +353,8 @@ class PaymentBot:
             update.message.reply_text('❌ Нет прав доступа')
             return
         
-        # Получаем все платежи
-        all_payments = self.db.get_unpaid_payments_with_parents()
-        
-        # Фильтруем только неоплаченные
-        unpaid_payments = [p for p in all_payments if not p.is_paid]
-        
-        if not unpaid_payments:
-            update.message.reply_text('🎉 Все родители оплатили! Неоплативших нет.')
-            return
-        
-        current_month = datetime.now().strftime('%Y-%m')
-        unpaid_this_month = [p for p in unpaid_payments if p.month == current_month]
-        
-        if not unpaid_this_month:
-            update.message.reply_text(f'📝 На {current_month} неоплативших нет.')
-            return
-        
-        unpaid_text = f'📝 Неоплатившие за {current_month}:\n\n'
-        
-        for i, payment in enumerate(unpaid_this_month, 1):
-            parent_info = self.db.get_parent_with_grade_info(payment.parent_id)
-            if parent_info:
-                parent_name = parent_info['parent_name']
-                child_name = parent_info['child_name']
-                school_name = parent_info['school_name']
-                grade_name = parent_info['grade_name']
-                phone = parent_info['phone']
-            else:
-                parent_name = payment.parent.first_name
-                child_name = payment.parent.child_name
-                school_name = 'не указана'
-                grade_name = 'не указан'
-                phone = payment.parent.phone_number or 'нет телефона'
-            
-            unpaid_text += f'''{i}. {parent_name}
-   👶 {child_name}
-   🏫 {school_name}, {grade_name}
-   💳 {payment.amount} руб.
-   📞 {phone}
-   
-'''
-        
-        if len(unpaid_text) > 4000:
-            parts = [unpaid_text[i:i+4000] for i in range(0, len(unpaid_text), 4000)]
-            for part in parts:
-                update.message.reply_text(part)
-        else:
-            update.message.reply_text(unpaid_text)
+        text, reply_markup = self._render_page('unpaid')
+        update.message.reply_text(text, reply_markup=reply_markup)
     
     def _show_paid_list(self, update: Update, context: CallbackContext):
         """Внутренняя функция для показа оплативших"""
@@ -350,70 +364,8 @@ class PaymentBot:
             update.message.reply_text('❌ Нет прав доступа')
             return
         
-        # Получаем все платежи с информацией о родителях
-        all_payments = self.db.get_unpaid_payments_with_parents()
-        
-        # Фильтруем оплаченные
-        paid_payments = [p for p in all_payments if p.is_paid]
-        
-        if not paid_payments:
-            update.message.reply_text('💰 Оплативших пока нет.')
-            return
-        
-        # Группируем по месяцам
-        paid_by_month = {}
-        for payment in paid_payments:
-            if payment.month not in paid_by_month:
-                paid_by_month[payment.month] = []
-            paid_by_month[payment.month].append(payment)
-        
-        result_text = '✅ Список оплативших:\n\n'
-        
-        for month in sorted(paid_by_month.keys(), reverse=True):
-            result_text += f'📅 {month}:\n'
-            
-            for i, payment in enumerate(paid_by_month[month], 1):
-                parent_info = self.db.get_parent_with_grade_info(payment.parent_id)
-                if parent_info:
-                    parent_name = parent_info['parent_name']
-                    child_name = parent_info['child_name']
-                    school_name = parent_info['school_name']
-                    grade_name = parent_info['grade_name']
-                else:
-                    parent_name = payment.parent.first_name
-                    child_name = payment.parent.child_name
-                    school_name = 'не указана'
-                    grade_name = 'не указан'
-                
-                payment_date = payment.payment_date.strftime('%d.%m.%Y %H:%M') if payment.payment_date else 'дата не указана'
-                receipt_status = '✅ чек отправлен' if payment.is_receipt_sent else '❌ чек не отправлен'
-                
-                result_text += f'''{i}. {parent_name}
-   👶 {child_name}
-   🏫 {school_name}, {grade_name}
-   💳 {payment.amount} руб.
-   🕒 {payment_date}
-   📄 {receipt_status}
-   
-'''
-            
-            result_text += '\n'
-        
-        # Добавляем статистику
-        total_paid = len(paid_payments)
-        total_with_receipt = len([p for p in paid_payments if p.is_receipt_sent])
-        
-        result_text += f'📊 Итого:\n'
-        result_text += f'• Всего оплат: {total_paid}\n'
-        result_text += f'• С чеками: {total_with_receipt}\n'
-        result_text += f'• Без чеков: {total_paid - total_with_receipt}'
-        
-        if len(result_text) > 4000:
-            parts = [result_text[i:i+4000] for i in range(0, len(result_text), 4000)]
-            for part in parts:
-                update.message.reply_text(part)
-        else:
-            update.message.reply_text(result_text)
+        text, reply_markup = self._render_page('paid')
+        update.message.reply_text(text, reply_markup=reply_markup)
     
     def show_parents_list(self, update: Update, context: CallbackContext):
         """Показать список всех родителей"""
@@ -423,43 +375,105 @@ class PaymentBot:
             update.message.reply_text('❌ Нет прав доступа')
             return
         
-        parents = self.db.get_all_active_parents()
+        text, reply_markup = self._render_page('parents')
+        update.message.reply_text(text, reply_markup=reply_markup)
+    
+    def page_handler(self, update: Update, context: CallbackContext):
+        """Переход по страницам списков кнопками ◀️/▶️"""
+        query = update.callback_query
+        query.answer()
         
-        if not parents:
-            update.message.reply_text('📋 Список родителей пуст')
+        if query.from_user.id not in ADMIN_IDS:
             return
         
-        parents_text = '📋 Список всех родителей:\n\n'
+        view, page, direction, key = parse_page_callback(query.data)
+        text, reply_markup = self._render_page(view, page, direction, key)
+        query.edit_message_text(text, reply_markup=reply_markup)
+    
+    def _paginator(self, view, key=None):
+        """Paginator для списка: родители, оплатившие или неоплатившие за месяц"""
+        if view == 'parents':
+            return Paginator(
+                view,
+                self.queries.get_parents_page,
+                row_key=lambda row: str(row['parent_id']),
+                parse_key=int
+            )
         
-        for i, parent in enumerate(parents, 1):
-            # Получаем информацию о классе и школе для каждого родителя
-            grade_info = self.db.get_grade_with_school_info(parent.grade_id)
-            
-            if grade_info:
-                school_name = grade_info['school_name']
-                grade_name = grade_info['grade_name']
-                monthly_payment = grade_info['monthly_payment']
-            else:
-                school_name = 'не указана'
-                grade_name = 'не указан'
-                monthly_payment = 'не указана'
-            
-            chat_status = '✅' if parent.chat_id else '❌'
-            parents_text += f'''{i}. {parent.first_name}
-   👶 {parent.child_name}
-   🏫 {school_name}, {grade_name}
-   💳 {monthly_payment} руб./мес
-   📞 {parent.phone_number or 'не указан'}
-   🆔 Chat ID: {chat_status} {parent.chat_id or 'не указан'}
-   
-'''
-        
-        if len(parents_text) > 4000:
-            parts = [parents_text[i:i+4000] for i in range(0, len(parents_text), 4000)]
-            for part in parts:
-                update.message.reply_text(part)
+        def parse_payment_key(key):
+            month, payment_id = key.split(':')
+            return month, int(payment_id)
+        
+        if view == 'paid':
+            fetch = lambda **kwargs: self.queries.get_payment_report(is_paid=True, **kwargs)
         else:
-            update.message.reply_text(parents_text)
+            # Месяц неоплативших зафиксирован в ключе, чтобы листание не "перескочило" месяц
+            month = key.split(':')[0] if key else today().strftime('%Y-%m')
+            fetch = lambda **kwargs: self.queries.get_payment_report(is_paid=False, month=month, **kwargs)
+        return Paginator(
+            view,
+            fetch,
+            row_key=lambda row: f"{row['month']}:{row['payment_id']}",
+            parse_key=parse_payment_key
+        )
+    
+    def _render_page(self, view, page=1, direction='n', key=None):
+        """Текст и клавиатура одной страницы списка"""
+        rows, reply_markup = self._paginator(view, key).get_page(page, direction, key)
+        first_number = (page - 1) * PAGE_SIZE + 1
+        
+        if view == 'parents':
+            if not rows:
+                return '📋 Список родителей пуст', None
+            text = f'📋 Список всех родителей (стр. {page}):\n\n'
+            for i, row in enumerate(rows, first_number):
+                chat_status = self.templates.label('chat_linked' if row['chat_id'] else 'chat_missing')
+                text += self.templates.render(
+                    'parent_entry', row,
+                    number=i,
+                    school_grade=self.templates.school_grade(row, 'school_grade_short'),
+                    chat_status=chat_status
+                ) + '\n\n'
+            return text, reply_markup
+        
+        if view == 'unpaid':
+            month = key.split(':')[0] if key else today().strftime('%Y-%m')
+            if not rows:
+                return f'📝 На {month} неоплативших нет.', None
+            text = f'📝 Неоплатившие за {month} (стр. {page}):\n\n'
+            for i, row in enumerate(rows, first_number):
+                text += self.templates.render(
+                    'unpaid_entry', row,
+                    number=i,
+                    school_grade=self.templates.school_grade(row, 'school_grade_short')
+                ) + '\n\n'
+            return text, reply_markup
+        
+        if not rows:
+            return '💰 Оплативших пока нет.', None
+        text = f'✅ Список оплативших (стр. {page}):\n\n'
+        current_month = None
+        for i, row in enumerate(rows, first_number):
+            # Группируем по месяцам внутри страницы
+            if row['month'] != current_month:
+                current_month = row['month']
+                text += f'📅 {current_month}:\n'
+            receipt_status = self.templates.label('receipt_sent' if row['is_receipt_sent'] else 'receipt_missing')
+            text += self.templates.render(
+                'paid_entry', row,
+                number=i,
+                school_grade=self.templates.school_grade(row, 'school_grade_short'),
+                receipt_status=receipt_status
+            ) + '\n\n'
+        
+        if page == 1:
+            # Итоги считаются одним агрегирующим запросом, только на первой странице
+            stats = self.queries.get_statistics(today().strftime('%Y-%m'))
+            text += f'📊 Итого:\n'
+            text += f"• Всего оплат: {stats['paid_total']}\n"
+            text += f"• С чеками: {stats['paid_with_receipt']}\n"
+            text += f"• Без чеков: {stats['paid_total'] - stats['paid_with_receipt']}"
+        return text, reply_markup
     
     # ... остальные методы добавления родителя (add_parent_start, add_parent_name и т.д.) ...
     
@@ -515,7 +529,7 @@ class PaymentBot:
         context.user_data['child_name'] = child_name
         
         # Получаем список школ
-        schools = self.db.get_schools()
+        schools = self.refs.get_schools()
         if not schools:
             update.message.reply_text('❌ В системе нет школ. Сначала инициализируйте базу данных через команду /init_db')
             return ConversationHandler.END
@@ -542,14 +556,8 @@ class PaymentBot:
         if school_name == '❌ Отменить':
             return self.add_parent_cancel(update, context)
         
-        schools = self.db.get_schools()
-        
         # Находим выбранную школу
-        selected_school = None
-        for school in schools:
-            if school.name == school_name:
-                selected_school = school
-                break
+        selected_school = self.refs.get_school_by_name(school_name)
         
         if not selected_school:
             update.message.reply_text('❌ Школа не найдена. Попробуйте еще раз:')
@@ -559,7 +567,7 @@ class PaymentBot:
         context.user_data['school_name'] = selected_school.name
         
         # Получаем классы для выбранной школы
-        grades = self.db.get_grades_by_school(selected_school.id)
+        grades = self.refs.get_grades_by_school(selected_school.id)
         if not grades:
             update.message.reply_text('❌ В этой школе нет классов.')
             return ConversationHandler.END
@@ -591,14 +599,8 @@ class PaymentBot:
         # Извлекаем название класса из текста
         grade_name = grade_text.split(' (')[0]
         
-        grades = self.db.get_grades_by_school(school_id)
-        
         # Находим выбранный класс
-        selected_grade = None
-        for grade in grades:
-            if grade.grade_name == grade_name:
-                selected_grade = grade
-                break
+        selected_grade = self.refs.get_grade_by_name(school_id, grade_name)
         
         if not selected_grade:
             update.message.reply_text('❌ Класс не найден. Попробуйте еще раз:')
@@ -687,7 +689,7 @@ class PaymentBot:
         # Сохраняем родителя в базу
         try:
             logger.info(f"Сохранение родителя в базу: {context.user_data}")
-            parent = self.db.add_parent(
+            self.queries.add_parent(
                 first_name=context.user_data['parent_name'],
                 child_name=context.user_data['child_name'],
                 grade_id=context.user_data['grade_id'],
@@ -697,13 +699,13 @@ class PaymentBot:
             
             success_text = f'''✅ Родитель успешно добавлен!
 
-👤 Родитель: {parent.first_name}
-👶 Ребенок: {parent.child_name}
+👤 Родитель: {context.user_data['parent_name']}
+👶 Ребенок: {context.user_data['child_name']}
 🏫 Школа: {context.user_data['school_name']}
 📚 Класс: {context.user_data['grade_name']}
 💳 Сумма: {context.user_data['monthly_payment']} руб./мес
-📞 Телефон: {parent.phone_number or 'не указан'}
-🆔 Chat ID: {parent.chat_id}
+📞 Телефон: {context.user_data['phone'] or 'не указан'}
+🆔 Chat ID: {chat_id}
 
 Родитель будет получать напоминания об оплате.'''
 
@@ -727,6 +729,32 @@ class PaymentBot:
         context.user_data.clear()
         return ConversationHandler.END
     
+    def import_parents_document(self, update: Update, context: CallbackContext):
+        """Массовый импорт родителей из присланного CSV/XLSX"""
+        chat_id = update.effective_chat.id
+        
+        if chat_id not in ADMIN_IDS:
+            return
+        
+        document = update.message.document
+        update.message.reply_text(f'📥 Импортирую родителей из {document.file_name}...')
+        
+        suffix = os.path.splitext(document.file_name)[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            path = f.name
+        
+        try:
+            from importer import ParentImporter
+            
+            document.get_file().download(custom_path=path)
+            report = ParentImporter(self.queries.engine, self.refs).import_file(path)
+            update.message.reply_text(f'📥 Импорт завершен\n\n{report.summary_text()}')
+        except Exception as e:
+            logger.error(f"Ошибка импорта родителей: {e}")
+            update.message.reply_text(f'❌ Ошибка импорта: {e}')
+        finally:
+            os.remove(path)
+    
     def add_parent_cancel(self, update: Update, context: CallbackContext):
         """Отмена добавления родителя"""
         # Возвращаем основную клавиатуру
@@ -752,9 +780,9 @@ class PaymentBot:
             update.message.reply_text('❌ Нет прав доступа')
             return
         
-        update.message.reply_text('📤 Отправляю напоминания...')
-        sent_count = self.send_payment_reminders(context)
-        update.message.reply_text(f'✅ Напоминания отправлены! Получили: {sent_count} человек')
+        progress_message = update.message.reply_text('📤 Отправляю напоминания...')
+        report = self.send_payment_reminders(context, progress_message=progress_message)
+        progress_message.edit_text(f'✅ Рассылка напоминаний завершена\n\n{report.summary_text()}')
     
     def force_send_all(self, update: Update, context: CallbackContext):
         """ПРИНУДИТЕЛЬНАЯ рассылка ВСЕМ родителям"""
@@ -764,101 +792,164 @@ class PaymentBot:
             update.message.reply_text('❌ Нет прав доступа')
             return
         
-        update.message.reply_text('🔄 Принудительно отправляю напоминания ВСЕМ родителям...')
+        progress_message = update.message.reply_text('🔄 Принудительно отправляю напоминания ВСЕМ родителям...')
         
-        parents = self.db.get_parents_with_chat_id()
-        sent_count = 0
+        # Один запрос: по каждому родителю самый старый неоплаченный платеж
+        reminders = self.queries.get_reminder_batch()
+        messages = []
         
-        for parent in parents:
-            try:
-                # Находим неоплаченный платеж для этого родителя
-                unpaid_payments = self.db.get_unpaid_payments_with_parents()
-                current_payment = None
-                
-                for payment in unpaid_payments:
-                    if payment.parent_id == parent.id and not payment.is_paid:
-                        current_payment = payment
-                        break
-                
-                if current_payment:
-                    # Получаем данные о классе и школе
-                    grade_info = self.db.get_grade_with_school_info(parent.grade_id)
-                    if grade_info:
-                        school_name = grade_info['school_name']
-                        grade_name = grade_info['grade_name']
-                    else:
-                        school_name = 'не указана'
-                        grade_name = 'не указан'
-                    
-                    message_text = f'''💳 Напоминание об оплате
-
-Уважаемый(ая) {parent.first_name}!
-
-Напоминаем об оплате занятий за {current_payment.month}:
-🏫 {school_name}
-📚 {grade_name} класс
-👶 {parent.child_name}
-💳 Сумма: {current_payment.amount} руб.
-📅 Срок оплаты: {current_payment.due_date.strftime('%d.%m.%Y')}
-
-После оплаты нажмите кнопку "✅ Оплатил".'''
-                    
-                    keyboard = [[InlineKeyboardButton('✅ Оплатил', callback_data=f'payment_{current_payment.id}')]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    context.bot.send_message(
-                        chat_id=parent.chat_id,
-                        text=message_text,
-                        reply_markup=reply_markup
-                    )
-                    sent_count += 1
-                    print(f'✅ Отправлено {parent.first_name} (chat_id: {parent.chat_id})')
-                    
-            except Exception as e:
-                print(f'❌ Ошибка отправки {parent.chat_id}: {e}')
-        
-        update.message.reply_text(f'✅ Принудительно отправлено: {sent_count} человек')
-    
-    def send_payment_reminders(self, context: CallbackContext):
-        """Автоматическая отправка напоминаний по условиям"""
-        payments_to_reminder = self.db.get_payments_for_reminder()
-        sent_count = 0
-        
-        for payment in payments_to_reminder:
-            if payment.parent.chat_id:
-                try:
-                    # Получаем данные о классе и школе
-                    grade_info = self.db.get_grade_with_school_info(payment.parent.grade_id)
-                    if grade_info:
-                        school_name = grade_info['school_name']
-                        grade_name = grade_info['grade_name']
-                    else:
-                        school_name = 'не указана'
-                        grade_name = 'не указан'
-                    
-                    message_text = f'''💳 Напоминание об оплате
-
-Уважаемый(ая) {payment.parent.first_name}!
-
-Напоминаем об оплате занятий за {payment.month}:
-🏫 {school_name}
-📚 {grade_name} класс
-👶 {payment.parent.child_name}
-💳 Сумма: {payment.amount} руб.'''
-                    
-                    keyboard = [[InlineKeyboardButton('✅ Оплатил', callback_data=f'payment_{payment.id}')]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    context.bot.send_message(
-                        chat_id=payment.parent.chat_id,
-                        text=message_text,
-                        reply_markup=reply_markup
-                    )
-                    sent_count += 1
-                except Exception as e:
-                    logger.error(f'Ошибка отправки: {e}')
-        
-        return sent_count
+        for reminder in reminders:
+            messages.append({
+                'payment_id': reminder['payment_id'],
+                'chat_id': reminder['chat_id'],
+                'text': self.templates.reminder(reminder),
+                'reply_markup': self.templates.paid_keyboard(reminder['payment_id'])
+            })
+        
+        campaign_id = f"force-{today().strftime('%Y-%m-%d')}"
+        report = self._deliver(context, campaign_id, messages, progress_message=progress_message)
+        progress_message.edit_text(f'🔄 Принудительная рассылка завершена\n\n{report.summary_text()}')
+    
+    def send_payment_reminders(self, context: CallbackContext, spread_over=None, progress_message=None,
+                               due_dates=None):
+        """Автоматическая отправка напоминаний по условиям.
+        
+        spread_over - за сколько секунд растянуть рассылку (для плановых запусков),
+        progress_message - сообщение админу, в котором показывается ход рассылки,
+        due_dates - напомнить только о платежах с этими сроками оплаты (планировщик).
+        Все запуски за день - одна кампания: повторный запуск дошлет только тем,
+        кому сообщение еще не ушло.
+        """
+        if due_dates:
+            # Один запрос: только платежи, срок оплаты которых попадает в due_dates
+            reminders = self.queries.get_reminders_due_on(due_dates)
+        else:
+            # Один запрос: все неоплаченные платежи родителей с chat_id
+            reminders = self.queries.get_unpaid_reminders()
+        messages = [{
+            'payment_id': reminder['payment_id'],
+            'chat_id': reminder['chat_id'],
+            'text': self.templates.reminder(reminder),
+            'reply_markup': self.templates.paid_keyboard(reminder['payment_id'])
+        } for reminder in reminders]
+        
+        global_rate = None
+        if spread_over and messages:
+            global_rate = min(GLOBAL_RATE, len(messages) / spread_over)
+        
+        campaign_id = f"reminders-{today().strftime('%Y-%m-%d')}"
+        return self._deliver(context, campaign_id, messages, global_rate, progress_message)
+    
+    def _deliver(self, context: CallbackContext, campaign_id, messages, global_rate=None, progress_message=None):
+        """Поставить сообщения кампании в outbox и отправить все неотправленные.
+        
+        Если передан progress_message, в нем по ходу рассылки обновляется прогресс
+        с кнопкой остановки.
+        """
+        report = DeliveryReport()
+        self.reclaim_abandoned()
+        with self.campaigns_lock:
+            if campaign_id in self.active_campaigns:
+                # Вторая такая же рассылка отправила бы те же pending-сообщения повторно
+                logger.warning(f"Рассылка {campaign_id} уже идет, повторный запуск пропущен")
+                report.already_running = True
+                return report
+            self.active_campaigns[campaign_id] = report
+        
+        try:
+            self.outbox.enqueue(campaign_id, messages)
+            self.outbox.skip_paid(campaign_id)
+            
+            progress = None
+            if progress_message:
+                total = self.outbox.counts(campaign_id).get('pending', 0)
+                # В асинхронном режиме tick вызывается из рассылки в цикле asyncio:
+                # правки уходят через AsyncBotAPI, без блокирующего HTTP-запроса
+                progress_bot = AsyncProgressBot(self.async_api, self.runtime) if ASYNC_MODE else context.bot
+                progress = DeliveryProgress(
+                    progress_bot, progress_message.chat_id, progress_message.message_id, campaign_id, total
+                )
+                progress.start(report)
+            
+            def on_result(message, error):
+                self.outbox.record_result(message, error)
+                if progress:
+                    progress.tick(report)
+            report.on_result = on_result
+            
+            # Короткие пачки: взятые, но не отправленные строки уходят за несколько секунд
+            # и не успевают устареть, а после падения в sending остается немного
+            batch_size = max(1, int((global_rate or GLOBAL_RATE) * OUTBOX_BATCH_SECONDS))
+            if ASYNC_MODE:
+                limiter = self.async_limiter.throttled(global_rate) if global_rate else self.async_limiter
+                delivery = AsyncReminderDelivery(self.async_api, limiter=limiter)
+            elif DELIVERY_PROCESSES <= 1:
+                limiter = self.limiter.throttled(global_rate) if global_rate else self.limiter
+                delivery = ReminderDelivery(context.bot, limiter=limiter)
+            while not report.cancelled.is_set():
+                batch = self.outbox.claim(campaign_id, batch_size)
+                if not batch:
+                    break
+                if ASYNC_MODE:
+                    self.runtime.run(delivery.send_all(batch, report))
+                elif DELIVERY_PROCESSES > 1:
+                    # Доли лимита по процессам; per-chat интервал соблюдается, т.к. чат всегда в одном процессе
+                    self.sharded_delivery.send_all(batch, report, global_rate=global_rate)
+                else:
+                    delivery.send_all(batch, report)
+            
+            if report.cancelled.is_set():
+                self.outbox.cancel(campaign_id)
+            report.campaign_counts = self.outbox.counts(campaign_id)
+            return report
+        finally:
+            with self.campaigns_lock:
+                self.active_campaigns.pop(campaign_id, None)
+    
+    def cancel_campaign(self, update: Update, context: CallbackContext):
+        """Кнопка ⛔ Остановить под ходом рассылки"""
+        query = update.callback_query
+        if update.effective_chat.id not in ADMIN_IDS:
+            query.answer('❌ Нет прав доступа')
+            return
+        
+        campaign_id = query.data[len('cancel_campaign_'):]
+        report = self.active_campaigns.get(campaign_id)
+        if report is None:
+            query.answer('Рассылка уже завершена')
+            return
+        report.cancel()
+        query.answer('⛔ Останавливаю рассылку...')
+        logger.info(f"Рассылка {campaign_id} остановлена администратором {update.effective_chat.id}")
+    
+    def reclaim_abandoned(self):
+        """Вернуть в очередь брошенные сообщения outbox, кроме взятых идущими здесь рассылками"""
+        # Под блокировкой: рассылка, начатая после снимка active_campaigns, не потеряет свои строки
+        with self.campaigns_lock:
+            return self.outbox.reclaim_stale(active_campaigns=list(self.active_campaigns))
+    
+    def resume_campaigns(self, context: CallbackContext):
+        """Периодическая задача: дослать кампании, прерванные падением или перезапуском бота.
+        
+        Сообщения, взятые в отправку упавшим процессом, возвращаются в очередь;
+        взятые другим живым экземпляром моложе OUTBOX_CLAIM_TIMEOUT и остаются за ним.
+        Каждая кампания досылается в отдельном потоке, задача не ждет ее окончания.
+        """
+        self.reclaim_abandoned()
+        for campaign_id in self.outbox.unfinished_campaigns():
+            if campaign_id not in self.active_campaigns:
+                context.dispatcher.run_async(self._resume_campaign, context, campaign_id)
+    
+    def _resume_campaign(self, context: CallbackContext, campaign_id):
+        logger.info(f"Продолжаю рассылку {campaign_id}")
+        report = self._deliver(context, campaign_id, [])
+        if report.already_running or not (report.sent or report.failed):
+            return
+        for admin_id in ADMIN_IDS:
+            context.bot.send_message(
+                chat_id=admin_id,
+                text=f'🔁 Рассылка {campaign_id} продолжена после сбоя или перезапуска\n\n{report.summary_text()}'
+            )
     
     def help_command(self, update: Update, context: CallbackContext):
         help_text = '''📋 Команды бота:
@@ -875,7 +966,13 @@ class PaymentBot:
 /stats - статистика
 /paid_list - список оплативших
 /unpaid_list - список неоплативших
-/init_db - инициализировать базу данных'''
+/init_db - инициализировать базу данных
+/schedule - плановые задачи
+/perf - производительность обработчиков
+/report [ГГГГ-ММ] [xlsx] - отчет по школам и классам с выгрузкой
+
+Чтобы добавить много родителей сразу, пришлите CSV или XLSX
+с колонками: Имя, Фамилия, Ребенок, Школа, Класс, Телефон, Chat ID'''
         update.message.reply_text(help_text)
     
     def create_payments(self, update: Update, context: CallbackContext):
@@ -885,10 +982,125 @@ class PaymentBot:
             update.message.reply_text('❌ Нет прав доступа')
             return
         
-        next_month = (datetime.now() + timedelta(days=32)).strftime('%Y-%m')
-        update.message.reply_text(f'📅 Создаю платежи на {next_month}...')
-        created_count = self.db.create_monthly_payments(next_month)
-        update.message.reply_text(f'✅ Создано {created_count} платежей на {next_month}')
+        next_month = self.next_payment_month()
+        
+        # Сначала показываем, что будет создано, и ждем подтверждения
+        count, total = self.queries.create_monthly_payments(next_month, dry_run=True)
+        if not count:
+            update.message.reply_text(f'✅ Все платежи на {next_month} уже созданы')
+            return
+        
+        keyboard = [[
+            InlineKeyboardButton('✅ Создать', callback_data=f'create_payments_{next_month}'),
+            InlineKeyboardButton('❌ Отмена', callback_data='create_payments_cancel')
+        ]]
+        update.message.reply_text(
+            f'📅 Платежи на {next_month}\n\n'
+            f'Будет создано: {count}\n'
+            f'На сумму: {total} руб.',
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    
+    def create_payments_confirm(self, update: Update, context: CallbackContext):
+        """Подтверждение создания платежей из предпросмотра"""
+        query = update.callback_query
+        query.answer()
+        
+        if query.from_user.id not in ADMIN_IDS:
+            return
+        
+        month = query.data[len('create_payments_'):]
+        if month == 'cancel':
+            query.edit_message_text('❌ Создание платежей отменено')
+            return
+        
+        query.edit_message_text(f'📅 Создаю платежи на {month}...')
+        # Повторное нажатие или второй админ ничего не создадут: (parent_id, month) уникальны
+        count, total = self.queries.create_monthly_payments(month)
+        query.edit_message_text(f'✅ Создано {count} платежей на {month} на сумму {total} руб.')
+    
+    def next_payment_month(self):
+        """Месяц, на который создаются следующие платежи; "сейчас" - в часовом поясе TIMEZONE,
+        как у планировщика и ключей рассылок"""
+        return add_months(today().strftime('%Y-%m'))
+    
+    def show_schedule(self, update: Update, context: CallbackContext):
+        """Последние запуски плановых задач"""
+        chat_id = update.effective_chat.id
+        
+        if chat_id not in ADMIN_IDS:
+            update.message.reply_text('❌ Нет прав доступа')
+            return
+        
+        runs = self.scheduler.last_runs()
+        if not runs:
+            update.message.reply_text('⏰ Плановые задачи еще не запускались')
+            return
+        
+        schedule_text = '⏰ Последние плановые запуски:\n\n'
+        for run in runs:
+            duration = f"{run['duration']:.1f} сек." if run['duration'] is not None else 'выполняется'
+            if run['failed']:
+                duration = f"ошибка, попыток: {run['attempts']}"
+            schedule_text += f"• {run['job_name']} ({run['run_key']}): {duration}\n"
+        
+        update.message.reply_text(schedule_text)
+    
+    def show_perf(self, update: Update, context: CallbackContext):
+        """Время обработчиков, запросы к БД и задержки Telegram API с момента запуска"""
+        chat_id = update.effective_chat.id
+        
+        if chat_id not in ADMIN_IDS:
+            update.message.reply_text('❌ Нет прав доступа')
+            return
+        
+        update.message.reply_text(metrics.perf_text())
+    
+    def financial_report(self, update: Update, context: CallbackContext):
+        """/report [ГГГГ-ММ] [xlsx]: собираемость и долг по школам и классам за месяц
+        и выгрузка всех платежей месяца файлом"""
+        chat_id = update.effective_chat.id
+        
+        if chat_id not in ADMIN_IDS:
+            update.message.reply_text('❌ Нет прав доступа')
+            return
+        
+        args = [arg.lower() for arg in context.args or []]
+        file_format = 'xlsx' if 'xlsx' in args else 'csv'
+        months = [arg for arg in args if arg not in ('csv', 'xlsx')]
+        month = months[0] if months else today().strftime('%Y-%m')
+        try:
+            # "2025-9" -> "2025-09": ключ месяца в payments и payment_summary
+            month = datetime.strptime(month, '%Y-%m').strftime('%Y-%m')
+        except ValueError:
+            update.message.reply_text('❌ Укажите месяц в виде ГГГГ-ММ, например: /report 2025-09 xlsx')
+            return
+        
+        from reports import export_report, summary_text
+        
+        # Итоги по классам - из payment_summary, без обхода платежей
+        grades = self.queries.get_grade_report(month)
+        if not grades:
+            update.message.reply_text(f'📊 Платежей за {month} нет')
+            return
+        update.message.reply_text(summary_text(month, grades))
+        
+        # Файл пишется построчно по мере чтения платежей из БД
+        with tempfile.NamedTemporaryFile(suffix=f'.{file_format}', delete=False) as f:
+            path = f.name
+        try:
+            count = export_report(path, file_format, grades, self.queries.iter_month_payments(month))
+            with open(path, 'rb') as document:
+                update.message.reply_document(
+                    document,
+                    filename=f'payments-{month}.{file_format}',
+                    caption=f'📎 Платежи за {month}: {count}'
+                )
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки отчета за {month}: {e}")
+            update.message.reply_text(f'❌ Ошибка выгрузки: {e}')
+        finally:
+            os.remove(path)
     
     def stats(self, update: Update, context: CallbackContext):
         chat_id = update.effective_chat.id
@@ -897,28 +1109,34 @@ class PaymentBot:
             update.message.reply_text('❌ Нет прав доступа')
             return
         
-        parents = self.db.get_all_active_parents()
-        unpaid_payments = self.db.get_unpaid_payments()
-        schools = self.db.get_schools()
+        current_month = today().strftime('%Y-%m')
         
-        # Считаем оплативших
-        all_payments = self.db.get_unpaid_payments_with_parents()
-        paid_payments = [p for p in all_payments if p.is_paid]
-        current_month = datetime.now().strftime('%Y-%m')
-        paid_this_month = [p for p in paid_payments if p.month == current_month]
+        # Счетчики и суммы читаются из итогов payment_summary, а не из всех платежей
+        stats = self.queries.get_statistics(current_month)
+        revenue = self.queries.get_school_revenue(current_month)
+        revenue_text = ''.join(
+            f"• {row['school_name']}: {row['paid_sum']} из {row['expected_amount']} руб. "
+            f"({row['paid_count']}/{row['payments_count']})\n"
+            for row in revenue
+        ) or 'Платежей за месяц нет\n'
         
         stats_text = f'''📊 Подробная статистика
 
-🏫 Школ: {len(schools)}
-👥 Родителей: {len(parents)}
-💰 Неоплаченных платежей: {len(unpaid_payments)}
+🏫 Школ: {stats['schools']}
+👥 Родителей: {stats['parents']}
+💰 Неоплаченных платежей: {stats['unpaid_total']}
 
 📅 За {current_month}:
-✅ Оплатили: {len(paid_this_month)}
-❌ Не оплатили: {len([p for p in unpaid_payments if p.month == current_month])}
+✅ Оплатили: {stats['paid_month']}
+❌ Не оплатили: {stats['unpaid_month']}
+
+Всего оплат: {stats['paid_total']}
+С чеками: {stats['paid_with_receipt']}
+Без чеков: {stats['paid_total'] - stats['paid_with_receipt']}
 
-Всего оплат: {len(paid_payments)}
-С чеками: {len([p for p in paid_payments if p.is_receipt_sent])}'''
+💵 Оплаты по школам за {current_month}:
+{revenue_text}
+{self.refs.stats_text()}'''
         
         update.message.reply_text(stats_text)
     
@@ -926,27 +1144,102 @@ class PaymentBot:
         update.message.reply_text('💳 Ваши платежи будут здесь')
     
     def button_handler(self, update: Update, context: CallbackContext):
+        """Кнопки под напоминанием: ✅ Оплатил и 📄 Отправить чек"""
         query = update.callback_query
-        query.answer()
-        query.edit_message_text('✅ Обработано!')
+        chat_id = update.effective_chat.id
+        action, payment_id = query.data.split('_', 1)
+        payment_id = int(payment_id)
+        
+        if action == 'payment':
+            status = self.queries.mark_payment_paid(payment_id, chat_id)
+            if status == 'not_found':
+                query.answer('❌ Платеж не найден')
+                return
+            query.answer()
+            
+            keyboard = [[InlineKeyboardButton('📄 Отправить чек', callback_data=f'receipt_{payment_id}')]]
+            status_text = '✅ Спасибо! Оплата отмечена.' if status == 'paid' else '✅ Оплата уже отмечена.'
+            query.edit_message_text(
+                f'{status_text}\n\nЕсли есть чек, нажмите кнопку ниже и пришлите его фото или файл.',
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            logger.info(f"Платеж {payment_id} отмечен оплаченным (chat_id: {chat_id}, {status})")
+        else:
+            query.answer()
+            context.user_data['receipt_payment_id'] = payment_id
+            query.edit_message_text('📄 Пришлите фото или файл чека следующим сообщением.')
+    
+    async def payment_button_async(self, update: Update, context: CallbackContext):
+        """Кнопка ✅ Оплатил в асинхронном режиме"""
+        query = update.callback_query
+        chat_id = update.effective_chat.id
+        payment_id = int(query.data.split('_', 1)[1])
+        
+        status = await self.async_queries.mark_payment_paid(payment_id, chat_id)
+        if status == 'not_found':
+            await self.async_api.answer_callback_query(query.id, '❌ Платеж не найден')
+            return
+        await self.async_api.answer_callback_query(query.id)
+        
+        keyboard = [[InlineKeyboardButton('📄 Отправить чек', callback_data=f'receipt_{payment_id}')]]
+        status_text = '✅ Спасибо! Оплата отмечена.' if status == 'paid' else '✅ Оплата уже отмечена.'
+        await self.async_api.edit_message_text(
+            chat_id,
+            query.message.message_id,
+            f'{status_text}\n\nЕсли есть чек, нажмите кнопку ниже и пришлите его фото или файл.',
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    
+    def receive_receipt(self, update: Update, context: CallbackContext):
+        """Фото или документ с чеком после кнопки 📄 Отправить чек"""
+        payment_id = context.user_data.pop('receipt_payment_id', None)
+        if payment_id is None:
+            return
+        
+        chat_id = update.effective_chat.id
+        if not self.queries.mark_receipt_sent(payment_id, chat_id):
+            update.message.reply_text('❌ Платеж не найден или еще не отмечен оплаченным.')
+            return
+        
+        update.message.reply_text('✅ Чек получен, спасибо!')
+        logger.info(f"Получен чек по платежу {payment_id} (chat_id: {chat_id})")
+        
+        # Пересылаем чек администраторам для сверки
+        for admin_id in ADMIN_IDS:
+            try:
+                context.bot.send_message(chat_id=admin_id, text=f'📄 Чек по платежу #{payment_id}')
+                update.message.forward(admin_id)
+            except Exception as e:
+                logger.error(f"Не удалось переслать чек админу {admin_id}: {e}")
     
     def run(self):
-        print('🚀 Бот запущен!')
+        with self._startup_phase('запуск получения обновлений'):
+            # Незаконченные рассылки продолжаются сразу после старта и затем каждые RESUME_INTERVAL
+            self.updater.job_queue.run_repeating(self.resume_campaigns, RESUME_INTERVAL, first=0)
+            start_metrics_server()
+            if WEBHOOK_URL:
+                self.start_webhook()
+            else:
+                self.updater.start_polling()
+        
+        print(self.startup_report())
         print(f'🤖 Токен: {BOT_TOKEN[:10]}...')
-        print('✨ Возможности:')
-        print('   • ✅ Список оплативших родителей')
-        print('   • 📝 Список неоплативших')
-        print('   • 👥 Добавление родителей через бота')
-        print('   • 📤 Принудительная рассылка всем')
-        print('   • 📋 Просмотр списка родителей')
-        print('   • 📊 Подробная статистика')
-        print('   • 💳 Создание платежей')
-        print('   • 🗃️ Инициализация базы данных')
-        print('\n📝 Используйте /admin для доступа к панели управления')
-        print('📝 Используйте /init_db для инициализации базы данных')
-        self.updater.start_polling()
+        print('📝 Используйте /admin для доступа к панели управления')
         self.updater.idle()
+    
+    def start_webhook(self):
+        """Получение обновлений через webhook на локальном HTTP-сервере"""
+        # python-telegram-bot 13 не проверяет заголовок secret_token,
+        # поэтому секрет включается в путь: чужие запросы получают 404
+        url_path = f'{WEBHOOK_PATH}/{WEBHOOK_SECRET}' if WEBHOOK_SECRET else WEBHOOK_PATH
+        self.updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=url_path,
+            webhook_url=f'{WEBHOOK_URL.rstrip("/")}/{url_path}'
+        )
+        print(f'🌐 Webhook: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}')
 
 if __name__ == '__main__':
     bot = PaymentBot()
-    bot.run()
+    bot.run()
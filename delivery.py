@@ -0,0 +1,302 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut, Unauthorized
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений в секунду всего и 1 в секунду в один чат
+GLOBAL_RATE = getattr(config, 'GLOBAL_RATE', 30)
+PER_CHAT_INTERVAL = getattr(config, 'PER_CHAT_INTERVAL', 1.0)
+# Не чаще одного редактирования сообщения о ходе рассылки за столько секунд
+PROGRESS_INTERVAL = 3.0
+# Сколько чатов помнит RateLimiter, прежде чем забыть те, в которые уже можно писать
+PER_CHAT_PRUNE_SIZE = 10000
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate, capacity=None, tokens=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity if tokens is None else tokens
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Забрать один токен, при необходимости подождав"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """Общий лимит на бота и отдельный интервал для каждого чата.
+
+    Один экземпляр на процесс (PaymentBot.limiter) делят все рассылки:
+    плановая, /send_reminders, /force_all и продолжение после рестарта
+    вместе не превышают global_rate.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL, tokens=None):
+        self.bucket = TokenBucket(global_rate, tokens=tokens)
+        self.per_chat_interval = per_chat_interval
+        self.next_allowed = {}
+        self.lock = threading.Lock()
+
+    def wait(self, chat_id):
+        """Дождаться, пока можно отправить сообщение в chat_id"""
+        with self.lock:
+            now = time.monotonic()
+            if len(self.next_allowed) > PER_CHAT_PRUNE_SIZE:
+                self.next_allowed = {key: slot for key, slot in self.next_allowed.items() if slot > now}
+            slot = max(now, self.next_allowed.get(chat_id, now))
+            self.next_allowed[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            time.sleep(slot - now)
+        self.bucket.acquire()
+
+    def throttled(self, rate):
+        """Этот же лимитер, но не быстрее rate сообщений в секунду - для растянутых рассылок"""
+        return ThrottledLimiter(self, rate)
+
+
+class ThrottledLimiter:
+    """Дополнительный лимит одной рассылки поверх общего RateLimiter"""
+
+    def __init__(self, limiter, rate):
+        self.limiter = limiter
+        # Без запаса токенов: растянутая рассылка не начинается с пачки сообщений
+        self.bucket = TokenBucket(rate, capacity=1, tokens=0)
+
+    def wait(self, chat_id):
+        self.bucket.acquire()
+        self.limiter.wait(chat_id)
+
+
+# Статусы outbox в итоге рассылки
+CAMPAIGN_STATUS_LABELS = [
+    ('sent', 'доставлено'),
+    ('failed', 'не доставлено'),
+    ('skipped', 'не отправлено: оплатили раньше'),
+    ('pending', 'ждут повторной отправки'),
+    ('sending', 'отправляются другим экземпляром бота'),
+    ('cancelled', 'остановлено'),
+]
+
+
+class DeliveryError(Exception):
+    """Ошибка отправки, полученная из процесса рассылки: текст и признак временной"""
+
+    def __init__(self, message, transient):
+        super().__init__(message)
+        self.transient = transient
+
+
+def is_transient(error):
+    """Временная ошибка (сеть, таймаут, flood): сообщение стоит отправить позже.
+    BadRequest в python-telegram-bot 13 - подкласс NetworkError, но он окончательный."""
+    if isinstance(error, DeliveryError):
+        return error.transient
+    return isinstance(error, NetworkError) and not isinstance(error, BadRequest)
+
+
+class DeliveryReport:
+    """Итог рассылки: сколько отправлено, не доставлено и повторено"""
+
+    def __init__(self, on_result=None):
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        # Статусы всех сообщений кампании в outbox после рассылки: {status: count}
+        self.campaign_counts = None
+        # Такая же рассылка уже шла, эта ничего не отправляла
+        self.already_running = False
+        self.errors = []
+        self.lock = threading.Lock()
+        # on_result(message, error) вызывается после окончательного результата по сообщению
+        self.on_result = on_result
+        # Установленное событие останавливает рассылку: еще не начатые сообщения не отправляются
+        self.cancelled = threading.Event()
+
+    def add_sent(self, message):
+        with self.lock:
+            self.sent += 1
+        if self.on_result:
+            self.on_result(message, None)
+
+    def add_retry(self):
+        with self.lock:
+            self.retried += 1
+
+    def add_failed(self, message, error):
+        with self.lock:
+            self.failed += 1
+            self.errors.append((message['chat_id'], str(error)))
+        if self.on_result:
+            self.on_result(message, error)
+
+    @property
+    def done(self):
+        return self.sent + self.failed
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def summary_text(self):
+        if self.already_running:
+            return '⏳ Эта рассылка уже идет, повторный запуск пропущен'
+        text = (
+            f'✅ Отправлено: {self.sent}\n'
+            f'❌ Не доставлено: {self.failed}\n'
+            f'🔁 Повторных попыток: {self.retried}'
+        )
+        if self.campaign_counts:
+            counts = self.campaign_counts
+            text += '\n\n📬 Вся кампания:'
+            for status, label in CAMPAIGN_STATUS_LABELS:
+                if counts.get(status):
+                    text += f'\n• {label}: {counts[status]}'
+        if self.cancelled.is_set():
+            text += '\n⛔ Рассылка остановлена администратором'
+        if self.errors:
+            text += '\n\nОшибки:\n' + '\n'.join(
+                f'• {chat_id}: {error}' for chat_id, error in self.errors[:10]
+            )
+            if len(self.errors) > 10:
+                text += f'\n• ... и еще {len(self.errors) - 10}'
+        return text
+
+
+class DeliveryProgress:
+    """Ход рассылки в одном сообщении админу: редактируется не чаще раза в interval секунд.
+
+    tick(report) вызывается после каждого сообщения из потоков рассылки;
+    под сообщением кнопка отмены с callback_data cancel_campaign_<campaign_id>.
+    Итог рассылки пишет в это же сообщение вызывающий код.
+    """
+
+    def __init__(self, bot, chat_id, message_id, campaign_id, total, interval=PROGRESS_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.campaign_id = campaign_id
+        self.total = total
+        self.interval = interval
+        self.started_at = time.monotonic()
+        self.edited_at = None
+        self.lock = threading.Lock()
+
+    def start(self, report):
+        self._edit(report)
+
+    def tick(self, report):
+        with self.lock:
+            if self.edited_at is not None and time.monotonic() - self.edited_at < self.interval:
+                return
+            self.edited_at = time.monotonic()
+        self._edit(report)
+
+    def progress_text(self, report):
+        elapsed = time.monotonic() - self.started_at
+        done = report.done
+        remaining = max(0, self.total - done)
+        rate = done / elapsed if elapsed > 0 else 0
+        text = (
+            f'📤 Рассылка {self.campaign_id}\n\n'
+            f'✅ Отправлено: {report.sent} из {self.total}\n'
+            f'❌ Не доставлено: {report.failed}\n'
+            f'⏳ Осталось: {remaining}\n'
+            f'⚡ Скорость: {rate:.1f} сообщ./сек.'
+        )
+        if rate > 0 and remaining:
+            eta = int(remaining / rate)
+            text += f'\n🕒 Осталось примерно: {eta // 60} мин. {eta % 60} сек.'
+        return text
+
+    def _edit(self, report):
+        keyboard = [[InlineKeyboardButton('⛔ Остановить', callback_data=f'cancel_campaign_{self.campaign_id}')]]
+        try:
+            self.bot.edit_message_text(
+                text=self.progress_text(report),
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+        except Exception as e:
+            # Прогресс не должен мешать самой рассылке
+            logger.warning(f'Не удалось обновить ход рассылки {self.campaign_id}: {e}')
+
+
+class ReminderDelivery:
+    """Параллельная отправка сообщений пулом потоков с учетом лимитов Telegram"""
+
+    def __init__(self, bot, workers=8, limiter=None, max_retries=3, backoff=1.0):
+        self.bot = bot
+        self.workers = workers
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def send_all(self, messages, report=None):
+        """Отправить все сообщения (dict с chat_id, text, reply_markup) и вернуть DeliveryReport"""
+        report = report or DeliveryReport()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for message in messages:
+                pool.submit(self._send_one, message, report)
+        logger.info(f'Рассылка завершена: {report.sent} отправлено, {report.failed} ошибок, {report.retried} повторов')
+        return report
+
+    def _send_one(self, message, report):
+        if report.cancelled.is_set():
+            return
+        chat_id = message['chat_id']
+        attempt = 0
+        while True:
+            self.limiter.wait(chat_id)
+            if report.cancelled.is_set():
+                return
+            try:
+                self.bot.send_message(
+                    chat_id=chat_id,
+                    text=message['text'],
+                    reply_markup=message.get('reply_markup')
+                )
+                report.add_sent(message)
+                return
+            except RetryAfter as e:
+                # Telegram сам говорит, сколько ждать; это не считается неудачной попыткой
+                logger.warning(f'Flood limit для {chat_id}, ждем {e.retry_after} сек.')
+                report.add_retry()
+                time.sleep(e.retry_after)
+            except (BadRequest, Unauthorized) as e:
+                # Чат не найден или бот заблокирован - повтор не поможет
+                logger.error(f'Ошибка отправки {chat_id}: {e}')
+                report.add_failed(message, e)
+                return
+            except (TimedOut, NetworkError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.error(f'Ошибка отправки {chat_id} после {self.max_retries} повторов: {e}')
+                    report.add_failed(message, e)
+                    return
+                logger.warning(f'Сетевая ошибка для {chat_id}, повтор {attempt}: {e}')
+                report.add_retry()
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            except Exception as e:
+                logger.error(f'Ошибка отправки {chat_id}: {e}')
+                report.add_failed(message, e)
+                return
@@ -0,0 +1,238 @@
+import csv
+import logging
+import os
+import re
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+# Заголовки файла (русские и английские) -> поля таблицы parents
+COLUMN_ALIASES = {
+    'имя': 'first_name',
+    'first_name': 'first_name',
+    'фамилия': 'last_name',
+    'last_name': 'last_name',
+    'ребенок': 'child_name',
+    'имя ребенка': 'child_name',
+    'child_name': 'child_name',
+    'школа': 'school',
+    'school': 'school',
+    'класс': 'grade',
+    'grade': 'grade',
+    'телефон': 'phone_number',
+    'phone': 'phone_number',
+    'phone_number': 'phone_number',
+    'username': 'telegram_username',
+    'telegram_username': 'telegram_username',
+    'chat id': 'chat_id',
+    'chat_id': 'chat_id',
+}
+
+REQUIRED_FIELDS = ('first_name', 'child_name', 'school', 'grade')
+
+# Chat ID - целое число; из Excel оно может прийти как "123456789.0"
+CHAT_ID_PATTERN = re.compile(r'-?\d+(?:\.0+)?')
+# Идентификаторы Telegram укладываются в 52 значащих бита
+CHAT_ID_LIMIT = 2 ** 52
+CSV_DELIMITERS = ',;\t'
+
+
+class ImportReport:
+    """Результат импорта: сколько добавлено, пропущено и ошибки по строкам"""
+
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.errors = []
+
+    def add_error(self, row_number, message):
+        self.errors.append((row_number, message))
+
+    def summary_text(self):
+        text = (
+            f'✅ Добавлено: {self.imported}\n'
+            f'⏭ Пропущено (уже есть в базе): {self.skipped}\n'
+            f'❌ Строк с ошибками: {len(self.errors)}'
+        )
+        if self.errors:
+            text += '\n\n' + '\n'.join(
+                f'• строка {row_number}: {message}' for row_number, message in self.errors[:20]
+            )
+            if len(self.errors) > 20:
+                text += f'\n• ... и еще {len(self.errors) - 20}'
+        return text
+
+
+def _iter_csv(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=CSV_DELIMITERS)
+        except csv.Error:
+            # Sniffer не справляется с файлами из одной колонки и неровными строками:
+            # берем самый частый разделитель в заголовке
+            header = sample.splitlines()[0] if sample else ''
+            dialect = csv.excel()
+            dialect.delimiter = max(CSV_DELIMITERS, key=header.count)
+        reader = csv.reader(f, dialect)
+        yield from reader
+
+
+def _iter_xlsx(path):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError('Для импорта XLSX установите openpyxl: pip install openpyxl')
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in workbook.active.iter_rows(values_only=True):
+            yield ['' if value is None else str(value) for value in row]
+    finally:
+        workbook.close()
+
+
+def iter_rows(path):
+    """Построчно читать CSV или XLSX, возвращая (номер строки, dict полей)"""
+    if os.path.splitext(path)[1].lower() in ('.xlsx', '.xlsm'):
+        rows = _iter_xlsx(path)
+    else:
+        rows = _iter_csv(path)
+
+    header = next(rows, None)
+    if header is None:
+        return
+    fields = [COLUMN_ALIASES.get(str(name).strip().lower()) for name in header]
+    missing = [name for name in REQUIRED_FIELDS if name not in fields]
+    if missing:
+        raise ValueError(f'В файле нет обязательных колонок: {", ".join(missing)}')
+
+    for row_number, row in enumerate(rows, 2):
+        values = {}
+        for field, value in zip(fields, row):
+            if field:
+                values[field] = str(value).strip()
+        if any(values.values()):
+            yield row_number, values
+
+
+class ParentImporter:
+    """Массовое добавление родителей из файла пачками по BATCH_SIZE в одной транзакции"""
+
+    def __init__(self, engine, refs):
+        self.engine = engine
+        self.refs = refs
+
+    def _resolve_grade(self, school_name, grade_name):
+        school = self.refs.get_school_by_name(school_name)
+        if not school:
+            return None, f'школа "{school_name}" не найдена'
+        # "5" и "5 класс" считаем одним и тем же классом
+        if grade_name.isdigit():
+            grade_name = f'{grade_name} класс'
+        grade = self.refs.get_grade_by_name(school.id, grade_name)
+        if not grade:
+            return None, f'класс "{grade_name}" не найден в школе "{school_name}"'
+        return grade, None
+
+    def _validate(self, values):
+        for field in REQUIRED_FIELDS:
+            if not values.get(field):
+                return None, f'не заполнено поле {field}'
+
+        grade, error = self._resolve_grade(values['school'], values['grade'])
+        if error:
+            return None, error
+
+        chat_id = values.get('chat_id') or None
+        if chat_id:
+            if not CHAT_ID_PATTERN.fullmatch(chat_id):
+                return None, f'Chat ID "{chat_id}" не целое число'
+            chat_id = int(chat_id.split('.')[0])
+            if abs(chat_id) >= CHAT_ID_LIMIT:
+                return None, f'Chat ID "{chat_id}" вне допустимого диапазона'
+
+        phone = values.get('phone_number') or None
+        if phone and not any(char.isdigit() for char in phone):
+            return None, f'телефон "{phone}" не содержит цифр'
+
+        return {
+            'first_name': values['first_name'],
+            'last_name': values.get('last_name') or None,
+            'child_name': values['child_name'],
+            'grade_id': grade.id,
+            'phone_number': phone,
+            'telegram_username': (values.get('telegram_username') or '').lstrip('@') or None,
+            'chat_id': chat_id,
+        }, None
+
+    def _insert_batch(self, batch):
+        with self.engine.begin() as conn:
+            conn.execute(text('''
+                INSERT INTO parents
+                    (first_name, last_name, child_name, grade_id, phone_number,
+                     telegram_username, chat_id, is_active)
+                VALUES
+                    (:first_name, :last_name, :child_name, :grade_id, :phone_number,
+                     :telegram_username, :chat_id, :is_active)
+            '''), [dict(parent, is_active=True) for parent in batch])
+
+    def _flush(self, batch, report):
+        """Записать пачку (номер строки, родитель); если база отвергла пачку,
+        повторить по одной строке и записать отвергнутые в ошибки отчета"""
+        try:
+            self._insert_batch([parent for _, parent in batch])
+            report.imported += len(batch)
+            return
+        except IntegrityError as e:
+            logger.warning(f'Пачка из {len(batch)} строк не записана ({e.orig}), записываю по одной')
+        for row_number, parent in batch:
+            try:
+                self._insert_batch([parent])
+                report.imported += 1
+            except IntegrityError as e:
+                report.add_error(row_number, f'не записана в базу: {e.orig}')
+
+    def import_file(self, path, dry_run=False):
+        """Импортировать родителей из CSV/XLSX и вернуть ImportReport"""
+        report = ImportReport()
+
+        # У братьев и сестер один chat_id, повтором считается только тот же ребенок
+        with self.engine.connect() as conn:
+            known_children = {tuple(row) for row in conn.execute(text(
+                'SELECT chat_id, child_name FROM parents WHERE chat_id IS NOT NULL'
+            ))}
+
+        batch = []
+        for row_number, values in iter_rows(path):
+            parent, error = self._validate(values)
+            if error:
+                report.add_error(row_number, error)
+                continue
+            child = (parent['chat_id'], parent['child_name'])
+            if parent['chat_id'] and child in known_children:
+                report.skipped += 1
+                continue
+            if parent['chat_id']:
+                known_children.add(child)
+
+            batch.append((row_number, parent))
+            if len(batch) >= BATCH_SIZE:
+                if dry_run:
+                    report.imported += len(batch)
+                else:
+                    self._flush(batch, report)
+                batch = []
+
+        if batch:
+            if dry_run:
+                report.imported += len(batch)
+            else:
+                self._flush(batch, report)
+
+        logger.info(f'Импорт {path}: добавлено {report.imported}, ошибок {len(report.errors)}')
+        return report
@@ -0,0 +1,89 @@
+"""Профиль импорта модулей бота (python -X importtime) и бюджет времени запуска.
+
+Импортирует модуль в отдельном чистом процессе несколько раз, печатает
+самые долгие импорты по суммарному времени (медиана по запускам) и
+проверяет, что редко нужные подсистемы не загружаются при старте:
+они импортируются внутри своих обработчиков и команд.
+
+    python importtime_check.py
+    python importtime_check.py --module admin_tools --budget 300
+    python importtime_check.py --top 40 --repeat 5
+
+Код выхода 1, если импорт дольше --budget мс или загружен модуль
+из списка отложенных.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Модули, которые не должны импортироваться вместе с указанным
+DEFERRED = {
+    'bot': ['database', 'seeding', 'importer', 'reports', 'openpyxl'],
+    'admin_tools': ['database', 'sqlalchemy', 'telegram'],
+}
+# Бюджет импорта по умолчанию, мс
+BUDGETS = {
+    'bot': 900,
+    'admin_tools': 100,
+}
+
+
+def profile(module):
+    """Один импорт module в новом процессе: {имя модуля: суммарное время, мкс}"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True
+    )
+    if result.returncode:
+        raise RuntimeError(f'Не удалось импортировать {module}:\n{result.stderr[-2000:]}')
+
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        timings.setdefault(name.strip(), int(cumulative))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Профиль импорта модулей бота')
+    parser.add_argument('--module', default='bot')
+    parser.add_argument('--budget', type=float, help='допустимое время импорта, мс')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    runs = [profile(args.module) for _ in range(args.repeat)]
+    names = set().union(*runs)
+    median = {
+        name: statistics.median(run.get(name, 0) for run in runs) / 1000
+        for name in names
+    }
+
+    total = median.get(args.module, 0.0)
+    print(f'⏱ import {args.module}: {total:.0f} мс (медиана из {args.repeat}), модулей: {len(names)}\n')
+    for name, duration in sorted(median.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f'{duration:8.1f} мс  {name}')
+
+    failed = False
+    loaded = [name for name in DEFERRED.get(args.module, []) if name in names]
+    if loaded:
+        print(f'\n❌ Загружаются при импорте, хотя должны откладываться: {", ".join(loaded)}')
+        failed = True
+
+    budget = args.budget or BUDGETS.get(args.module)
+    if budget and total > budget:
+        print(f'\n❌ Импорт {args.module} дольше бюджета {budget:.0f} мс')
+        failed = True
+    elif budget:
+        print(f'\n✅ В пределах бюджета {budget:.0f} мс')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
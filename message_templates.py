@@ -0,0 +1,126 @@
+import os
+import string
+from functools import lru_cache
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import config
+
+# Каталог с шаблонами: templates/<язык>/<имя>.txt и labels.txt с короткими подписями
+TEMPLATES_DIR = getattr(config, 'TEMPLATES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+TEMPLATE_LANGUAGE = getattr(config, 'TEMPLATE_LANGUAGE', 'ru')
+FRAGMENT_CACHE_SIZE = 1024
+
+
+class MessageTemplate:
+    """Шаблон, разобранный один раз при загрузке.
+
+    Синтаксис - как у str.format, плюс значение по умолчанию для пустых полей
+    (None, пустая строка, 0): {due_date|не указан:%d.%m.%Y}. Поля нумеруются в порядке первого
+    появления (self.fields), render_row принимает кортеж значений в этом порядке.
+    """
+
+    def __init__(self, name, source):
+        self.name = name
+        # Литералы чередуются с подстановками: literals[0], slot 0, literals[1], ...
+        self._literals = ['']
+        self._slots = []
+
+        positions = {}
+        for literal, field, spec, _ in string.Formatter().parse(source):
+            self._literals[-1] += literal
+            if field is None:
+                continue
+            field_name, separator, default = field.partition('|')
+            if field_name not in positions:
+                positions[field_name] = len(positions)
+            # None - у поля нет значения по умолчанию, и 0 или '' выводятся как есть
+            self._slots.append((positions[field_name], spec or '', default if separator else None))
+            self._literals.append('')
+        self.fields = tuple(positions)
+
+    def render_row(self, row):
+        parts = [self._literals[0]]
+        for (index, spec, default), literal in zip(self._slots, self._literals[1:]):
+            value = row[index]
+            if default is not None and not value:
+                parts.append(default)
+            elif value is None:
+                parts.append('')
+            else:
+                parts.append(format(value, spec))
+            parts.append(literal)
+        return ''.join(parts)
+
+    def render(self, values):
+        """values - словарь или строка результата запроса с полями шаблона"""
+        return self.render_row([values[field] for field in self.fields])
+
+
+class MessageTemplates:
+    """Все шаблоны одного языка, загруженные из файлов при создании.
+
+    Фрагменты, зависящие только от справочников (школа и класс), кэшируются:
+    в рассылке они повторяются для каждого родителя одного класса.
+    """
+
+    def __init__(self, language=TEMPLATE_LANGUAGE, directory=TEMPLATES_DIR):
+        self.language = language
+        path = os.path.join(directory, language)
+        self.templates = {}
+        self.labels = {}
+        for filename in sorted(os.listdir(path)):
+            name, extension = os.path.splitext(filename)
+            if extension != '.txt':
+                continue
+            with open(os.path.join(path, filename), encoding='utf-8') as f:
+                source = f.read().rstrip('\n')
+            if name == 'labels':
+                for line in source.splitlines():
+                    if '=' in line and not line.lstrip().startswith('#'):
+                        key, value = line.split('=', 1)
+                        self.labels[key.strip()] = value.strip()
+            else:
+                self.templates[name] = MessageTemplate(name, source)
+        self.fragment = lru_cache(maxsize=FRAGMENT_CACHE_SIZE)(self._render_fragment)
+
+    def __getitem__(self, name):
+        return self.templates[name]
+
+    def render(self, name, values, **extra):
+        """Отрисовать шаблон name; поля из extra имеют приоритет над values"""
+        template = self.templates[name]
+        return template.render_row([
+            extra[field] if field in extra else values[field] for field in template.fields
+        ])
+
+    def _render_fragment(self, name, **values):
+        return self.templates[name].render(values)
+
+    def school_grade(self, values, name='school_grade'):
+        """Строка со школой и классом - одна на класс, берется из кэша"""
+        return self.fragment(name, school_name=values['school_name'], grade_name=values['grade_name'])
+
+    def label(self, key):
+        return self.labels.get(key, key)
+
+    def paid_keyboard(self, payment_id):
+        """Кнопка ✅ Оплатил под напоминанием"""
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton(self.label('paid_button'), callback_data=f'payment_{payment_id}')
+        ]])
+
+    def reminder(self, values):
+        """Напоминание об оплате: first_name, month, school_name, grade_name, child_name, amount, due_date"""
+        return self.render('reminder', values, school_grade=self.school_grade(values))
+
+
+_templates = None
+
+
+def get_templates():
+    """Шаблоны языка TEMPLATE_LANGUAGE, загружаются при первом обращении"""
+    global _templates
+    if _templates is None:
+        _templates = MessageTemplates()
+    return _templates
@@ -0,0 +1,333 @@
+import logging
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from telegram.ext import ConversationHandler
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# HTTP-эндпоинт с метриками в формате Prometheus включается портом в config.py,
+# например METRICS_PORT = 9108; по умолчанию выключен
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')
+METRICS_PORT = getattr(config, 'METRICS_PORT', None)
+# Больше запросов к БД на одно обновление - повод искать N+1
+N_PLUS_ONE_THRESHOLD = getattr(config, 'N_PLUS_ONE_THRESHOLD', 10)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Счетчики текущего обновления: у каждого потока и каждой задачи asyncio свои
+_current_update = ContextVar('current_update', default=None)
+
+
+class Histogram:
+    """Распределение длительностей по фиксированным корзинам BUCKETS"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def prometheus_lines(self, name, labels=''):
+        separator = ',' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class UpdateStats:
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+
+
+class HandlerStats:
+    def __init__(self):
+        self.duration = Histogram()
+        self.queries = 0
+        self.rows = 0
+        self.max_queries = 0
+        self.errors = 0
+
+
+class Metrics:
+    """Метрики обработчиков, запросов к БД и вызовов Telegram API"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handlers = {}
+        self.db_queries = Histogram()
+        self.api_calls = {}
+        self.api_errors = {}
+
+    @contextmanager
+    def measure_update(self, handler_name):
+        """Время обработчика и число запросов к БД и строк за одно обновление"""
+        stats = UpdateStats()
+        token = _current_update.set(stats)
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield stats
+        except Exception:
+            failed = True
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            _current_update.reset(token)
+            with self.lock:
+                handler = self.handlers.setdefault(handler_name, HandlerStats())
+                handler.duration.observe(duration)
+                handler.queries += stats.queries
+                handler.rows += stats.rows
+                handler.max_queries = max(handler.max_queries, stats.queries)
+                handler.errors += failed
+
+    def timed_handler(self, name, callback):
+        """Обернуть callback обработчика python-telegram-bot"""
+        @wraps(callback)
+        def wrapper(update, context):
+            with self.measure_update(name):
+                return callback(update, context)
+        return wrapper
+
+    def observe_query(self, duration, rows):
+        with self.lock:
+            self.db_queries.observe(duration)
+        stats = _current_update.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.rows += rows
+
+    def count_rows(self, rows):
+        stats = _current_update.get()
+        if stats is not None:
+            stats.rows += rows
+
+    def observe_api(self, method, duration, failed=False):
+        with self.lock:
+            self.api_calls.setdefault(method, Histogram()).observe(duration)
+            if failed:
+                self.api_errors[method] = self.api_errors.get(method, 0) + 1
+
+    def prometheus_text(self):
+        with self.lock:
+            lines = [
+                '# HELP bot_handler_seconds Время обработки обновления',
+                '# TYPE bot_handler_seconds histogram',
+            ]
+            for name, handler in sorted(self.handlers.items()):
+                lines += handler.duration.prometheus_lines('bot_handler_seconds', f'handler="{name}"')
+            for metric, attribute, help_text in (
+                ('bot_handler_db_queries_total', 'queries', 'Запросов к БД из обработчика'),
+                ('bot_handler_db_rows_total', 'rows', 'Строк, прочитанных или измененных обработчиком'),
+                ('bot_handler_errors_total', 'errors', 'Обработчик завершился исключением'),
+            ):
+                lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+                lines += [
+                    f'{metric}{{handler="{name}"}} {getattr(handler, attribute)}'
+                    for name, handler in sorted(self.handlers.items())
+                ]
+            lines += ['# HELP bot_db_query_seconds Время запроса к БД', '# TYPE bot_db_query_seconds histogram']
+            lines += self.db_queries.prometheus_lines('bot_db_query_seconds')
+            lines += ['# HELP bot_telegram_api_seconds Время вызова Telegram API', '# TYPE bot_telegram_api_seconds histogram']
+            for method, histogram in sorted(self.api_calls.items()):
+                lines += histogram.prometheus_lines('bot_telegram_api_seconds', f'method="{method}"')
+            lines += ['# HELP bot_telegram_api_errors_total Ошибки Telegram API', '# TYPE bot_telegram_api_errors_total counter']
+            lines += [
+                f'bot_telegram_api_errors_total{{method="{method}"}} {count}'
+                for method, count in sorted(self.api_errors.items())
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def perf_text(self, limit=15):
+        """Сводка для /perf: самые затратные обработчики и методы API"""
+        with self.lock:
+            handlers = sorted(self.handlers.items(), key=lambda item: item[1].duration.sum, reverse=True)
+            api_calls = sorted(self.api_calls.items(), key=lambda item: item[1].sum, reverse=True)
+            if not handlers and not api_calls:
+                return '📈 Метрик пока нет'
+
+            text = '📈 Обработчики (по суммарному времени):\n\n'
+            for name, handler in handlers[:limit]:
+                duration = handler.duration
+                queries_per_update = handler.queries / duration.count
+                warning = ' ⚠️ N+1?' if handler.max_queries > N_PLUS_ONE_THRESHOLD else ''
+                text += (
+                    f'• {name}: {duration.count} раз, '
+                    f'ср. {duration.avg * 1000:.0f} мс, p95 ≤{duration.quantile(0.95) * 1000:.0f} мс, '
+                    f'макс. {duration.max * 1000:.0f} мс\n'
+                    f'   БД: {queries_per_update:.1f} запр./обн. (макс. {handler.max_queries}), '
+                    f'{handler.rows / duration.count:.0f} строк/обн.{warning}'
+                )
+                if handler.errors:
+                    text += f', ошибок: {handler.errors}'
+                text += '\n'
+
+            text += (
+                f'\n🗄 Запросы к БД: {self.db_queries.count}, '
+                f'ср. {self.db_queries.avg * 1000:.1f} мс, макс. {self.db_queries.max * 1000:.0f} мс\n'
+            )
+            if api_calls:
+                text += '\n📡 Telegram API:\n'
+                for method, histogram in api_calls[:limit]:
+                    text += (
+                        f'• {method}: {histogram.count} раз, ср. {histogram.avg * 1000:.0f} мс, '
+                        f'макс. {histogram.max * 1000:.0f} мс'
+                    )
+                    if self.api_errors.get(method):
+                        text += f', ошибок: {self.api_errors[method]}'
+                    text += '\n'
+        return text
+
+
+metrics = Metrics()
+_db_instrumented = False
+
+
+def _counting_row_factory(cursor, row):
+    metrics.count_rows(1)
+    return row
+
+
+def instrument_db():
+    """Считать запросы и строки во всех engine процесса, включая ORM в database.py.
+
+    Вызывается до создания первого engine. Прочитанные строки SQLite считаются
+    через row_factory, у остальных драйверов - по rowcount курсора.
+    """
+    global _db_instrumented
+    if _db_instrumented:
+        return
+    _db_instrumented = True
+
+    @event.listens_for(Pool, 'connect')
+    def count_sqlite_rows(dbapi_connection, connection_record):
+        if isinstance(dbapi_connection, sqlite3.Connection):
+            dbapi_connection.row_factory = _counting_row_factory
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def finish_query(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        metrics.observe_query(time.perf_counter() - started, max(cursor.rowcount, 0))
+
+
+def instrument_bot(bot):
+    """Замерять каждый вызов Telegram API, кроме длинного опроса getUpdates"""
+    request = bot.request
+    post = request.post
+
+    def timed_post(url, data=None, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        if method == 'getUpdates':
+            return post(url, data, timeout)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return post(url, data, timeout)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            metrics.observe_api(method, time.perf_counter() - started, failed)
+
+    request.post = timed_post
+
+
+def instrument_dispatcher(dispatcher):
+    """Обернуть callback каждого зарегистрированного обработчика замером времени.
+
+    Вызывается в конце setup_handlers; callback, уже замеряемые сами
+    (асинхронные обработчики), помечены атрибутом instrumented.
+    """
+    def instrument(handler):
+        if isinstance(handler, ConversationHandler):
+            for inner in handler.entry_points + handler.fallbacks:
+                instrument(inner)
+            for state_handlers in handler.states.values():
+                for inner in state_handlers:
+                    instrument(inner)
+            return
+        callback = handler.callback
+        if getattr(callback, 'instrumented', False):
+            return
+        handler.callback = metrics.timed_handler(callback.__name__, callback)
+        handler.callback.instrumented = True
+
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            instrument(handler)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Отдавать /metrics в фоновом потоке; возвращает сервер или None, если порт
+    не задан или занят - бот работает и без эндпоинта, /perf продолжает отвечать"""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    except OSError as e:
+        logger.error(f'Не удалось открыть метрики на {host}:{port}: {e}')
+        return None
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f'Метрики: http://{host}:{port}/metrics')
+    return server
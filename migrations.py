@@ -0,0 +1,337 @@
+import logging
+import re
+import sqlite3
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import bindparam, create_engine, event, inspect, text
+from sqlalchemy.pool import StaticPool
+
+from payment_summary import SUMMARY_TABLE_SQL, REBUILD_SQL
+
+logger = logging.getLogger(__name__)
+
+# Миграции применяются по порядку и только один раз; id не меняются после выпуска.
+# Индекс (parent_id, month) уже дает ux_payments_parent_month из первой миграции.
+# Перед уникальным индексом шаг-функция сливает или показывает строки, которые ему мешают.
+#
+# chat_id не уникален: строка parents - это родитель одного ребенка, и у братьев
+# и сестер один chat_id на несколько строк. /start показывает всех детей
+# (PaymentQueries.get_parent_cards), импорт пропускает только повтор той же пары
+# (chat_id, child_name), а кнопки по chat_id работают со всеми его строками.
+MIGRATIONS = [
+    ('001_payments_parent_month', 'Не больше одного платежа на родителя за месяц', [
+        lambda conn: _merge_duplicate_payments(conn),
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_payments_parent_month ON payments (parent_id, month)',
+    ]),
+    ('002_parents_chat_id', 'Поиск родителя по chat_id в /start и кнопках', [
+        'CREATE INDEX IF NOT EXISTS ix_parents_chat_id ON parents (chat_id)',
+    ]),
+    ('003_payments_month_paid', 'Списки и отчеты по месяцу и статусу оплаты', [
+        'CREATE INDEX IF NOT EXISTS ix_payments_month_paid ON payments (month, is_paid)',
+    ]),
+    ('004_payments_due_date', 'Поиск неоплаченных платежей по сроку оплаты для планировщика', [
+        'CREATE INDEX IF NOT EXISTS ix_payments_due_date ON payments (due_date)',
+    ]),
+    ('005_payment_summary', 'Итоги платежей по месяцу, школе и классу для /stats и отчетов', [
+        SUMMARY_TABLE_SQL,
+        REBUILD_SQL.format(where=''),
+    ]),
+    ('006_grades_school_name', 'Ключ upsert справочников: класс с таким названием в школе один', [
+        lambda conn: _check_duplicates(conn, 'grades', ('school_id', 'grade_name')),
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_grades_school_name ON grades (school_id, grade_name)',
+    ]),
+    ('007_outbox', 'Очередь исходящих напоминаний (outbox.py)', [
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            campaign_id VARCHAR(50) NOT NULL,
+            payment_id INTEGER NOT NULL,
+            chat_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            status VARCHAR(10) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP,
+            sent_at TIMESTAMP,
+            UNIQUE (campaign_id, payment_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS ix_outbox_status_campaign ON outbox (status, campaign_id)',
+    ]),
+    ('008_outbox_claimed_at', 'Время, когда сообщение взято в отправку: брошенные возвращаются в очередь', [
+        lambda conn: _add_column(conn, 'outbox', 'claimed_at', 'TIMESTAMP'),
+    ]),
+    ('009_bot_state', 'Состояние диалогов и user_data (persistence.py, STATE_BACKEND = "sql")', [
+        '''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            namespace VARCHAR(50) NOT NULL,
+            key VARCHAR(100) NOT NULL,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMP,
+            PRIMARY KEY (namespace, key)
+        )
+        ''',
+    ]),
+    ('010_outbox_claimed_by', 'Процесс, взявший сообщение в отправку: свои брошенные строки он возвращает сразу', [
+        lambda conn: _add_column(conn, 'outbox', 'claimed_by', 'VARCHAR(100)'),
+    ]),
+    ('011_parents_chat_id_siblings', 'Один chat_id у родителя нескольких детей: индекс по chat_id не уникальный', [
+        # Базы, где 002 успела создать уникальный ux_parents_chat_id
+        'DROP INDEX IF EXISTS ux_parents_chat_id',
+        'CREATE INDEX IF NOT EXISTS ix_parents_chat_id ON parents (chat_id)',
+    ]),
+    ('012_scheduler_runs', 'Запуски плановых задач и число неудачных попыток за период (scheduler.py)', [
+        '''
+        CREATE TABLE IF NOT EXISTS scheduler_runs (
+            job_name VARCHAR(50) PRIMARY KEY,
+            run_key VARCHAR(20) NOT NULL,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            duration REAL,
+            result TEXT
+        )
+        ''',
+        # Таблицу могла создать прежняя версия планировщика без этих колонок
+        lambda conn: _add_column(conn, 'scheduler_runs', 'attempts', 'INTEGER NOT NULL DEFAULT 0'),
+        lambda conn: _add_column(conn, 'scheduler_runs', 'failed', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+    ]),
+]
+
+# Справочники читаются целиком в ReferenceCache, полный просмотр для них нормален
+FULL_SCAN_ALLOWED = {'schools', 'grades'}
+# (запрос, таблица), которые по смыслу обходят таблицу целиком
+FULL_SCAN_EXPECTED = {
+    ('get_reminder_batch', 'payments'): 'по одному платежу на каждого должника',
+    ('get_unpaid_reminders', 'parents'): 'неоплаченные платежи каждого активного родителя',
+    ('get_unpaid_reminders', 'payments'): 'все неоплаченные платежи, если план начинает с payments',
+    ('get_parents_page', 'parents'): 'первая страница - обход по id до LIMIT',
+    ('get_statistics', 'payment_summary'): 'счетчики по всем итогам',
+    ('get_statistics', 'parents'): 'число активных родителей',
+    ('create_monthly_payments', 'parents'): 'платеж каждому активному родителю',
+}
+_SCAN_PATTERN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+_SUBQUERY_PATTERN = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\w+)')
+# Таблица и ее псевдоним в SQL: "FROM payments pay", "JOIN parents AS par"
+_TABLE_PATTERN = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+_NOT_ALIASES = {
+    'ON', 'WHERE', 'JOIN', 'LEFT', 'INNER', 'CROSS', 'GROUP', 'ORDER', 'LIMIT',
+    'SET', 'VALUES', 'SELECT', 'UNION', 'USING',
+}
+
+
+def _add_column(conn, table, column, column_type):
+    """ALTER TABLE ... ADD COLUMN, если колонки еще нет: таблицы, созданные
+    до появления миграций, могут ее уже содержать"""
+    if column not in {info['name'] for info in inspect(conn).get_columns(table)}:
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}'))
+
+
+def _duplicate_rows(conn, table, columns, order_by='t.id'):
+    """Строки table, у которых значения columns повторяются, сгруппированные
+    по этим значениям: {значения: [строки в порядке order_by]}"""
+    keys = ', '.join(columns)
+    condition = ' AND '.join(f'd.{column} = t.{column}' for column in columns)
+    rows = conn.execute(text(f'''
+        SELECT t.*
+        FROM {table} t
+        JOIN (SELECT {keys} FROM {table} GROUP BY {keys} HAVING COUNT(*) > 1) d ON {condition}
+        ORDER BY {', '.join(f't.{column}' for column in columns)}, {order_by}
+    '''))
+    groups = {}
+    for row in rows.mappings():
+        groups.setdefault(tuple(row[column] for column in columns), []).append(dict(row))
+    return groups
+
+
+def _check_duplicates(conn, table, columns):
+    """Остановить миграцию со списком повторов, если уникальный индекс
+    по columns не создать, а слить строки автоматически нельзя"""
+    groups = _duplicate_rows(conn, table, columns)
+    if groups:
+        details = '; '.join(
+            f'{dict(zip(columns, key))}: id {[row["id"] for row in rows]}' for key, rows in groups.items()
+        )
+        raise RuntimeError(f'в {table} повторяются {", ".join(columns)}, исправьте вручную: {details}')
+
+
+def _merge_duplicate_payments(conn):
+    """Оставить по одному платежу на (parent_id, month): оплаченный, а среди
+    равных - самый ранний; остальные удалить и перечислить в журнале"""
+    groups = _duplicate_rows(conn, 'payments', ('parent_id', 'month'), order_by='t.is_paid DESC, t.id')
+    removed = [row['id'] for rows in groups.values() for row in rows[1:]]
+    if not removed:
+        return
+    conn.execute(
+        text('DELETE FROM payments WHERE id IN :ids').bindparams(bindparam('ids', expanding=True)),
+        {'ids': removed}
+    )
+    for (parent_id, month), rows in groups.items():
+        logger.warning(
+            f'Платежи родителя {parent_id} за {month}: оставлен id {rows[0]["id"]}, '
+            f'удалены {[row["id"] for row in rows[1:]]}'
+        )
+
+
+def apply_migrations(engine):
+    """Применить еще не выполненные миграции; возвращает список их id"""
+    with engine.begin() as conn:
+        conn.execute(text('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                id VARCHAR(100) PRIMARY KEY,
+                applied_at TIMESTAMP
+            )
+        '''))
+        done = set(conn.execute(text('SELECT id FROM schema_migrations')).scalars())
+
+    applied = []
+    for migration_id, description, statements in MIGRATIONS:
+        if migration_id in done:
+            continue
+        try:
+            with engine.begin() as conn:
+                for statement in statements:
+                    # Шаг, которому нужна проверка схемы, задается функцией от соединения
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(text(statement))
+                conn.execute(text(
+                    'INSERT INTO schema_migrations (id, applied_at) VALUES (:id, :applied_at)'
+                ), {'id': migration_id, 'applied_at': datetime.now()})
+        except Exception as e:
+            raise RuntimeError(f'Миграция {migration_id} ({description}) не применена: {e}') from e
+        logger.info(f'Применена миграция {migration_id}: {description}')
+        applied.append(migration_id)
+    return applied
+
+
+def _bot_queries(engine):
+    """Все запросы бота к БД в виде (имя, вызов) на переданном engine"""
+    from importer import ParentImporter
+    from outbox import Outbox
+    from persistence import SQLStateStore
+    from queries import PaymentQueries
+    from reference_cache import ReferenceCache
+    from scheduler import PaymentScheduler
+
+    queries = PaymentQueries(engine)
+    outbox = Outbox(engine)
+    month = date.today().strftime('%Y-%m')
+    refs = ReferenceCache(engine)
+    importer = ParentImporter(engine, refs)
+    scheduler = PaymentScheduler(None, engine)
+    state = SQLStateStore(engine)
+    message = {'outbox_id': 0, 'payment_id': 0, 'chat_id': 0, 'text': '', 'reply_markup': None}
+    parent = {'first_name': '', 'last_name': None, 'child_name': '', 'grade_id': 0, 'phone_number': None,
+              'telegram_username': None, 'chat_id': None}
+
+    return [
+        ('get_parent_cards', lambda: queries.get_parent_cards(0)),
+        ('get_reminder_batch', queries.get_reminder_batch),
+        ('get_payment_report(paid)', lambda: queries.get_payment_report(True, limit=11)),
+        ('get_payment_report(paid, after)', lambda: queries.get_payment_report(True, after=(month, 0), limit=11)),
+        ('get_payment_report(unpaid, month)', lambda: queries.get_payment_report(False, month=month, limit=11)),
+        ('get_payment_report(unpaid, month, before)',
+         lambda: queries.get_payment_report(False, month=month, before=(month, 0), limit=11)),
+        ('get_parents_page', lambda: queries.get_parents_page(limit=11)),
+        ('get_parents_page(after)', lambda: queries.get_parents_page(after=1, limit=11)),
+        ('get_statistics', lambda: queries.get_statistics(month)),
+        ('get_school_revenue', lambda: queries.get_school_revenue(month)),
+        ('get_grade_report', lambda: queries.get_grade_report(month)),
+        ('iter_month_payments', lambda: list(queries.iter_month_payments(month))),
+        ('get_unpaid_reminders', queries.get_unpaid_reminders),
+        ('get_reminders_due_on', lambda: queries.get_reminders_due_on({date.today(), date.today() + timedelta(days=3)})),
+        ('has_unpaid_due_on', lambda: queries.has_unpaid_due_on({date.today()})),
+        ('create_monthly_payments', lambda: queries.create_monthly_payments(month)),
+        ('mark_payment_paid', lambda: queries.mark_payment_paid(0, 0)),
+        ('mark_receipt_sent', lambda: queries.mark_receipt_sent(0, 0)),
+        ('rebuild_summary', lambda: queries.rebuild_summary(month)),
+        ('reference_cache', refs.get_schools),
+        ('importer.insert_batch', lambda: importer._insert_batch([parent])),
+        ('scheduler.claim', lambda: scheduler._claim('check', month)),
+        ('outbox.enqueue', lambda: outbox.enqueue('check', [message])),
+        ('outbox.skip_paid', lambda: outbox.skip_paid('check')),
+        ('outbox.claim', lambda: outbox.claim('check', 100)),
+        ('outbox.counts', lambda: outbox.counts('check')),
+        ('outbox.record_result', lambda: outbox.record_result(message, None)),
+        ('outbox.cancel', lambda: outbox.cancel('check')),
+        ('outbox.reclaim_stale', outbox.reclaim_stale),
+        ('outbox.reclaim_stale(active)', lambda: outbox.reclaim_stale(active_campaigns=['check'])),
+        ('outbox.unfinished_campaigns', outbox.unfinished_campaigns),
+        ('state.write', lambda: state.write({('check', 'key'): '{}', ('check', 'old'): None})),
+        ('state.load', lambda: state.load('check')),
+        ('state.get', lambda: state.get('check', 'key')),
+    ]
+
+
+def _table_aliases(statement):
+    """Псевдонимы таблиц в statement: {псевдоним или имя: таблица}"""
+    aliases = {}
+    for table, alias in _TABLE_PATTERN.findall(statement):
+        aliases[table] = table
+        if alias and alias.upper() not in _NOT_ALIASES:
+            aliases[alias] = table
+    return aliases
+
+
+def _full_scans(name, statement, plan):
+    """Таблицы, которые план читает целиком без индекса, кроме FULL_SCAN_ALLOWED
+    и пар (запрос, таблица) из FULL_SCAN_EXPECTED"""
+    subqueries = {match.group(1) for match in map(_SUBQUERY_PATTERN.match, plan) if match}
+    aliases = _table_aliases(statement)
+    scans = []
+    for detail in plan:
+        match = _SCAN_PATTERN.match(detail)
+        if not match or 'USING' in detail or match.group(1) in subqueries:
+            continue
+        table = aliases.get(match.group(1), match.group(1))
+        if table not in FULL_SCAN_ALLOWED and (name, table) not in FULL_SCAN_EXPECTED:
+            scans.append(table)
+    return scans
+
+
+def check_query_plans(engine):
+    """EXPLAIN QUERY PLAN для каждого запроса бота.
+
+    Запросы выполняются на копии SQLite-базы в памяти, поэтому проверка
+    ничего не меняет в рабочей базе. Возвращает список
+    (имя, SQL, строки плана, таблицы с недопустимым полным просмотром).
+    """
+    if engine.dialect.name != 'sqlite':
+        raise RuntimeError('Проверка планов поддерживается только для SQLite')
+
+    source = engine.raw_connection()
+    copy = sqlite3.connect(':memory:', check_same_thread=False)
+    try:
+        source.driver_connection.backup(copy)
+    finally:
+        source.close()
+    check_engine = create_engine('sqlite://', creator=lambda: copy, poolclass=StaticPool)
+    apply_migrations(check_engine)
+
+    plans = []
+
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'INSERT', 'DELETE', 'WITH')):
+            return
+        if executemany:
+            # План пачки такой же, как у одной строки
+            parameters = parameters[0]
+        plan = cursor.connection.execute(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+        plans.append((statement, [row[-1] for row in plan]))
+
+    results = []
+    calls = _bot_queries(check_engine)
+    event.listen(check_engine, 'before_cursor_execute', explain)
+    try:
+        for name, call in calls:
+            del plans[:]
+            call()
+            for statement, plan in plans:
+                results.append((name, statement, plan, _full_scans(name, statement, plan)))
+    finally:
+        event.remove(check_engine, 'before_cursor_execute', explain)
+        check_engine.dispose()
+        copy.close()
+    return results
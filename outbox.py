@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, text
+from telegram import InlineKeyboardMarkup
+
+import config
+from delivery import is_transient
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз пробовать сообщение при временных ошибках (сеть, таймаут), прежде чем считать его failed
+OUTBOX_MAX_ATTEMPTS = getattr(config, 'OUTBOX_MAX_ATTEMPTS', 3)
+# Через сколько секунд взятое в отправку (sending) сообщение считается брошенным упавшим процессом
+OUTBOX_CLAIM_TIMEOUT = getattr(config, 'OUTBOX_CLAIM_TIMEOUT', 120)
+# Пачка claim() - столько секунд отправки при текущем лимите: после падения
+# недосланными в sending остается не больше одной короткой пачки
+OUTBOX_BATCH_SECONDS = getattr(config, 'OUTBOX_BATCH_SECONDS', 5)
+
+
+class Outbox:
+    """Очередь исходящих напоминаний в БД.
+
+    Рассылка сначала целиком записывается в outbox (одна строка на платеж
+    в кампании, повтор не добавится благодаря уникальному ключу), затем
+    отправляется пачками: claim() одним UPDATE переводит строки из pending
+    в sending, поэтому два процесса бота не возьмут одно сообщение.
+    Каждое отправленное сообщение сразу помечается sent, поэтому после
+    падения процесса кампания продолжается с места остановки, а уже
+    получившим повторно ничего не уходит.
+
+    Статусы: pending -> sending -> sent | failed; skipped - платеж оплачен
+    до отправки, cancelled - рассылку остановил админ.
+    Строки в sending помечены владельцем (claimed_by) - процессом, который
+    их взял; брошенные возвращает в очередь reclaim_stale().
+    Таблицу создают миграции 007, 008 и 010 (migrations.py).
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        # Уникален для каждого запуска, даже если pid повторился (контейнеры)
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+    def enqueue(self, campaign_id, messages):
+        """Добавить сообщения кампании одной пачкой.
+
+        Уже поставленные пропускаются, остановленные админом снова ставятся в очередь.
+        """
+        if not messages:
+            return 0
+        now = datetime.now()
+        with self.engine.begin() as conn:
+            result = conn.execute(text('''
+                INSERT INTO outbox (campaign_id, payment_id, chat_id, text, reply_markup, created_at)
+                VALUES (:campaign_id, :payment_id, :chat_id, :text, :reply_markup, :created_at)
+                ON CONFLICT (campaign_id, payment_id) DO UPDATE
+                SET status = 'pending'
+                WHERE outbox.status = 'cancelled'
+            '''), [{
+                'campaign_id': campaign_id,
+                'payment_id': message['payment_id'],
+                'chat_id': message['chat_id'],
+                'text': message['text'],
+                'reply_markup': json.dumps(message['reply_markup'].to_dict()) if message.get('reply_markup') else None,
+                'created_at': now,
+            } for message in messages])
+            return result.rowcount
+
+    def skip_paid(self, campaign_id):
+        """Пока кампания стояла, часть родителей могла оплатить - им напоминание не нужно"""
+        with self.engine.begin() as conn:
+            return conn.execute(text('''
+                UPDATE outbox
+                SET status = 'skipped'
+                WHERE status = 'pending' AND campaign_id = :campaign_id
+                  AND payment_id IN (SELECT id FROM payments WHERE is_paid)
+            '''), {'campaign_id': campaign_id}).rowcount
+
+    def claim(self, campaign_id, limit):
+        """Взять в отправку до limit сообщений кампании: pending -> sending одним UPDATE.
+
+        Возвращает их в виде словарей для доставки. Строки, которые
+        одновременно взял другой процесс, сюда не попадут.
+        """
+        with self.engine.begin() as conn:
+            rows = conn.execute(text('''
+                UPDATE outbox
+                SET status = 'sending', claimed_at = :claimed_at, claimed_by = :owner
+                WHERE status = 'pending'
+                  AND id IN (
+                      SELECT id FROM outbox
+                      WHERE status = 'pending' AND campaign_id = :campaign_id
+                      ORDER BY id
+                      LIMIT :limit
+                  )
+                RETURNING id, campaign_id, payment_id, chat_id, text, reply_markup
+            '''), {'campaign_id': campaign_id, 'limit': limit, 'claimed_at': datetime.now(), 'owner': self.owner}).all()
+        rows.sort(key=lambda row: row.id)
+        return [{
+            'outbox_id': row.id,
+            'campaign_id': row.campaign_id,
+            'payment_id': row.payment_id,
+            'chat_id': row.chat_id,
+            'text': row.text,
+            'reply_markup': InlineKeyboardMarkup.de_json(json.loads(row.reply_markup), None) if row.reply_markup else None,
+        } for row in rows]
+
+    def counts(self, campaign_id):
+        """Сколько сообщений кампании в каждом статусе"""
+        with self.engine.connect() as conn:
+            return dict(conn.execute(text(
+                'SELECT status, COUNT(*) FROM outbox WHERE campaign_id = :campaign_id GROUP BY status'
+            ), {'campaign_id': campaign_id}).all())
+
+    def record_result(self, message, error):
+        """Отметить результат отправки; вызывается доставкой сразу после каждого сообщения.
+
+        После временной ошибки сообщение возвращается в pending, пока число
+        попыток меньше OUTBOX_MAX_ATTEMPTS: его возьмет следующая пачка,
+        повторный запуск или продолжение кампании после рестарта.
+        """
+        if not error:
+            status = 'sent'
+        elif is_transient(error):
+            status = 'retry'
+        else:
+            status = 'failed'
+        with self.engine.begin() as conn:
+            conn.execute(text('''
+                UPDATE outbox
+                SET status = CASE
+                        WHEN :status = 'retry' AND attempts + 1 < :max_attempts THEN 'pending'
+                        WHEN :status = 'retry' THEN 'failed'
+                        ELSE :status
+                    END,
+                    attempts = attempts + 1,
+                    last_error = :last_error,
+                    sent_at = :sent_at,
+                    claimed_at = NULL,
+                    claimed_by = NULL
+                WHERE id = :outbox_id
+            '''), {
+                'status': status,
+                'max_attempts': OUTBOX_MAX_ATTEMPTS,
+                'last_error': str(error) if error else None,
+                'sent_at': None if error else datetime.now(),
+                'outbox_id': message['outbox_id'],
+            })
+
+    def cancel(self, campaign_id):
+        """Снять с очереди неотправленные сообщения кампании, чтобы их не дослали при рестарте"""
+        with self.engine.begin() as conn:
+            return conn.execute(text('''
+                UPDATE outbox
+                SET status = 'cancelled', claimed_at = NULL, claimed_by = NULL
+                WHERE campaign_id = :campaign_id AND status IN ('pending', 'sending')
+            '''), {'campaign_id': campaign_id}).rowcount
+
+    def reclaim_stale(self, timeout=OUTBOX_CLAIM_TIMEOUT, active_campaigns=()):
+        """Вернуть в pending брошенные сообщения из sending и вернуть их число.
+
+        Брошенными считаются строки, взятые больше timeout секунд назад
+        (процесс упал или был перезапущен), и строки этого процесса из
+        кампаний, которые он сейчас не отправляет (упал процесс-исполнитель
+        ShardedDelivery). active_campaigns - кампании, идущие в этом процессе:
+        их строки в работе, даже если они старше timeout.
+        """
+        sql = '''
+            UPDATE outbox
+            SET status = 'pending', claimed_at = NULL, claimed_by = NULL
+            WHERE status = 'sending'
+              AND (claimed_at < :stale_before OR claimed_by IS NULL OR claimed_by = :owner)
+        '''
+        params = {'stale_before': datetime.now() - timedelta(seconds=timeout), 'owner': self.owner}
+        statement = text(sql)
+        if active_campaigns:
+            statement = text(sql + ' AND NOT (claimed_by = :owner AND campaign_id IN :active_campaigns)')
+            statement = statement.bindparams(bindparam('active_campaigns', expanding=True))
+            params['active_campaigns'] = list(active_campaigns)
+        with self.engine.begin() as conn:
+            count = conn.execute(statement, params).rowcount
+        if count:
+            logger.warning(f'Возвращено в очередь брошенных сообщений: {count}')
+        return count
+
+    def unfinished_campaigns(self, timeout=OUTBOX_CLAIM_TIMEOUT):
+        """Кампании с неотправленными сообщениями: pending или брошенными в sending"""
+        with self.engine.connect() as conn:
+            return list(conn.execute(text('''
+                SELECT DISTINCT campaign_id FROM outbox WHERE status = 'pending'
+                UNION
+                SELECT DISTINCT campaign_id FROM outbox WHERE status = 'sending' AND claimed_at < :stale_before
+            '''), {'stale_before': datetime.now() - timedelta(seconds=timeout)}).scalars())
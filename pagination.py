@@ -0,0 +1,55 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+PAGE_SIZE = 10
+
+
+def page_callback(view, page, direction, key):
+    """callback_data кнопки перехода: page_<view>_<номер>_<n|p>_<ключ>"""
+    return f'page_{view}_{page}_{direction}_{key}'
+
+
+def parse_page_callback(data):
+    """Разобрать callback_data кнопки в (view, номер страницы, направление, ключ)"""
+    _, view, page, direction, key = data.split('_', 4)
+    return view, int(page), direction, key
+
+
+class Paginator:
+    """Keyset-пагинация: страница - это один запрос на PAGE_SIZE + 1 строк
+    после (или перед) ключа соседней страницы, без OFFSET и COUNT.
+
+    fetch(after=..., before=..., limit=...) возвращает строки по порядку,
+    row_key(row) превращает строку в ключ для callback_data, parse_key -
+    обратно в значение для fetch.
+    """
+
+    def __init__(self, view, fetch, row_key, parse_key, page_size=PAGE_SIZE):
+        self.view = view
+        self.fetch = fetch
+        self.row_key = row_key
+        self.parse_key = parse_key
+        self.page_size = page_size
+
+    def get_page(self, page=1, direction='n', key=None):
+        """Вернуть (строки страницы, клавиатура навигации или None)"""
+        cursor = self.parse_key(key) if key else None
+        if direction == 'p':
+            rows = self.fetch(before=cursor, limit=self.page_size + 1)
+            # Лишняя строка (первая) только показывает, что страница не первая
+            rows = rows[-self.page_size:]
+            has_next = True
+        else:
+            rows = self.fetch(after=cursor, limit=self.page_size + 1)
+            has_next = len(rows) > self.page_size
+            rows = rows[:self.page_size]
+
+        buttons = []
+        if rows and page > 1:
+            buttons.append(InlineKeyboardButton(
+                '◀️', callback_data=page_callback(self.view, page - 1, 'p', self.row_key(rows[0]))
+            ))
+        if rows and has_next:
+            buttons.append(InlineKeyboardButton(
+                '▶️', callback_data=page_callback(self.view, page + 1, 'n', self.row_key(rows[-1]))
+            ))
+        return rows, InlineKeyboardMarkup([buttons]) if buttons else None
@@ -0,0 +1,102 @@
+import logging
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Итоги платежей по (месяц, школа, класс). Обновляются в той же транзакции,
+# что и сами платежи; родители без класса попадают в школу 0 и класс 0.
+SUMMARY_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS payment_summary (
+        month VARCHAR(7) NOT NULL,
+        school_id INTEGER NOT NULL,
+        grade_id INTEGER NOT NULL,
+        payments_count INTEGER NOT NULL DEFAULT 0,
+        expected_amount INTEGER NOT NULL DEFAULT 0,
+        paid_count INTEGER NOT NULL DEFAULT 0,
+        paid_sum INTEGER NOT NULL DEFAULT 0,
+        receipt_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (month, school_id, grade_id)
+    )
+'''
+
+SUMMARY_COLUMNS = '''
+    payment_summary (
+        month, school_id, grade_id, payments_count, expected_amount, paid_count, paid_sum, receipt_count
+    )
+'''
+
+# Хвост INSERT ... SELECT: строки из SELECT прибавляются к существующим итогам
+SUMMARY_UPSERT = '''
+    ON CONFLICT (month, school_id, grade_id) DO UPDATE SET
+        payments_count = payment_summary.payments_count + excluded.payments_count,
+        expected_amount = payment_summary.expected_amount + excluded.expected_amount,
+        paid_count = payment_summary.paid_count + excluded.paid_count,
+        paid_sum = payment_summary.paid_sum + excluded.paid_sum,
+        receipt_count = payment_summary.receipt_count + excluded.receipt_count
+'''
+
+# Изменение итогов одним платежом: :payments, :paid и :receipts - +1, 0 или -1
+PAYMENT_DELTA_SQL = f'''
+    INSERT INTO {SUMMARY_COLUMNS}
+    SELECT
+        pay.month,
+        COALESCE(g.school_id, 0),
+        COALESCE(par.grade_id, 0),
+        :payments,
+        :payments * pay.amount,
+        :paid,
+        :paid * pay.amount,
+        :receipts
+    FROM payments pay
+    JOIN parents par ON par.id = pay.parent_id
+    LEFT JOIN grades g ON g.id = par.grade_id
+    WHERE pay.id = :payment_id
+    {SUMMARY_UPSERT}
+'''
+
+# Итоги, посчитанные заново по таблице payments
+REBUILD_SQL = f'''
+    INSERT INTO {SUMMARY_COLUMNS}
+    SELECT
+        pay.month,
+        COALESCE(g.school_id, 0),
+        COALESCE(par.grade_id, 0),
+        COUNT(*),
+        COALESCE(SUM(pay.amount), 0),
+        SUM(CASE WHEN pay.is_paid THEN 1 ELSE 0 END),
+        COALESCE(SUM(CASE WHEN pay.is_paid THEN pay.amount ELSE 0 END), 0),
+        SUM(CASE WHEN pay.is_paid AND pay.is_receipt_sent THEN 1 ELSE 0 END)
+    FROM payments pay
+    JOIN parents par ON par.id = pay.parent_id
+    LEFT JOIN grades g ON g.id = par.grade_id
+    {{where}}
+    GROUP BY pay.month, COALESCE(g.school_id, 0), COALESCE(par.grade_id, 0)
+'''
+
+
+def payment_delta(payment_id, payments=0, paid=0, receipts=0):
+    """Параметры PAYMENT_DELTA_SQL"""
+    return {'payment_id': payment_id, 'payments': payments, 'paid': paid, 'receipts': receipts}
+
+
+def add_payment_delta(conn, payment_id, payments=0, paid=0, receipts=0):
+    """Учесть в итогах изменение одного платежа в транзакции conn"""
+    conn.execute(text(PAYMENT_DELTA_SQL), payment_delta(payment_id, payments, paid, receipts))
+
+
+def rebuild_summary(conn, month=None):
+    """Пересчитать итоги за месяц (или за все время) по таблице payments.
+
+    Нужен после изменений платежей в обход PaymentQueries: ручной правки
+    базы, импорта старых данных, смены класса у родителя.
+    Возвращает число строк итогов.
+    """
+    if month:
+        conn.execute(text('DELETE FROM payment_summary WHERE month = :month'), {'month': month})
+        result = conn.execute(text(REBUILD_SQL.format(where='WHERE pay.month = :month')), {'month': month})
+    else:
+        conn.execute(text('DELETE FROM payment_summary'))
+        result = conn.execute(text(REBUILD_SQL.format(where='')))
+    logger.info(f'Итоги платежей пересчитаны{f" за {month}" if month else ""}: {result.rowcount} строк')
+    return result.rowcount
@@ -0,0 +1,317 @@
+import json
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import text
+from telegram.ext import BasePersistence
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Где хранить состояние диалогов и user_data: 'sql' - таблица bot_state в основной БД,
+# 'redis' - Redis по REDIS_URL, 'memory' - заглушка Redis в памяти процесса (для разработки)
+STATE_BACKEND = getattr(config, 'STATE_BACKEND', 'sql')
+REDIS_URL = getattr(config, 'REDIS_URL', 'redis://localhost:6379/0')
+# Изменения копятся в памяти и записываются одной пачкой раз в столько секунд
+STATE_FLUSH_INTERVAL = getattr(config, 'STATE_FLUSH_INTERVAL', 1.0)
+# Несколько экземпляров бота за одним webhook: перед каждым обновлением
+# состояние пользователя перечитывается из хранилища
+STATE_SHARED = getattr(config, 'STATE_SHARED', False)
+
+
+class SQLStateStore:
+    """Состояние в таблице bot_state: одна строка на (namespace, key), значение в JSON.
+    Таблицу создает миграция 009 (migrations.py)"""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def load(self, namespace):
+        with self.engine.connect() as conn:
+            return dict(conn.execute(text(
+                'SELECT key, value FROM bot_state WHERE namespace = :namespace'
+            ), {'namespace': namespace}).all())
+
+    def get(self, namespace, key):
+        with self.engine.connect() as conn:
+            return conn.execute(text(
+                'SELECT value FROM bot_state WHERE namespace = :namespace AND key = :key'
+            ), {'namespace': namespace, 'key': key}).scalar()
+
+    def write(self, items):
+        """items: {(namespace, key): JSON или None для удаления} - одной транзакцией"""
+        now = datetime.now()
+        upserts = [
+            {'namespace': namespace, 'key': key, 'value': value, 'updated_at': now}
+            for (namespace, key), value in items.items() if value is not None
+        ]
+        deletes = [
+            {'namespace': namespace, 'key': key}
+            for (namespace, key), value in items.items() if value is None
+        ]
+        with self.engine.begin() as conn:
+            if upserts:
+                conn.execute(text('''
+                    INSERT INTO bot_state (namespace, key, value, updated_at)
+                    VALUES (:namespace, :key, :value, :updated_at)
+                    ON CONFLICT (namespace, key) DO UPDATE
+                    SET value = excluded.value, updated_at = excluded.updated_at
+                '''), upserts)
+            if deletes:
+                conn.execute(text(
+                    'DELETE FROM bot_state WHERE namespace = :namespace AND key = :key'
+                ), deletes)
+
+
+class RedisStateStore:
+    """Состояние в Redis: один хэш на namespace, значение в JSON"""
+
+    def __init__(self, client, prefix='payment_bot'):
+        self.client = client
+        self.prefix = prefix
+
+    def _hash(self, namespace):
+        return f'{self.prefix}:{namespace}'
+
+    @staticmethod
+    def _decode(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def load(self, namespace):
+        return {
+            self._decode(key): self._decode(value)
+            for key, value in self.client.hgetall(self._hash(namespace)).items()
+        }
+
+    def get(self, namespace, key):
+        return self._decode(self.client.hget(self._hash(namespace), key))
+
+    def write(self, items):
+        pipeline = self.client.pipeline()
+        for (namespace, key), value in items.items():
+            if value is None:
+                pipeline.hdel(self._hash(namespace), key)
+            else:
+                pipeline.hset(self._hash(namespace), key, value)
+        pipeline.execute()
+
+
+class LocalRedis:
+    """Заглушка Redis в памяти процесса: hget, hgetall, hset, hdel и pipeline
+    из redis-py. Для запуска без Redis; между процессами состояние не делит."""
+
+    def __init__(self):
+        self.hashes = defaultdict(dict)
+        self.lock = threading.Lock()
+
+    def hget(self, name, key):
+        with self.lock:
+            return self.hashes[name].get(key)
+
+    def hgetall(self, name):
+        with self.lock:
+            return dict(self.hashes[name])
+
+    def hset(self, name, key, value):
+        with self.lock:
+            self.hashes[name][key] = value
+
+    def hdel(self, name, key):
+        with self.lock:
+            self.hashes[name].pop(key, None)
+
+    def pipeline(self):
+        return _LocalPipeline(self)
+
+
+class _LocalPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def hset(self, name, key, value):
+        self.commands.append((self.client.hset, (name, key, value)))
+
+    def hdel(self, name, key):
+        self.commands.append((self.client.hdel, (name, key)))
+
+    def execute(self):
+        with self.client.lock:
+            commands, self.commands = self.commands, []
+        for command, args in commands:
+            command(*args)
+
+
+class SharedConversations(dict):
+    """Состояния ConversationHandler: при STATE_SHARED отсутствующий ключ
+    ищется в хранилище - диалог мог начаться в другом экземпляре бота"""
+
+    def __init__(self, persistence, name, states):
+        super().__init__(states)
+        self.persistence = persistence
+        self.name = name
+
+    def get(self, key, default=None):
+        if self.persistence.shared:
+            state = self.persistence.read_conversation(self.name, key)
+            if state is None:
+                super().pop(key, None)
+                return default
+            super().__setitem__(key, state)
+            return state
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __delitem__(self, key):
+        super().pop(key, None)
+
+
+class BotStatePersistence(BasePersistence):
+    """Хранение user_data и состояний ConversationHandler с отложенной записью.
+
+    python-telegram-bot сообщает об изменениях после каждого обновления;
+    здесь они только запоминаются, а фоновый поток раз в flush_interval
+    записывает все накопившиеся изменения одной транзакцией. Неизменившиеся
+    данные не записываются вовсе. При остановке Updater вызывает flush().
+
+    При shared запись сквозная: другой экземпляр бота может получить
+    следующее обновление того же пользователя раньше, чем истечет
+    flush_interval, и должен прочитать уже записанное состояние.
+    """
+
+    def __init__(self, store, flush_interval=STATE_FLUSH_INTERVAL, shared=STATE_SHARED):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.state_store = store
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.lock = threading.Lock()
+        # (namespace, key) -> JSON, ожидающий записи (None - удалить)
+        self.pending = {}
+        # (namespace, key) -> последний известный JSON, чтобы не писать то же самое
+        self.known = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._flush_loop, name='state-flush', daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _encode(value):
+        return json.dumps(value, ensure_ascii=False, sort_keys=True) if value is not None else None
+
+    @staticmethod
+    def _conversation_key(key):
+        return ':'.join(map(str, key))
+
+    def _read(self, namespace, key):
+        with self.lock:
+            if (namespace, key) in self.pending:
+                value = self.pending[(namespace, key)]
+                return json.loads(value) if value is not None else None
+        value = self.state_store.get(namespace, key)
+        with self.lock:
+            if (namespace, key) not in self.pending:
+                self.known[(namespace, key)] = value
+        return json.loads(value) if value is not None else None
+
+    def _write(self, namespace, key, value):
+        encoded = self._encode(value)
+        with self.lock:
+            if self.known.get((namespace, key)) == encoded:
+                return
+            self.known[(namespace, key)] = encoded
+            self.pending[(namespace, key)] = encoded
+        if self.shared:
+            self._write_pending()
+
+    def _load(self, namespace):
+        values = self.state_store.load(namespace)
+        with self.lock:
+            for key, value in values.items():
+                self.known[(namespace, key)] = value
+        return {key: json.loads(value) for key, value in values.items()}
+
+    def get_user_data(self):
+        user_data = defaultdict(dict)
+        for user_id, data in self._load('user_data').items():
+            user_data[int(user_id)] = data
+        return user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        states = {
+            tuple(int(part) for part in key.split(':')): state
+            for key, state in self._load(f'conversation:{name}').items()
+        }
+        return SharedConversations(self, name, states)
+
+    def read_conversation(self, name, key):
+        return self._read(f'conversation:{name}', self._conversation_key(key))
+
+    def update_conversation(self, name, key, new_state):
+        if isinstance(new_state, tuple):
+            # (старое состояние, Promise) у run_async-обработчиков: сохраняем старое
+            new_state = new_state[0]
+        self._write(f'conversation:{name}', self._conversation_key(key), new_state)
+
+    def update_user_data(self, user_id, data):
+        self._write('user_data', str(user_id), dict(data) or None)
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def refresh_user_data(self, user_id, user_data):
+        if not self.shared:
+            return
+        data = self._read('user_data', str(user_id)) or {}
+        user_data.clear()
+        user_data.update(data)
+
+    def _flush_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            self._write_pending()
+
+    def _write_pending(self):
+        with self.lock:
+            items, self.pending = self.pending, {}
+        if not items:
+            return
+        try:
+            self.state_store.write(items)
+        except Exception as e:
+            logger.error(f'Не удалось сохранить состояние диалогов ({len(items)} записей): {e}')
+            with self.lock:
+                # Более новые изменения, пришедшие за это время, важнее
+                for key, value in items.items():
+                    self.pending.setdefault(key, value)
+
+    def flush(self):
+        """Записать все накопленные изменения; вызывается при остановке бота"""
+        self.stopped.set()
+        self._write_pending()
+
+
+def create_persistence(engine, backend=STATE_BACKEND):
+    """BotStatePersistence с хранилищем из STATE_BACKEND"""
+    if backend == 'redis':
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('Для STATE_BACKEND = "redis" установите redis: pip install redis')
+        store = RedisStateStore(redis.Redis.from_url(REDIS_URL))
+    elif backend == 'memory':
+        store = RedisStateStore(LocalRedis())
+    else:
+        store = SQLStateStore(engine)
+    return BotStatePersistence(store)
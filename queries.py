@@ -0,0 +1,446 @@
+from datetime import datetime, timedelta, time as dt_time
+
+from sqlalchemy import text, DateTime
+
+from db_session import get_engine
+from payment_summary import SUMMARY_COLUMNS, SUMMARY_UPSERT, add_payment_delta, rebuild_summary
+
+# День месяца, до которого нужно оплатить занятия
+DUE_DAY = 10
+
+
+def add_months(month, count=1):
+    """Сдвинуть месяц вида 'YYYY-MM' на count календарных месяцев"""
+    year, month_number = map(int, month.split('-'))
+    index = year * 12 + (month_number - 1) + count
+    return f'{index // 12:04d}-{index % 12 + 1:02d}'
+
+
+# Карточки родителя для /start, по одной на ребенка; тот же запрос выполняет асинхронный режим
+PARENT_CARD_SQL = '''
+    SELECT
+        par.first_name,
+        par.child_name,
+        par.phone_number,
+        g.grade_name,
+        g.monthly_payment,
+        s.name AS school_name
+    FROM parents par
+    LEFT JOIN grades g ON g.id = par.grade_id
+    LEFT JOIN schools s ON s.id = g.school_id
+    WHERE par.chat_id = :chat_id
+    ORDER BY par.id
+'''
+
+
+class PaymentQueries:
+    """Массовые запросы к платежам, собранные в один SQL-запрос каждый"""
+
+    def __init__(self, engine=None):
+        self.engine = engine or get_engine()
+
+    def ensure_schema(self):
+        """Индексы и ограничения, на которые опираются запросы (см. migrations.py)"""
+        from migrations import apply_migrations
+        return apply_migrations(self.engine)
+
+    def _fetch_all(self, sql, **params):
+        """Выполнить SELECT и вернуть строки в виде словарей"""
+        statement = text(sql).columns(due_date=DateTime, payment_date=DateTime)
+        with self.engine.connect() as conn:
+            return [dict(row._mapping) for row in conn.execute(statement, params)]
+
+    def get_parent_cards(self, chat_id):
+        """Строки родителя по chat_id (по одной на ребенка) вместе с классом
+        и школой; пустой список, если chat_id не привязан"""
+        return self._fetch_all(PARENT_CARD_SQL, chat_id=chat_id)
+
+    def get_reminder_batch(self):
+        """Самый старый неоплаченный платеж каждого родителя с chat_id,
+        вместе с названиями школы и класса"""
+        return self._fetch_all('''
+            SELECT
+                pay.id AS payment_id,
+                pay.month,
+                pay.amount,
+                pay.due_date,
+                par.id AS parent_id,
+                par.first_name,
+                par.child_name,
+                par.chat_id,
+                g.grade_name,
+                s.name AS school_name
+            FROM (
+                SELECT
+                    p.*,
+                    ROW_NUMBER() OVER (PARTITION BY p.parent_id ORDER BY p.month, p.id) AS rn
+                FROM payments p
+                WHERE NOT p.is_paid
+            ) pay
+            JOIN parents par ON par.id = pay.parent_id
+            LEFT JOIN grades g ON g.id = par.grade_id
+            LEFT JOIN schools s ON s.id = g.school_id
+            WHERE pay.rn = 1
+              AND par.chat_id IS NOT NULL
+              AND par.is_active
+            ORDER BY par.id
+        ''')
+
+    def get_unpaid_reminders(self):
+        """Все неоплаченные платежи активных родителей с chat_id, вместе
+        с названиями школы и класса - по строке на напоминание"""
+        return self._fetch_all('''
+            SELECT
+                pay.id AS payment_id,
+                pay.month,
+                pay.amount,
+                pay.due_date,
+                par.id AS parent_id,
+                par.first_name,
+                par.child_name,
+                par.chat_id,
+                g.grade_name,
+                s.name AS school_name
+            FROM payments pay
+            JOIN parents par ON par.id = pay.parent_id
+            LEFT JOIN grades g ON g.id = par.grade_id
+            LEFT JOIN schools s ON s.id = g.school_id
+            WHERE NOT pay.is_paid
+              AND par.chat_id IS NOT NULL
+              AND par.is_active
+            ORDER BY par.id, pay.id
+        ''')
+
+    def get_reminders_due_on(self, dates):
+        """Неоплаченные платежи со сроком оплаты в один из дней dates у родителей
+        с chat_id, вместе с названиями школы и класса"""
+        dates = sorted(dates)
+        ranges = ' OR '.join(f'(pay.due_date >= :from_{i} AND pay.due_date < :to_{i})' for i in range(len(dates)))
+        params = {}
+        for i, day in enumerate(dates):
+            params[f'from_{i}'] = datetime.combine(day, dt_time.min)
+            params[f'to_{i}'] = datetime.combine(day + timedelta(days=1), dt_time.min)
+        return self._fetch_all(f'''
+            SELECT
+                pay.id AS payment_id,
+                pay.month,
+                pay.amount,
+                pay.due_date,
+                par.id AS parent_id,
+                par.first_name,
+                par.child_name,
+                par.chat_id,
+                g.grade_name,
+                s.name AS school_name
+            FROM payments pay
+            JOIN parents par ON par.id = pay.parent_id
+            LEFT JOIN grades g ON g.id = par.grade_id
+            LEFT JOIN schools s ON s.id = g.school_id
+            WHERE NOT pay.is_paid
+              AND ({ranges})
+              AND par.chat_id IS NOT NULL
+              AND par.is_active
+            ORDER BY par.id, pay.id
+        ''', **params)
+
+    def get_payment_report(self, is_paid, month=None, after=None, before=None, limit=None):
+        """Оплаченные или неоплаченные платежи (за месяц или за все время)
+        вместе с данными родителя, ребенка, школы и класса.
+
+        Сортировка (month DESC, id). after/before - ключ (month, payment_id)
+        соседней страницы для keyset-пагинации, limit - размер страницы.
+        """
+        filters = ['pay.is_paid = :is_paid']
+        order = 'pay.month DESC, pay.id'
+        params = {'is_paid': is_paid}
+        if month:
+            filters.append('pay.month = :month')
+            params['month'] = month
+        if after:
+            filters.append('(pay.month < :cursor_month OR (pay.month = :cursor_month AND pay.id > :cursor_id))')
+            params['cursor_month'], params['cursor_id'] = after
+        elif before:
+            # Предыдущая страница: идем в обратном порядке и разворачиваем результат
+            filters.append('(pay.month > :cursor_month OR (pay.month = :cursor_month AND pay.id < :cursor_id))')
+            params['cursor_month'], params['cursor_id'] = before
+            order = 'pay.month, pay.id DESC'
+        limit_clause = ''
+        if limit:
+            limit_clause = 'LIMIT :limit'
+            params['limit'] = limit
+
+        rows = self._fetch_all(f'''
+            SELECT
+                pay.id AS payment_id,
+                pay.month,
+                pay.amount,
+                pay.payment_date,
+                pay.is_receipt_sent,
+                par.id AS parent_id,
+                TRIM(par.first_name || ' ' || COALESCE(par.last_name, '')) AS parent_name,
+                par.child_name,
+                par.phone_number,
+                g.grade_name,
+                s.name AS school_name
+            FROM payments pay
+            JOIN parents par ON par.id = pay.parent_id
+            LEFT JOIN grades g ON g.id = par.grade_id
+            LEFT JOIN schools s ON s.id = g.school_id
+            WHERE {' AND '.join(filters)}
+            ORDER BY {order}
+            {limit_clause}
+        ''', **params)
+        return rows[::-1] if before else rows
+
+    def get_parents_page(self, after=None, before=None, limit=None):
+        """Активные родители с классом и школой, по возрастанию id,
+        начиная после after или заканчивая перед before"""
+        filters = ['par.is_active']
+        order = 'par.id'
+        params = {}
+        if after:
+            filters.append('par.id > :cursor_id')
+            params['cursor_id'] = after
+        elif before:
+            filters.append('par.id < :cursor_id')
+            params['cursor_id'] = before
+            order = 'par.id DESC'
+        limit_clause = ''
+        if limit:
+            limit_clause = 'LIMIT :limit'
+            params['limit'] = limit
+
+        rows = self._fetch_all(f'''
+            SELECT
+                par.id AS parent_id,
+                par.first_name,
+                par.child_name,
+                par.phone_number,
+                par.chat_id,
+                g.grade_name,
+                g.monthly_payment,
+                s.name AS school_name
+            FROM parents par
+            LEFT JOIN grades g ON g.id = par.grade_id
+            LEFT JOIN schools s ON s.id = g.school_id
+            WHERE {' AND '.join(filters)}
+            ORDER BY {order}
+            {limit_clause}
+        ''', **params)
+        return rows[::-1] if before else rows
+
+    def get_statistics(self, month):
+        """Все счетчики для /stats и /admin одним запросом по итогам payment_summary"""
+        return self._fetch_all('''
+            SELECT
+                (SELECT COUNT(*) FROM parents WHERE is_active) AS parents,
+                (SELECT COUNT(*) FROM schools) AS schools,
+                COALESCE(SUM(ps.payments_count - ps.paid_count), 0) AS unpaid_total,
+                COALESCE(SUM(CASE WHEN ps.month = :month THEN ps.payments_count - ps.paid_count ELSE 0 END), 0) AS unpaid_month,
+                COALESCE(SUM(CASE WHEN ps.month = :month THEN ps.paid_count ELSE 0 END), 0) AS paid_month,
+                COALESCE(SUM(ps.paid_count), 0) AS paid_total,
+                COALESCE(SUM(ps.receipt_count), 0) AS paid_with_receipt
+            FROM payment_summary ps
+        ''', month=month)[0]
+
+    def get_school_revenue(self, month):
+        """Начислено и оплачено за месяц по каждой школе"""
+        return self._fetch_all('''
+            SELECT
+                ps.school_id,
+                COALESCE(s.name, 'Без школы') AS school_name,
+                SUM(ps.payments_count) AS payments_count,
+                SUM(ps.expected_amount) AS expected_amount,
+                SUM(ps.paid_count) AS paid_count,
+                SUM(ps.paid_sum) AS paid_sum,
+                SUM(ps.receipt_count) AS receipt_count
+            FROM payment_summary ps
+            LEFT JOIN schools s ON s.id = ps.school_id
+            WHERE ps.month = :month
+            GROUP BY ps.school_id, s.name
+            ORDER BY school_name
+        ''', month=month)
+
+    def get_grade_report(self, month):
+        """Итоги за месяц по каждому классу каждой школы, по порядку школ и классов"""
+        return self._fetch_all('''
+            SELECT
+                ps.school_id,
+                COALESCE(s.name, 'Без школы') AS school_name,
+                ps.grade_id,
+                COALESCE(g.grade_name, 'Без класса') AS grade_name,
+                ps.payments_count,
+                ps.paid_count,
+                ps.expected_amount,
+                ps.paid_sum,
+                ps.expected_amount - ps.paid_sum AS outstanding,
+                ps.receipt_count
+            FROM payment_summary ps
+            LEFT JOIN schools s ON s.id = ps.school_id
+            LEFT JOIN grades g ON g.id = ps.grade_id
+            WHERE ps.month = :month
+              AND ps.payments_count > 0
+            ORDER BY ps.school_id, ps.grade_id
+        ''', month=month)
+
+    def iter_month_payments(self, month, batch_size=1000):
+        """Все платежи месяца со школой, классом и родителем - по одной строке,
+        без загрузки всего результата в память"""
+        statement = text('''
+            SELECT
+                COALESCE(s.name, 'Без школы') AS school_name,
+                COALESCE(g.grade_name, 'Без класса') AS grade_name,
+                pay.id AS payment_id,
+                TRIM(par.first_name || ' ' || COALESCE(par.last_name, '')) AS parent_name,
+                par.child_name,
+                par.phone_number,
+                pay.amount,
+                pay.is_paid,
+                pay.payment_date,
+                pay.is_receipt_sent
+            FROM payments pay
+            JOIN parents par ON par.id = pay.parent_id
+            LEFT JOIN grades g ON g.id = par.grade_id
+            LEFT JOIN schools s ON s.id = g.school_id
+            WHERE pay.month = :month
+            ORDER BY g.school_id, par.grade_id, pay.id
+        ''').columns(payment_date=DateTime)
+        with self.engine.connect() as conn:
+            result = conn.execution_options(yield_per=batch_size).execute(statement, {'month': month})
+            for row in result:
+                yield row._mapping
+
+    def rebuild_summary(self, month=None):
+        """Пересчитать payment_summary по таблице payments (см. payment_summary.py)"""
+        with self.engine.begin() as conn:
+            return rebuild_summary(conn, month)
+
+    def has_unpaid_due_on(self, dates):
+        """Есть ли неоплаченные платежи со сроком оплаты в один из дней dates"""
+        dates = sorted(dates)
+        rows = self._fetch_all('''
+            SELECT DISTINCT due_date
+            FROM payments
+            WHERE NOT is_paid
+              AND due_date >= :date_from
+              AND due_date < :date_to
+        ''', date_from=datetime.combine(dates[0], dt_time.min),
+             date_to=datetime.combine(dates[-1] + timedelta(days=1), dt_time.min))
+        return any(row['due_date'].date() in dates for row in rows)
+
+    def create_monthly_payments(self, month, dry_run=False):
+        """Создать платежи на месяц всем активным родителям одним INSERT ... SELECT.
+
+        Возвращает (количество, сумма). С dry_run=True ничего не записывает,
+        а только считает, сколько платежей будет создано. Повторный запуск
+        за тот же месяц ничего не создает благодаря ux_payments_parent_month.
+        Итоги payment_summary обновляются в той же транзакции.
+        """
+        missing_payments = '''
+            FROM parents par
+            JOIN grades g ON g.id = par.grade_id
+            WHERE par.is_active
+              AND NOT EXISTS (
+                  SELECT 1 FROM payments pay
+                  WHERE pay.parent_id = par.id AND pay.month = :month
+              )
+        '''
+        year, month_number = map(int, month.split('-'))
+        params = {
+            'month': month,
+            'due_date': datetime(year, month_number, DUE_DAY),
+            'is_paid': False,
+        }
+
+        with self.engine.begin() as conn:
+            count, total = conn.execute(text(
+                f'SELECT COUNT(*), COALESCE(SUM(g.monthly_payment), 0) {missing_payments}'
+            ), params).one()
+            if dry_run or not count:
+                return count, total
+
+            conn.execute(text(f'''
+                INSERT INTO {SUMMARY_COLUMNS}
+                SELECT :month, COALESCE(g.school_id, 0), g.id, COUNT(*), SUM(g.monthly_payment), 0, 0, 0
+                {missing_payments}
+                GROUP BY COALESCE(g.school_id, 0), g.id
+                {SUMMARY_UPSERT}
+            '''), params)
+
+            # Параллельный запуск мог успеть создать часть платежей,
+            # поэтому итог считается по реально вставленным строкам
+            amounts = conn.execute(text(f'''
+                INSERT INTO payments (parent_id, month, amount, due_date, is_paid, is_receipt_sent)
+                SELECT par.id, :month, g.monthly_payment, :due_date, :is_paid, :is_paid
+                {missing_payments}
+                ON CONFLICT (parent_id, month) DO NOTHING
+                RETURNING amount
+            '''), params).scalars().all()
+            if len(amounts) != count:
+                rebuild_summary(conn, month)
+            return len(amounts), sum(amounts)
+
+    def add_parent(self, first_name, child_name, grade_id, last_name=None, phone_number=None,
+                   telegram_username=None, chat_id=None):
+        """Добавить активного родителя одним INSERT; возвращает его id"""
+        with self.engine.begin() as conn:
+            return conn.execute(text('''
+                INSERT INTO parents
+                    (first_name, last_name, child_name, grade_id, phone_number,
+                     telegram_username, chat_id, is_active)
+                VALUES
+                    (:first_name, :last_name, :child_name, :grade_id, :phone_number,
+                     :telegram_username, :chat_id, :is_active)
+                RETURNING id
+            '''), {
+                'first_name': first_name, 'last_name': last_name, 'child_name': child_name,
+                'grade_id': grade_id, 'phone_number': phone_number,
+                'telegram_username': telegram_username, 'chat_id': chat_id, 'is_active': True,
+            }).scalar()
+
+    def mark_payment_paid(self, payment_id, chat_id):
+        """Отметить платеж родителя с chat_id оплаченным.
+
+        Условный UPDATE: повторное или одновременное нажатие ничего не меняет.
+        Возвращает 'paid', 'already_paid' или 'not_found'.
+        """
+        with self.engine.begin() as conn:
+            result = conn.execute(text('''
+                UPDATE payments
+                SET is_paid = :is_paid, payment_date = :payment_date
+                WHERE id = :payment_id
+                  AND NOT is_paid
+                  AND parent_id IN (SELECT id FROM parents WHERE chat_id = :chat_id)
+            '''), {'is_paid': True, 'payment_date': datetime.now(), 'payment_id': payment_id, 'chat_id': chat_id})
+            if result.rowcount:
+                add_payment_delta(conn, payment_id, paid=1)
+                return 'paid'
+            already_paid = conn.execute(text('''
+                SELECT 1 FROM payments
+                WHERE id = :payment_id
+                  AND is_paid
+                  AND parent_id IN (SELECT id FROM parents WHERE chat_id = :chat_id)
+            '''), {'payment_id': payment_id, 'chat_id': chat_id}).first()
+            return 'already_paid' if already_paid else 'not_found'
+
+    def mark_receipt_sent(self, payment_id, chat_id):
+        """Отметить, что по оплаченному платежу прислан чек; True, если платеж найден"""
+        with self.engine.begin() as conn:
+            result = conn.execute(text('''
+                UPDATE payments
+                SET is_receipt_sent = :is_receipt_sent
+                WHERE id = :payment_id
+                  AND is_paid
+                  AND NOT is_receipt_sent
+                  AND parent_id IN (SELECT id FROM parents WHERE chat_id = :chat_id)
+            '''), {'is_receipt_sent': True, 'payment_id': payment_id, 'chat_id': chat_id})
+            if result.rowcount:
+                add_payment_delta(conn, payment_id, receipts=1)
+                return True
+            # Повторный чек по тому же платежу: итоги не меняются
+            return conn.execute(text('''
+                SELECT 1 FROM payments
+                WHERE id = :payment_id
+                  AND is_paid
+                  AND parent_id IN (SELECT id FROM parents WHERE chat_id = :chat_id)
+            '''), {'payment_id': payment_id, 'chat_id': chat_id}).first() is not None
@@ -0,0 +1,86 @@
+import threading
+from collections import namedtuple
+
+from sqlalchemy import text
+
+School = namedtuple('School', ['id', 'name'])
+Grade = namedtuple('Grade', ['id', 'school_id', 'grade_name', 'monthly_payment'])
+
+
+class ReferenceCache:
+    """Кэш справочников школ и классов в памяти процесса.
+
+    Данные загружаются двумя запросами при первом обращении и живут до
+    вызова invalidate() (после /init_db или любой записи в справочники).
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._loaded = False
+        self.schools_by_id = {}
+        self.schools_by_name = {}
+        self.grades_by_id = {}
+        self.grades_by_school = {}
+
+    def _ensure_loaded(self):
+        with self.lock:
+            if self._loaded:
+                self.hits += 1
+                return
+            self.misses += 1
+            with self.engine.connect() as conn:
+                schools = [School(*row) for row in conn.execute(text(
+                    'SELECT id, name FROM schools ORDER BY id'
+                ))]
+                grades = [Grade(*row) for row in conn.execute(text(
+                    'SELECT id, school_id, grade_name, monthly_payment FROM grades ORDER BY school_id, id'
+                ))]
+            self.schools_by_id = {school.id: school for school in schools}
+            self.schools_by_name = {school.name: school for school in schools}
+            self.grades_by_id = {grade.id: grade for grade in grades}
+            self.grades_by_school = {}
+            for grade in grades:
+                self.grades_by_school.setdefault(grade.school_id, []).append(grade)
+            self._loaded = True
+
+    def invalidate(self):
+        """Сбросить кэш; следующее обращение перечитает справочники из БД"""
+        with self.lock:
+            self._loaded = False
+
+    def get_schools(self):
+        self._ensure_loaded()
+        return list(self.schools_by_id.values())
+
+    def get_school_by_name(self, name):
+        self._ensure_loaded()
+        return self.schools_by_name.get(name)
+
+    def get_grades_by_school(self, school_id):
+        self._ensure_loaded()
+        return list(self.grades_by_school.get(school_id, []))
+
+    def get_grade_by_name(self, school_id, grade_name):
+        for grade in self.get_grades_by_school(school_id):
+            if grade.grade_name == grade_name:
+                return grade
+        return None
+
+    def get_grade_with_school_info(self, grade_id):
+        """То же, что Database.get_grade_with_school_info, но без запроса к БД"""
+        self._ensure_loaded()
+        grade = self.grades_by_id.get(grade_id)
+        if not grade:
+            return None
+        school = self.schools_by_id.get(grade.school_id)
+        return {
+            'grade_name': grade.grade_name,
+            'monthly_payment': grade.monthly_payment,
+            'school_name': school.name if school else 'не указана'
+        }
+
+    def stats_text(self):
+        return f'🗂 Кэш справочников: попаданий {self.hits}, промахов {self.misses}'
@@ -0,0 +1,152 @@
+import csv
+import logging
+from itertools import groupby
+
+logger = logging.getLogger(__name__)
+
+# Колонки выгрузки: поле строки запроса -> заголовок
+GRADE_COLUMNS = [
+    ('school_name', 'Школа'),
+    ('grade_name', 'Класс'),
+    ('payments_count', 'Платежей'),
+    ('paid_count', 'Оплачено'),
+    ('collection_rate', 'Собираемость, %'),
+    ('expected_amount', 'Начислено, руб.'),
+    ('paid_sum', 'Собрано, руб.'),
+    ('outstanding', 'Долг, руб.'),
+    ('receipt_count', 'С чеками'),
+]
+PAYMENT_COLUMNS = [
+    ('school_name', 'Школа'),
+    ('grade_name', 'Класс'),
+    ('payment_id', 'Платеж'),
+    ('parent_name', 'Родитель'),
+    ('child_name', 'Ребенок'),
+    ('phone_number', 'Телефон'),
+    ('amount', 'Сумма, руб.'),
+    ('is_paid', 'Оплачен'),
+    ('payment_date', 'Дата оплаты'),
+    ('is_receipt_sent', 'Чек'),
+]
+# Школ в сообщении; полный список - в файле
+SUMMARY_SCHOOLS_LIMIT = 40
+
+
+def collection_rate(row):
+    """Доля оплаченных платежей, %"""
+    return round(100 * row['paid_count'] / row['payments_count'], 1) if row['payments_count'] else 0.0
+
+
+def school_totals(grades):
+    """Итоги по школам из строк get_grade_report (они отсортированы по школе)"""
+    schools = []
+    for (school_id, school_name), rows in groupby(grades, key=lambda row: (row['school_id'], row['school_name'])):
+        total = {'school_id': school_id, 'school_name': school_name,
+                 'payments_count': 0, 'paid_count': 0, 'expected_amount': 0, 'paid_sum': 0,
+                 'outstanding': 0, 'receipt_count': 0}
+        for row in rows:
+            for key in ('payments_count', 'paid_count', 'expected_amount', 'paid_sum', 'outstanding', 'receipt_count'):
+                total[key] += row[key]
+        schools.append(total)
+    return schools
+
+
+def summary_text(month, grades):
+    """Короткий отчет для сообщения: общий итог и строка на школу"""
+    schools = school_totals(grades)
+    total = {key: sum(school[key] for school in schools)
+             for key in ('payments_count', 'paid_count', 'expected_amount', 'paid_sum', 'outstanding')}
+
+    text = (
+        f'📊 Финансовый отчет за {month}\n\n'
+        f'💳 Начислено: {total["expected_amount"]} руб. ({total["payments_count"]} платежей)\n'
+        f'✅ Собрано: {total["paid_sum"]} руб. ({total["paid_count"]}, {collection_rate(total)}%)\n'
+        f'❌ Долг: {total["outstanding"]} руб. ({total["payments_count"] - total["paid_count"]} платежей)\n\n'
+        f'🏫 По школам:\n'
+    )
+    for school in schools[:SUMMARY_SCHOOLS_LIMIT]:
+        text += (
+            f'• {school["school_name"]}: {collection_rate(school)}%, '
+            f'собрано {school["paid_sum"]} из {school["expected_amount"]} руб., '
+            f'долг {school["outstanding"]} руб.\n'
+        )
+    if len(schools) > SUMMARY_SCHOOLS_LIMIT:
+        text += f'• ... и еще {len(schools) - SUMMARY_SCHOOLS_LIMIT}\n'
+    text += '\nПо классам и по каждому платежу - в файле.'
+    return text
+
+
+def _grade_values(row):
+    return [collection_rate(row) if field == 'collection_rate' else row[field] for field, _ in GRADE_COLUMNS]
+
+
+def _payment_values(row, date_format=None):
+    values = []
+    for field, _ in PAYMENT_COLUMNS:
+        value = row[field]
+        if field in ('is_paid', 'is_receipt_sent'):
+            value = 'да' if value else 'нет'
+        elif field == 'payment_date' and value and date_format:
+            value = value.strftime(date_format)
+        elif value is None:
+            value = ''
+        values.append(value)
+    return values
+
+
+def write_csv(path, grades, payments):
+    """CSV для Excel (UTF-8 с BOM, разделитель ';'): сначала итоги по классам,
+    после пустой строки - строка на платеж.
+
+    payments - итератор строк, файл пишется по мере чтения из БД.
+    """
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(['Итоги по классам'])
+        writer.writerow([title for _, title in GRADE_COLUMNS])
+        for row in grades:
+            writer.writerow(_grade_values(row))
+        writer.writerow([])
+        writer.writerow(['Платежи'])
+        writer.writerow([title for _, title in PAYMENT_COLUMNS])
+        for row in payments:
+            writer.writerow(_payment_values(row, date_format='%d.%m.%Y'))
+            count += 1
+    return count
+
+
+def write_xlsx(path, grades, payments):
+    """XLSX с листами "Итоги" (по классам) и "Платежи".
+
+    openpyxl в режиме write_only сбрасывает строки во временный файл по мере
+    чтения платежей из БД; в памяти растет только таблица различных строк
+    (имена, телефоны). Для самых больших выгрузок экономнее CSV.
+    """
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise RuntimeError('Для выгрузки XLSX установите openpyxl: pip install openpyxl')
+
+    workbook = Workbook(write_only=True)
+    summary = workbook.create_sheet('Итоги')
+    summary.append([title for _, title in GRADE_COLUMNS])
+    for row in grades:
+        summary.append(_grade_values(row))
+
+    sheet = workbook.create_sheet('Платежи')
+    sheet.append([title for _, title in PAYMENT_COLUMNS])
+    count = 0
+    for row in payments:
+        sheet.append(_payment_values(row))
+        count += 1
+    workbook.save(path)
+    return count
+
+
+def export_report(path, file_format, grades, payments):
+    """Записать отчет в path в формате 'csv' или 'xlsx'; возвращает число платежей"""
+    writer = write_xlsx if file_format == 'xlsx' else write_csv
+    count = writer(path, grades, payments)
+    logger.info(f'Отчет {path}: {count} платежей, {len(grades)} классов')
+    return count
@@ -0,0 +1,163 @@
+import calendar
+import logging
+import time
+from datetime import datetime, timedelta, time as dt_time
+
+import pytz
+from sqlalchemy import text
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Расписание можно переопределить в config.py
+PAYMENTS_DAY = getattr(config, 'PAYMENTS_DAY', 25)
+PAYMENTS_TIME = getattr(config, 'PAYMENTS_TIME', dt_time(9, 0))
+REMINDER_TIME = getattr(config, 'REMINDER_TIME', dt_time(10, 0))
+# Смещения в днях относительно срока оплаты: -3 = за три дня до срока
+REMINDER_DUE_OFFSETS = getattr(config, 'REMINDER_DUE_OFFSETS', (-3, 0, 3))
+REMINDER_WINDOW_MINUTES = getattr(config, 'REMINDER_WINDOW_MINUTES', 60)
+# Часовой пояс, в котором заданы PAYMENTS_TIME, REMINDER_TIME и считается "сегодня".
+# Без него JobQueue запускал бы задачи по UTC, а день проверялся по времени сервера
+TIMEZONE = pytz.timezone(getattr(config, 'TIMEZONE', 'Europe/Moscow'))
+# Повтор упавшей задачи: через сколько минут и сколько раз за период
+RETRY_MINUTES = getattr(config, 'SCHEDULER_RETRY_MINUTES', 15)
+RETRY_ATTEMPTS = getattr(config, 'SCHEDULER_RETRY_ATTEMPTS', 3)
+
+
+def local_time(value):
+    """Время запуска в часовом поясе TIMEZONE, если пояс не указан явно"""
+    return value if value.tzinfo else value.replace(tzinfo=TIMEZONE)
+
+
+def today():
+    return datetime.now(TIMEZONE).date()
+
+
+def payments_day(day):
+    """День создания платежей в месяце day: PAYMENTS_DAY, но не позже
+    последнего дня месяца (31 в феврале - это 28 или 29)"""
+    return min(PAYMENTS_DAY, calendar.monthrange(day.year, day.month)[1])
+
+
+class PaymentScheduler:
+    """Плановое создание платежей и рассылка напоминаний через JobQueue.
+
+    Каждый запуск отмечается в таблице scheduler_runs (миграция 012) ключом
+    периода (месяц для платежей, день для напоминаний), поэтому после рестарта
+    уже выполненная задача повторно не запускается. Если задача упала, запуск
+    помечается failed и повторяется через RETRY_MINUTES; число попыток за период
+    хранится там же и не сбрасывается рестартом.
+    """
+
+    def __init__(self, payment_bot, engine):
+        self.payment_bot = payment_bot
+        self.engine = engine
+
+    def start(self, job_queue):
+        job_queue.run_daily(self.create_payments_job, local_time(PAYMENTS_TIME), name='create_payments')
+        job_queue.run_daily(self.send_reminders_job, local_time(REMINDER_TIME), name='send_reminders')
+        logger.info(
+            f'Планировщик запущен ({TIMEZONE.zone}): платежи {PAYMENTS_DAY}-го числа '
+            f'(в коротких месяцах - последнего) в {PAYMENTS_TIME}, '
+            f'напоминания в {REMINDER_TIME} со смещениями {REMINDER_DUE_OFFSETS}'
+        )
+
+    def create_payments_job(self, context):
+        """Создать платежи на следующий месяц в PAYMENTS_DAY"""
+        day = today()
+        if day.day != payments_day(day):
+            return
+        month = self.payment_bot.next_payment_month()
+        self._run(context, 'create_payments', month, lambda: self._create_payments(month), self.create_payments_job)
+
+    def send_reminders_job(self, context):
+        """Разослать напоминания, если сегодня срок оплаты плюс одно из смещений"""
+        day = today()
+        due_dates = {day - timedelta(days=offset) for offset in REMINDER_DUE_OFFSETS}
+        if not self.payment_bot.queries.has_unpaid_due_on(due_dates):
+            return
+        spread_over = REMINDER_WINDOW_MINUTES * 60
+        self._run(
+            context, 'send_reminders', day.isoformat(),
+            lambda: self.payment_bot.send_payment_reminders(
+                context, spread_over=spread_over, due_dates=due_dates
+            ).summary_text(),
+            self.send_reminders_job
+        )
+
+    def _create_payments(self, month):
+        count, total = self.payment_bot.queries.create_monthly_payments(month)
+        return f'Создано {count} платежей на {month} на сумму {total} руб.'
+
+    def _claim(self, job_name, run_key):
+        """Атомарно отметить запуск; False, если за этот период задача уже выполнялась
+        или выполняется. Упавший запуск (failed) можно повторить, попытки за тот же
+        период продолжают счет"""
+        with self.engine.begin() as conn:
+            result = conn.execute(text('''
+                INSERT INTO scheduler_runs (job_name, run_key, started_at, attempts, failed)
+                VALUES (:job_name, :run_key, :started_at, 0, FALSE)
+                ON CONFLICT (job_name) DO UPDATE
+                SET attempts = CASE WHEN scheduler_runs.run_key = excluded.run_key
+                                    THEN scheduler_runs.attempts ELSE 0 END,
+                    run_key = excluded.run_key,
+                    started_at = excluded.started_at,
+                    finished_at = NULL,
+                    duration = NULL,
+                    result = NULL,
+                    failed = FALSE
+                WHERE scheduler_runs.run_key <> excluded.run_key OR scheduler_runs.failed
+            '''), {'job_name': job_name, 'run_key': run_key, 'started_at': datetime.now()})
+            return result.rowcount > 0
+
+    def _run(self, context, job_name, run_key, action, job_callback):
+        if not self._claim(job_name, run_key):
+            logger.info(f'Задача {job_name} за {run_key} уже выполнена, пропускаем')
+            return
+
+        started = time.monotonic()
+        failed = False
+        try:
+            result = action()
+        except Exception as e:
+            logger.error(f'Ошибка плановой задачи {job_name}: {e}')
+            result = f'❌ Ошибка: {e}'
+            failed = True
+        duration = time.monotonic() - started
+
+        with self.engine.begin() as conn:
+            # Упавший запуск не засчитывается: failed снова разрешает _claim
+            attempts = conn.execute(text('''
+                UPDATE scheduler_runs
+                SET failed = :failed,
+                    attempts = attempts + CASE WHEN :failed THEN 1 ELSE 0 END,
+                    finished_at = :finished_at, duration = :duration, result = :result
+                WHERE job_name = :job_name
+                RETURNING attempts
+            '''), {'failed': failed, 'finished_at': datetime.now(), 'duration': duration, 'result': result,
+                   'job_name': job_name}).scalar()
+        if failed:
+            result += self._schedule_retry(context, job_name, run_key, job_callback, attempts)
+
+        report = f'⏰ Плановая задача {job_name} ({run_key})\n🕒 Длительность: {duration:.1f} сек.\n\n{result}'
+        for admin_id in config.ADMIN_IDS:
+            try:
+                context.bot.send_message(chat_id=admin_id, text=report)
+            except Exception as e:
+                logger.error(f'Не удалось отправить отчет админу {admin_id}: {e}')
+
+    def _schedule_retry(self, context, job_name, run_key, job_callback, attempt):
+        """Запланировать повтор упавшей задачи после attempt неудачных попыток;
+        возвращает строку для отчета админам"""
+        if attempt >= RETRY_ATTEMPTS:
+            return f'\n\n⛔ Попыток за {run_key}: {attempt}, автоматических повторов больше не будет'
+        context.job_queue.run_once(job_callback, RETRY_MINUTES * 60, name=f'{job_name}_retry')
+        return f'\n\n🔁 Повтор через {RETRY_MINUTES} мин. (попытка {attempt + 1} из {RETRY_ATTEMPTS})'
+
+    def last_runs(self):
+        with self.engine.connect() as conn:
+            return [dict(row._mapping) for row in conn.execute(text(
+                'SELECT job_name, run_key, started_at, duration, result, attempts, failed '
+                'FROM scheduler_runs ORDER BY job_name'
+            ))]
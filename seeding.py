@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, Index, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+logger = logging.getLogger(__name__)
+
+SEED_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schools.json')
+
+metadata = MetaData()
+
+schools_table = Table(
+    'schools', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+)
+
+grades_table = Table(
+    'grades', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('school_id', Integer, nullable=False),
+    Column('grade_name', String(50), nullable=False),
+    Column('monthly_payment', Integer, nullable=False),
+    # Ключ для upsert: в одной школе класс с таким названием только один
+    Index('ux_grades_school_name', 'school_id', 'grade_name', unique=True),
+)
+
+
+def load_seed_config(path=SEED_FILE):
+    """Прочитать школы и классы из JSON.
+
+    У школы может быть свой список "grades", иначе берется общий.
+    """
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+
+    default_grades = data.get('grades', [])
+    schools = []
+    grades = []
+    for school in data['schools']:
+        schools.append({'id': school['id'], 'name': school['name']})
+        for grade_number in school.get('grades', default_grades):
+            grades.append({
+                'school_id': school['id'],
+                'grade_name': f'{grade_number} класс',
+                'monthly_payment': school['monthly_payment'],
+            })
+    return schools, grades
+
+
+def _insert(engine, table):
+    if engine.dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def seed_reference_data(engine, path=SEED_FILE, create_schema=True):
+    """Добавить школы и классы из файла и обновить цены одной транзакцией.
+
+    Каждая таблица пишется одним INSERT ... ON CONFLICT DO UPDATE.
+    Возвращает словарь с количеством новых школ, новых классов и
+    классов с изменившейся ценой. Бот создает таблицы и индекс при
+    запуске (миграция 006) и вызывает функцию с create_schema=False.
+    """
+    schools, grades = load_seed_config(path)
+    with engine.begin() as conn:
+        if create_schema:
+            metadata.create_all(conn)
+            # В базах, созданных до появления индекса, create_all его не добавит
+            for index in grades_table.indexes:
+                index.create(conn, checkfirst=True)
+
+        known_school_ids = set(conn.execute(select(schools_table.c.id)).scalars())
+        known_prices = {
+            (row.school_id, row.grade_name): row.monthly_payment
+            for row in conn.execute(select(
+                grades_table.c.school_id, grades_table.c.grade_name, grades_table.c.monthly_payment
+            ))
+        }
+
+        if schools:
+            statement = _insert(engine, schools_table).values(schools)
+            conn.execute(statement.on_conflict_do_update(
+                index_elements=['id'],
+                set_={'name': statement.excluded.name}
+            ))
+
+        if grades:
+            statement = _insert(engine, grades_table).values(grades)
+            conn.execute(statement.on_conflict_do_update(
+                index_elements=['school_id', 'grade_name'],
+                set_={'monthly_payment': statement.excluded.monthly_payment}
+            ))
+
+    result = {
+        'added_schools': len([school for school in schools if school['id'] not in known_school_ids]),
+        'added_grades': len([
+            grade for grade in grades if (grade['school_id'], grade['grade_name']) not in known_prices
+        ]),
+        'updated_prices': len([
+            grade for grade in grades
+            if known_prices.get((grade['school_id'], grade['grade_name']), grade['monthly_payment'])
+            != grade['monthly_payment']
+        ]),
+    }
+    logger.info(f'Справочники загружены из {path}: {result}')
+    return result
@@ -0,0 +1,143 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import zlib
+
+from telegram import Bot, InlineKeyboardMarkup
+
+import config
+from delivery import DeliveryError, DeliveryReport, RateLimiter, ReminderDelivery, GLOBAL_RATE, is_transient
+
+logger = logging.getLogger(__name__)
+
+# Сколько процессов делят рассылку; 0 или 1 - отправка в процессе бота
+DELIVERY_PROCESSES = getattr(config, 'DELIVERY_PROCESSES', 0)
+# Потоков отправки в каждом процессе
+DELIVERY_THREADS = getattr(config, 'DELIVERY_THREADS', 8)
+
+
+def shard_of(chat_id, shards):
+    """Номер процесса для чата: все сообщения одного чата идут через один процесс,
+    поэтому интервал между сообщениями в чат соблюдается без координации"""
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+class _QueueReport:
+    """DeliveryReport внутри процесса-исполнителя: результаты уходят в очередь главного процесса"""
+
+    def __init__(self, events, cancelled):
+        self.events = events
+        self.cancelled = cancelled
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def add_sent(self, message):
+        self.sent += 1
+        self.events.put(('sent', message['index'], None))
+
+    def add_failed(self, message, error):
+        self.failed += 1
+        self.events.put(('failed', message['index'], (str(error), is_transient(error))))
+
+    def add_retry(self):
+        self.retried += 1
+        self.events.put(('retry', None, None))
+
+
+def _deliver_shard(token, messages, global_rate, threads, events, cancelled):
+    """Точка входа процесса-исполнителя"""
+    for message in messages:
+        if message['reply_markup']:
+            message['reply_markup'] = InlineKeyboardMarkup.de_json(message['reply_markup'], None)
+    try:
+        # Пустой bucket: каждая пачка начинается без всплеска сверх лимита
+        limiter = RateLimiter(global_rate=global_rate, tokens=0)
+        delivery = ReminderDelivery(Bot(token), workers=threads, limiter=limiter)
+        delivery.send_all(messages, _QueueReport(events, cancelled))
+    finally:
+        events.put(('done', None, None))
+
+
+class ShardedDelivery:
+    """Рассылка несколькими процессами: сообщения делятся по хэшу chat_id,
+    каждый процесс получает свою долю общего лимита GLOBAL_RATE.
+
+    Главный процесс собирает результаты в один DeliveryReport, так что
+    outbox, прогресс и кнопка остановки работают как при обычной рассылке.
+    Если процесс-исполнитель упал, его неотправленные сообщения остаются
+    sending в outbox; после окончания рассылки их возвращает в очередь
+    PaymentBot.reclaim_abandoned() при следующем resume_campaigns.
+
+    Один экземпляр на бота: одновременные рассылки отправляют свои пачки
+    по очереди, поэтому вместе не превышают global_rate.
+    """
+
+    def __init__(self, token, processes=DELIVERY_PROCESSES, global_rate=GLOBAL_RATE, threads=DELIVERY_THREADS):
+        self.token = token
+        self.processes = processes
+        self.global_rate = global_rate
+        self.threads = threads
+        self.lock = threading.Lock()
+
+    def send_all(self, messages, report=None, global_rate=None):
+        """global_rate - лимит этой рассылки, если он ниже общего (растянутые рассылки)"""
+        with self.lock:
+            return self._send_all(messages, report or DeliveryReport(), min(global_rate or self.global_rate, self.global_rate))
+
+    def _send_all(self, messages, report, global_rate):
+        shards = [[] for _ in range(self.processes)]
+        for index, message in enumerate(messages):
+            shards[shard_of(message['chat_id'], self.processes)].append({
+                'index': index,
+                'chat_id': message['chat_id'],
+                'text': message['text'],
+                'reply_markup': message['reply_markup'].to_dict() if message.get('reply_markup') else None,
+            })
+        shards = [shard for shard in shards if shard]
+        if not shards:
+            return report
+
+        # spawn: у бота уже работают потоки, fork их не копирует
+        context = multiprocessing.get_context('spawn')
+        events = context.Queue()
+        cancelled = context.Event()
+        share = global_rate / len(shards)
+        workers = [
+            context.Process(
+                target=_deliver_shard,
+                args=(self.token, shard, share, self.threads, events, cancelled),
+                name=f'delivery-{number}',
+                daemon=True
+            )
+            for number, shard in enumerate(shards)
+        ]
+        for worker in workers:
+            worker.start()
+        logger.info(f'Рассылка {len(messages)} сообщений в {len(workers)} процессах по {share:.1f} сообщ./сек.')
+
+        running = len(workers)
+        while running:
+            if report.cancelled.is_set():
+                cancelled.set()
+            try:
+                kind, index, error = events.get(timeout=0.5)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    logger.error('Процессы рассылки завершились, не отчитавшись о всех сообщениях')
+                    break
+                continue
+            if kind == 'sent':
+                report.add_sent(messages[index])
+            elif kind == 'failed':
+                report.add_failed(messages[index], DeliveryError(*error))
+            elif kind == 'retry':
+                report.add_retry()
+            else:
+                running -= 1
+
+        for worker in workers:
+            worker.join()
+        logger.info(f'Рассылка завершена: {report.sent} отправлено, {report.failed} ошибок, {report.retried} повторов')
+        return report
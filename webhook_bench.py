@@ -0,0 +1,170 @@
+"""Локальный стенд для сравнения задержки обработки обновлений в режимах
+polling и webhook.
+
+Обновления берутся из записанного JSON, Telegram подменяется заглушкой:
+в режиме webhook JSON отправляется POST-запросом на локальный сервер
+Updater.start_webhook, в режиме polling отдается из get_updates с семантикой
+long polling. Для каждого обновления замеряется время от отправки до вызова
+обработчика.
+
+    python webhook_bench.py --updates 200 --poll-interval 0.5
+"""
+import argparse
+import json
+import queue
+import socket
+import statistics
+import threading
+import time
+import urllib.request
+
+from telegram import Bot, Update, User
+from telegram.ext import Updater, CommandHandler, CallbackQueryHandler
+from telegram.utils.request import Request
+
+# Записанные обновления: /start от родителя и нажатие "✅ Оплатил"
+RECORDED_UPDATES = [
+    {
+        'update_id': 0,
+        'message': {
+            'message_id': 1,
+            'date': 1760000000,
+            'chat': {'id': 1001, 'type': 'private', 'first_name': 'Анна'},
+            'from': {'id': 1001, 'is_bot': False, 'first_name': 'Анна'},
+            'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+        }
+    },
+    {
+        'update_id': 0,
+        'callback_query': {
+            'id': '1',
+            'chat_instance': '1',
+            'from': {'id': 1001, 'is_bot': False, 'first_name': 'Анна'},
+            'data': 'payment_1',
+            'message': {
+                'message_id': 2,
+                'date': 1760000000,
+                'chat': {'id': 1001, 'type': 'private', 'first_name': 'Анна'},
+                'text': '💳 Напоминание об оплате'
+            }
+        }
+    }
+]
+
+WEBHOOK_PATH = 'telegram/bench-secret'
+
+
+class StubBot(Bot):
+    """Bot без сети: get_updates отдает обновления из локальной очереди"""
+
+    def __init__(self):
+        super().__init__(token='123456:BENCHMARK', request=Request(con_pool_size=8))
+        self.incoming = queue.Queue()
+
+    def get_me(self, *args, **kwargs):
+        self._bot = User(id=1, first_name='bench', is_bot=True, username='bench_bot')
+        return self._bot
+
+    def set_webhook(self, *args, **kwargs):
+        return True
+
+    def delete_webhook(self, *args, **kwargs):
+        return True
+
+    def get_updates(self, offset=None, limit=100, timeout=0, **kwargs):
+        # Как long polling у Telegram: ждем до timeout секунд первое обновление
+        try:
+            updates = [self.incoming.get(timeout=timeout or 0.01)]
+        except queue.Empty:
+            return []
+        while len(updates) < limit:
+            try:
+                updates.append(self.incoming.get_nowait())
+            except queue.Empty:
+                break
+        return [Update.de_json(data, self) for data in updates]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_mode(mode, count, poll_interval):
+    bot = StubBot()
+    bot.get_me()
+    updater = Updater(bot=bot, use_context=True)
+
+    sent_at = {}
+    latencies = []
+    done = threading.Event()
+
+    def record(update, context):
+        latencies.append(time.perf_counter() - sent_at[update.update_id])
+        if len(latencies) == count:
+            done.set()
+
+    updater.dispatcher.add_handler(CommandHandler('start', record))
+    updater.dispatcher.add_handler(CallbackQueryHandler(record))
+
+    port = free_port()
+    if mode == 'webhook':
+        updater.start_webhook(
+            listen='127.0.0.1',
+            port=port,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f'http://127.0.0.1:{port}/{WEBHOOK_PATH}'
+        )
+        # Даем tornado подняться
+        time.sleep(0.5)
+    else:
+        updater.start_polling(poll_interval=poll_interval, timeout=10)
+
+    try:
+        for update_id in range(1, count + 1):
+            data = dict(RECORDED_UPDATES[update_id % len(RECORDED_UPDATES)], update_id=update_id)
+            sent_at[update_id] = time.perf_counter()
+            if mode == 'webhook':
+                request = urllib.request.Request(
+                    f'http://127.0.0.1:{port}/{WEBHOOK_PATH}',
+                    data=json.dumps(data).encode(),
+                    headers={'Content-Type': 'application/json'}
+                )
+                urllib.request.urlopen(request).read()
+            else:
+                bot.incoming.put(data)
+            # Обновления приходят по одному, как нажатия живых пользователей
+            time.sleep(0.01)
+        done.wait(timeout=60)
+    finally:
+        updater.stop()
+
+    return latencies
+
+
+def report(mode, latencies):
+    ms = sorted(latency * 1000 for latency in latencies)
+    if not ms:
+        print(f'{mode:8} нет обработанных обновлений')
+        return
+    p95 = ms[int(len(ms) * 0.95) - 1] if len(ms) > 1 else ms[0]
+    print(
+        f'{mode:8} обновлений: {len(ms):5}  '
+        f'p50: {statistics.median(ms):7.2f} мс  p95: {p95:7.2f} мс  max: {ms[-1]:7.2f} мс'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Задержка обработки обновлений: polling против webhook')
+    parser.add_argument('--updates', type=int, default=100, help='сколько обновлений отправить в каждом режиме')
+    parser.add_argument('--poll-interval', type=float, default=0.0, help='poll_interval для start_polling')
+    args = parser.parse_args()
+
+    for mode in ('polling', 'webhook'):
+        report(mode, run_mode(mode, args.updates, args.poll_interval))
+
+
+if __name__ == '__main__':
+    main()